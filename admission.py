@@ -0,0 +1,123 @@
+# Keeps a burst of identical requests from turning into a burst of identical work.
+# SingleFlight lets concurrent callers share one fetch or translation; RateLimiter
+# and ConcurrencyLimit turn excess requests away quickly rather than letting them
+# queue without limit.
+
+import sys
+import time
+import threading
+
+class OverloadedError(Exception):
+    pass
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight(object):
+    """Coalesces concurrent calls with the same key: the first caller runs the
+    function, and callers arriving while it runs wait for and share its result."""
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if leader:
+            try:
+                flight.value = fn(*args)
+            except Exception:
+                flight.error = sys.exc_info()
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error:
+            raise flight.error[0], flight.error[1], flight.error[2]
+        return flight.value
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": len(self.flights), "calls": self.calls, "shared": self.shared}
+
+class RateLimiter(object):
+    """A token bucket per client: each client may make `burst` requests at once,
+    refilled at `rate` requests per second."""
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_clients = max_clients
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.limited = 0
+
+    def allow(self, client):
+        now = time.time()
+        with self.lock:
+            tokens, last = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[client] = (tokens, now)
+                self.limited += 1
+                return False
+            self.buckets[client] = (tokens - 1, now)
+            if len(self.buckets) > self.max_clients:
+                self.forget_idle_clients(now)
+            return True
+
+    def forget_idle_clients(self, now):
+        "Drops clients whose buckets have refilled; they are indistinguishable from new ones"
+        refill_time = self.burst / self.rate
+        for client, (tokens, last) in self.buckets.items():
+            if now - last > refill_time:
+                del self.buckets[client]
+
+    def stats(self):
+        with self.lock:
+            return {"rate": self.rate, "burst": self.burst, "clients": len(self.buckets),
+                    "limited": self.limited}
+
+class ConcurrencyLimit(object):
+    """Admits at most max_concurrent requests at once; use as a context manager.
+    Requests beyond the limit raise OverloadedError immediately."""
+
+    def __init__(self, max_concurrent):
+        self.max_concurrent = max_concurrent
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.shed = 0
+
+    def __enter__(self):
+        if not self.slots.acquire(False):
+            with self.lock:
+                self.shed += 1
+            raise OverloadedError("{} requests already in progress".format(self.max_concurrent))
+        with self.lock:
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.active -= 1
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {"max_concurrent": self.max_concurrent, "active": self.active,
+                    "shed": self.shed}
@@ -0,0 +1,189 @@
+# Times each phase of translation (parsing, declaring state, generating code and
+# rendering the template) on synthetic projects of various shapes, and compares
+# the timings with stored baselines so that regressions show up as numbers.
+#
+#     python benchmarks/run_benchmarks.py            # compare with baselines.json
+#     python benchmarks/run_benchmarks.py --save     # record new baselines
+
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import resource
+from os.path import dirname, join, realpath
+
+BENCHMARK_DIR = dirname(realpath(__file__))
+sys.path.insert(0, dirname(BENCHMARK_DIR))
+
+from translator import *
+from synthetic_projects import synthetic_project
+from metrics import metrics
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BASELINES = join(BENCHMARK_DIR, "baselines.json")
+
+SCENARIOS = [
+    ("small", {}),
+    ("many_scripts", {"scripts": 200}),
+    ("deep_nesting", {"depth": 40}),
+    ("long_expressions", {"expression_size": 100}),
+    ("long_lists", {"list_length": 5000}),
+    ("many_sprites", {"children": 40, "scripts": 80}),
+]
+
+PHASES = ["parse", "state", "codegen", "render"]
+
+def time_phase(fn, min_time=0.2, rounds=3):
+    "Returns the best time per call, in seconds, over several rounds of repeated calls"
+    best = None
+    for _ in range(rounds):
+        calls = 0
+        start = time.time()
+        while True:
+            fn()
+            calls += 1
+            elapsed = time.time() - start
+            if elapsed >= min_time:
+                break
+        per_call = elapsed / calls
+        best = per_call if best is None else min(best, per_call)
+    return best
+
+def peak_memory(fn):
+    """Returns how much memory one call needed at its peak, in bytes. Python 2 has
+    no tracemalloc, so there this is the growth in peak RSS, after resetting the
+    peak through /proc where Linux allows it."""
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        before = proc_status("VmRSS")
+        fn()
+        return proc_status("VmHWM") - before
+    except (IOError, OSError):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+
+def proc_status(field):
+    "Reads a memory size from /proc/self/status, in bytes"
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise IOError("No {} in /proc/self/status".format(field))
+
+def parse(project_json):
+    return ScratchObject(project_json, neopixel_target.new_context())
+
+def declare_state(project):
+    project.state_translation = None
+    return project.storage_plan(exclude=excluded_vars, reserved_sram=TEMPLATE_SRAM).declarations()
+
+def generate_code(project):
+    "Generates every script that goes into the sketch, bypassing the per-script cache"
+    code = [project.get_script("setup").block.emitted(), project.get_script("loop").block.emitted()]
+    code.extend(s.emitted() for s in project.get_scripts() if include_script(s))
+    return code
+
+def run_scenario(project_json, min_time):
+    size = len(json.dumps(project_json))
+    project = parse(project_json)
+    parts = program_parts(project)
+    del parts["plan"], parts["estimate"]
+    parts["helpers"] = list(parts["helpers"])
+    template = load_template("neopixel_template.html")
+    phases = [
+        ("parse", lambda: parse(project_json)),
+        ("state", lambda: declare_state(project)),
+        ("codegen", lambda: generate_code(project)),
+        ("render", lambda: template.render(**parts)),
+    ]
+    results = {"json_bytes": size}
+    for name, fn in phases:
+        seconds = time_phase(fn, min_time)
+        results[name] = {
+            "ms": round(seconds * 1000, 3),
+            "per_second": round(1 / seconds, 1),
+            "peak_kb": peak_memory(fn) // 1024
+        }
+    results["parse"]["mb_per_second"] = round(size / results["parse"]["ms"] / 1000, 2)
+    return results
+
+def compare(name, results, baseline, tolerance):
+    "Prints a scenario's timings against its baseline; returns the regressed phases"
+    regressions = []
+    for phase in PHASES:
+        ms = results[phase]["ms"]
+        line = "  {:<8} {:>10.3f} ms {:>9.1f}/s {:>9} KB".format(phase, ms,
+                results[phase]["per_second"], results[phase]["peak_kb"])
+        if baseline and phase in baseline:
+            change = (ms - baseline[phase]["ms"]) / baseline[phase]["ms"]
+            line += "  {:+7.1%} vs {:.3f} ms".format(change, baseline[phase]["ms"])
+            if change > tolerance:
+                line += "  REGRESSION"
+                regressions.append("{} {}".format(name, phase))
+        print(line)
+    return regressions
+
+def report_metrics(project_json, translations=5):
+    "Prints the translator's own per-phase metrics for translating a project"
+    metrics.enable(memory_sample_rate=1)
+    for _ in range(translations):
+        translate_project(project_json)
+    print("\n".join("  " + line for line in metrics.report().split("\n")))
+    metrics.drain()
+    metrics.enabled = False
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the translator's phases")
+    parser.add_argument("scenarios", nargs="*", help="Scenarios to run (default: all)")
+    parser.add_argument("--save", action="store_true",
+            help="Store these results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+            help="Slowdown relative to the baseline reported as a regression (default 0.25)")
+    parser.add_argument("--min-time", type=float, default=0.2,
+            help="Seconds to repeat each phase for, per round")
+    parser.add_argument("--metrics", action="store_true",
+            help="Also translate each project end to end with metrics on, and report them")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as baseline_file:
+            baselines = json.load(baseline_file)
+    regressions = []
+    for name, options in SCENARIOS:
+        if args.scenarios and name not in args.scenarios:
+            continue
+        results = run_scenario(synthetic_project(**options), args.min_time)
+        print("{} ({} KB of JSON, {} MB/s parsed)".format(name, results["json_bytes"] // 1024,
+                results["parse"]["mb_per_second"]))
+        regressions += compare(name, results, baselines.get(name), args.tolerance)
+        baselines[name] = results
+        if args.metrics:
+            report_metrics(synthetic_project(**options))
+
+    if args.save:
+        with open(BASELINES, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        print("Baselines written to {}".format(BASELINES))
+    elif regressions:
+        print("Slower than baseline: {}".format(", ".join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
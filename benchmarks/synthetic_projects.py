@@ -0,0 +1,148 @@
+# Generates Scratch 2 projects for benchmarking, using only the blocks the
+# translator supports. Each dimension that affects translation cost can be scaled
+# on its own: the number of scripts, how deeply their blocks nest, how large their
+# expressions are, how long the lists are, and how many sprites there are.
+
+import json
+import random
+
+OPERATORS = ["+", "-", "*", "/", "%"]
+COMPARISONS = ["=", ">", "<"]
+
+def label(index):
+    "Names have their digits stripped by clean_name, so number things with letters"
+    letters = ""
+    while True:
+        letters = chr(ord('a') + index % 26) + letters
+        index = index // 26
+        if not index:
+            return letters
+
+class ProjectGenerator(object):
+    def __init__(self, scripts=20, depth=3, expression_size=4, list_length=10,
+            children=2, variables=10, statements=4, seed=0):
+        self.scripts = scripts
+        self.depth = depth
+        self.expression_size = expression_size
+        self.list_length = list_length
+        self.children = children
+        self.variables = ["variable {}".format(label(i)) for i in range(variables)]
+        self.lists = ["list {}".format(label(i)) for i in range(3)]
+        self.statements = statements
+        self.random = random.Random(seed)
+        self.functions = []
+
+    def project(self):
+        "Returns the JSON for a whole project: a stage and its sprites"
+        self.functions = [("helper {}".format(label(i)), i % 3) for i in range(self.scripts)]
+        stage = {
+            "objName": "Stage",
+            "info": {},
+            "variables": [{"name": name, "value": 0, "isPersistent": False}
+                    for name in self.variables],
+            "lists": [{"listName": name, "contents": [self.random.randint(0, 255)
+                    for _ in range(self.list_length)]} for name in self.lists],
+            "scripts": [self.function("setup"), self.function("loop")],
+            "children": []
+        }
+        sprites = [stage] + [self.sprite(i) for i in range(self.children)]
+        for i, (name, args) in enumerate(self.functions):
+            sprites[i % len(sprites)]["scripts"].append(self.function(name, args))
+        for i in range(max(1, self.scripts // 5)):
+            sprites[i % len(sprites)]["scripts"].append(self.event_binding(i))
+        stage["children"] = sprites[1:]
+        return stage
+
+    def sprite(self, index):
+        return {
+            "objName": "Sprite{}".format(index),
+            "variables": [{"name": "sprite {} counter".format(label(index)), "value": 0,
+                    "isPersistent": False}],
+            "scripts": [],
+            "costumes": [{"costumeName": "costume", "baseLayerID": -1}] * 4,
+            "sounds": []
+        }
+
+    def function(self, name, args=0):
+        arg_names = ["argument {}".format(label(i)) for i in range(args)]
+        signature = ["procDef", name + " %n" * args, arg_names, [1] * args, False]
+        return [self.random.randint(0, 800), self.random.randint(0, 800),
+                [signature] + self.block(self.depth, arg_names)]
+
+    def event_binding(self, index):
+        if index % 2:
+            hat = ["whenIReceive", "message {}".format(label(index))]
+        else:
+            hat = ["whenGreenFlag"]
+        return [self.random.randint(0, 800), self.random.randint(0, 800),
+                [hat] + self.block(self.depth, [])]
+
+    def block(self, depth, params):
+        """A block of simple statements, with one nested statement among them
+        unless depth is 0. Nesting depth therefore grows without the number of
+        statements growing exponentially."""
+        block = [self.statement(params) for _ in range(self.statements)]
+        if depth > 0:
+            block.insert(self.random.randint(0, len(block)), self.nested(depth, params))
+        return block
+
+    def statement(self, params):
+        choice = self.random.randint(0, 5)
+        if choice == 0:
+            return ["setVar:to:", self.variable(), self.expression(self.expression_size, params)]
+        elif choice == 1:
+            return ["changeVar:by:", self.variable(), self.expression(self.expression_size, params)]
+        elif choice == 2:
+            return ["setLine:ofList:to:", self.random.randint(1, max(1, self.list_length)),
+                    self.random.choice(self.lists), self.expression(self.expression_size, params)]
+        elif choice == 3:
+            return ["wait:elapsed:from:", self.random.choice([0.1, 0.5, 1])]
+        elif choice == 4:
+            return ["broadcast:", "message {}".format(label(self.random.randint(0, 9)))]
+        elif choice == 5 and self.functions:
+            name, args = self.random.choice(self.functions)
+            return ["call", name + " %n" * args] + [self.expression(1, params)
+                    for _ in range(args)]
+        else:
+            return ["wait:elapsed:from:", 1]
+
+    def nested(self, depth, params):
+        choice = self.random.randint(0, 2)
+        if choice == 0:
+            return ["doIf", self.condition(params), self.block(depth - 1, params)]
+        elif choice == 1:
+            return ["doIfElse", self.condition(params), self.block(depth - 1, params),
+                    self.block(0, params)]
+        else:
+            return ["doRepeat", self.random.randint(2, 20), self.block(depth - 1, params)]
+
+    def condition(self, params):
+        return [self.random.choice(COMPARISONS), self.expression(self.expression_size // 2, params),
+                self.expression(self.expression_size // 2, params)]
+
+    def expression(self, size, params):
+        "An arithmetic expression with `size` operators, built without recursion"
+        operands = [self.operand(params) for _ in range(size + 1)]
+        while len(operands) > 1:
+            i = self.random.randint(0, len(operands) - 2)
+            operands[i:i + 2] = [[self.random.choice(OPERATORS), operands[i], operands[i + 1]]]
+        return operands[0]
+
+    def operand(self, params):
+        choice = self.random.randint(0, 3)
+        if choice == 0 and params:
+            return ["getParam", self.random.choice(params), "r"]
+        elif choice == 1:
+            return self.random.randint(0, 100)
+        else:
+            return ["readVariable", self.variable()]
+
+    def variable(self):
+        return self.random.choice(self.variables)
+
+def synthetic_project(**kwargs):
+    "Returns a project's JSON; see ProjectGenerator for the arguments"
+    return ProjectGenerator(**kwargs).project()
+
+if __name__ == '__main__':
+    print(json.dumps(synthetic_project(), indent=2))
@@ -0,0 +1,399 @@
+# Estimates, without compiling anything, how big a sketch will be and how long
+# each pass through loop() takes, so that students see what makes a sketch too
+# big or too slow before they upload it. The numbers are rough: flash is counted
+# per block from typical sizes of compiled AVR code, and time only counts what
+# dominates on a 16 MHz board: waiting, sending colors to the lights, and
+# floating point arithmetic, which the ATmega does in software.
+
+from scratch_blocks import *
+from storage_planner import TARGET_SRAM, TARGET_FLASH
+
+# Sending 24 bits to each of 15 pixels at 800 kHz, then the 50 us latch
+SHOW_MICROSECONDS = 15 * 24 * 1.25 + 50
+# A float add or multiply is around 150 cycles in software; a division more
+FLOAT_OP_MICROSECONDS = 10
+
+# Typical bytes of flash: the Arduino core, NeoPixel library and template; the
+# libraries some features link in; and the code for each block.
+BASE_FLASH = 3000
+MOTION_SENSOR_FLASH = 6000
+FLOAT_FLASH = 1500
+STRING_FLASH = 1600
+STATEMENT_FLASH = 12
+EXPRESSION_FLASH = 6
+
+# Nested repeat loops multiply quickly; counts stop growing here
+MAX_COUNT = 10 ** 9
+MAX_HOT_SPOTS = 10
+
+class Cost(object):
+    """What one run of some code costs, as far as the estimate goes. Waits and
+    forever loops are first counted as they are in a task, which pauses rather
+    than stopping the board (see scheduler). blocking() gives the cost of the
+    same code where it doesn't run as a task."""
+    __slots__ = ('wait_ms', 'unknown_waits', 'task_wait_ms', 'task_unknown_waits',
+            'shows', 'float_ops', 'never_ends', 'task_never_ends')
+
+    def __init__(self):
+        self.wait_ms = 0
+        self.unknown_waits = 0
+        self.task_wait_ms = 0
+        self.task_unknown_waits = 0
+        self.shows = 0
+        self.float_ops = 0
+        self.never_ends = False
+        self.task_never_ends = False
+
+    def add(self, other):
+        if other is None:
+            return
+        self.wait_ms = min(self.wait_ms + other.wait_ms, MAX_COUNT)
+        self.unknown_waits = min(self.unknown_waits + other.unknown_waits, MAX_COUNT)
+        self.task_wait_ms = min(self.task_wait_ms + other.task_wait_ms, MAX_COUNT)
+        self.task_unknown_waits = min(self.task_unknown_waits + other.task_unknown_waits,
+                MAX_COUNT)
+        self.shows = min(self.shows + other.shows, MAX_COUNT)
+        self.float_ops = min(self.float_ops + other.float_ops, MAX_COUNT)
+        self.never_ends = self.never_ends or other.never_ends
+        self.task_never_ends = self.task_never_ends or other.task_never_ends
+
+    def times(self, count):
+        cost = Cost()
+        cost.wait_ms = min(self.wait_ms * count, MAX_COUNT)
+        cost.unknown_waits = min(self.unknown_waits * count, MAX_COUNT)
+        cost.task_wait_ms = min(self.task_wait_ms * count, MAX_COUNT)
+        cost.task_unknown_waits = min(self.task_unknown_waits * count, MAX_COUNT)
+        cost.shows = min(self.shows * count, MAX_COUNT)
+        cost.float_ops = min(self.float_ops * count, MAX_COUNT)
+        cost.never_ends = self.never_ends
+        cost.task_never_ends = self.task_never_ends
+        return cost
+
+    def blocking(self):
+        "The cost of this code where it isn't a task, so its waits stop the board"
+        cost = Cost()
+        cost.add(self)
+        cost.wait_ms = min(cost.wait_ms + cost.task_wait_ms, MAX_COUNT)
+        cost.unknown_waits = min(cost.unknown_waits + cost.task_unknown_waits, MAX_COUNT)
+        cost.never_ends = cost.never_ends or cost.task_never_ends
+        cost.task_wait_ms = cost.task_unknown_waits = 0
+        cost.task_never_ends = False
+        return cost
+
+    def microseconds(self):
+        return self.wait_ms * 1000 + self.shows * SHOW_MICROSECONDS + \
+                self.float_ops * FLOAT_OP_MICROSECONDS
+
+    def to_json(self):
+        return {
+            "ms": round(self.microseconds() / 1000.0, 3),
+            "wait_ms": self.wait_ms,
+            "unknown_waits": self.unknown_waits,
+            "task_wait_ms": self.task_wait_ms,
+            "task_unknown_waits": self.task_unknown_waits,
+            "shows": self.shows,
+            "float_ops": self.float_ops,
+            "never_ends": self.never_ends
+        }
+
+class SketchEstimate(object):
+    "The estimated size of a sketch and cost of loop(), with the hot spots found"
+
+    def __init__(self, plan, flash_bytes, string_literal_bytes, loop, hot_spots):
+        self.plan = plan
+        self.flash_bytes = flash_bytes
+        self.string_literal_bytes = string_literal_bytes
+        self.loop = loop
+        self.hot_spots = hot_spots
+
+    def sram_bytes(self):
+        return self.plan.sram_bytes() + self.string_literal_bytes
+
+    def loop_microseconds(self):
+        "Waits in tasks don't count, since loop() carries on while a task waits"
+        return self.loop.microseconds()
+
+    def report(self):
+        "Summarizes the estimate as lines of comments for the top of the sketch"
+        lines = ["ESTIMATE: about {} of {} bytes of flash, and {} bytes of SRAM counting text in the code.".format(
+                self.flash_bytes, TARGET_FLASH, self.sram_bytes())]
+        loop = self.loop
+        if loop.never_ends:
+            lines.append("loop() never finishes a pass: it runs a forever loop.")
+        else:
+            lines.append("Each pass through loop() takes at least {}: {}.".format(
+                    format_duration(self.loop_microseconds()), ", ".join(cost_parts(loop))))
+        if self.flash_bytes > TARGET_FLASH or self.sram_bytes() > TARGET_SRAM:
+            lines.append("WARNING: the sketch probably won't fit on the board.")
+        lines.extend("HOT SPOT: " + hot_spot for hot_spot in self.hot_spots[:MAX_HOT_SPOTS])
+        if len(self.hot_spots) > MAX_HOT_SPOTS:
+            lines.append("... and {} more hot spots.".format(len(self.hot_spots) - MAX_HOT_SPOTS))
+        return lines
+
+    def to_json(self):
+        return {
+            "flash_bytes": self.flash_bytes,
+            "sram_bytes": self.sram_bytes(),
+            "loop": self.loop.to_json(),
+            "loop_ms": round(self.loop_microseconds() / 1000.0, 3),
+            "hot_spots": self.hot_spots
+        }
+
+def format_duration(microseconds):
+    if microseconds >= 86400 * 1000000:
+        return "more than a day"
+    if microseconds >= 1000000:
+        return "{:.1f} s".format(microseconds / 1000000.0)
+    if microseconds >= 1000:
+        return "{:.1f} ms".format(microseconds / 1000.0)
+    return "{:.0f} us".format(microseconds)
+
+def wait_parts(wait_ms, unknown_waits):
+    waits = []
+    if wait_ms or not unknown_waits:
+        waits.append("waiting {}".format(format_duration(wait_ms * 1000)))
+    if unknown_waits:
+        waits.append("{} wait{} of a length only known as it runs".format(
+                unknown_waits, "s" if unknown_waits != 1 else ""))
+    return " plus ".join(waits)
+
+def cost_parts(cost):
+    parts = []
+    in_tasks = cost.task_wait_ms or cost.task_unknown_waits
+    if cost.wait_ms or cost.unknown_waits or not in_tasks:
+        parts.append(wait_parts(cost.wait_ms, cost.unknown_waits))
+    if in_tasks:
+        parts.append("in tasks, {} (loop() carries on meanwhile)".format(
+                wait_parts(cost.task_wait_ms, cost.task_unknown_waits)))
+    parts.append("{} lights.show() ({})".format(cost.shows,
+            format_duration(cost.shows * SHOW_MICROSECONDS)))
+    parts.append("{} float operations ({})".format(cost.float_ops,
+            format_duration(cost.float_ops * FLOAT_OP_MICROSECONDS)))
+    return parts
+
+def repeat_count(node):
+    "Returns how many times a repeat loop runs, or None if that's only known as it runs"
+    if isinstance(node.repeats, LiteralNumber) and node.repeats.value >= 0:
+        return int(node.repeats.value)
+    return None
+
+# Nodes whose cost isn't just the sum of their children's
+BRANCHING = (DoRepeat, DoIfElse)
+
+STATEMENT, EXPRESSION, OPERATOR = 1, 2, 3
+KINDS = {}
+
+def kind_of(node_class):
+    "Whether a class of node is a statement, an operator or another expression"
+    if node_class not in KINDS:
+        if issubclass(node_class, ScratchStatement):
+            KINDS[node_class] = STATEMENT
+        elif issubclass(node_class, BinaryOperator):
+            KINDS[node_class] = OPERATOR
+        elif issubclass(node_class, ScratchExpression):
+            KINDS[node_class] = EXPRESSION
+        else:
+            KINDS[node_class] = None
+    return KINDS[node_class]
+
+class Estimator(object):
+    """Works out the cost of scripts, and of the functions they call, and counts
+    the code in each script it looks at. functions maps the names of the
+    functions in the sketch to their scripts, receivers maps each message to the
+    names of the functions that receive it, shows_per_call maps the target's own
+    functions to how many times each calls lights.show(), and types maps
+    variables, and (function, parameter) pairs, to their C types. With the
+    cooperative scheduler, receivers are tasks, and so are the functions in
+    pausing when a task calls them. whole_divisions holds the ids of the
+    divisions that divide as ints; the rest divide as floats."""
+
+    def __init__(self, functions, receivers, shows_per_call, types, tasks=False, pausing=(),
+            whole_divisions=()):
+        self.functions = functions
+        self.whole_divisions = whole_divisions
+        self.receivers = receivers
+        self.tasks = tasks
+        self.pausing = pausing
+        self.shows_per_call = shows_per_call
+        self.types = types
+        self.function_costs = {}
+        self.hot_spots = []
+        self.statements = 0
+        self.expressions = 0
+        self.string_literal_bytes = 0
+        self.uses_float = False
+
+    def function_cost(self, name):
+        if name in self.shows_per_call:
+            cost = Cost()
+            cost.shows = self.shows_per_call[name]
+            return cost
+        if name not in self.functions:
+            return None
+        if name not in self.function_costs:
+            # A function that calls itself is counted once
+            self.function_costs[name] = None
+            self.function_costs[name] = self.cost(self.functions[name].block, name)
+        return self.function_costs[name]
+
+    def cost(self, root, where):
+        """Returns the cost of running root once, or None if it costs nothing worth
+        counting, noting hot spots in it as being in where"""
+        nodes = []
+        parents = []
+        # Hot spots are reported for the outermost repeat loops, counting the loops in them
+        outermost = set()
+        stack = [(root, None, False)]
+        while stack:
+            node, parent, in_repeat = stack.pop()
+            nodes.append(node)
+            parents.append(parent)
+            if node.fields:
+                if type(node) is DoRepeat:
+                    if not in_repeat:
+                        outermost.add(id(node))
+                    in_repeat = True
+                for field in node.fields:
+                    value = getattr(node, field)
+                    if type(value) is list:
+                        stack.extend((item, node, in_repeat) for item in value)
+                    else:
+                        stack.append((value, node, in_repeat))
+
+        # Every node comes after its parent in nodes, so going backwards, each
+        # node's cost is complete by the time it's added to its parent's. Repeats
+        # and if/elses need their children's costs separately.
+        sums = {}
+        separate = {}
+        floats = set()
+        cost = None
+        for index in xrange(len(nodes) - 1, -1, -1):
+            node = nodes[index]
+            node_class = type(node)
+            kind = KINDS.get(node_class) or kind_of(node_class)
+            cost = sums.pop(id(node), None)
+            if kind == OPERATOR:
+                self.expressions += 1
+                # Division divides as floats unless it comes out whole, and a
+                # remainder cuts fractions to whole numbers (see Divide and Modulo)
+                if (node_class is Divide and id(node) not in self.whole_divisions) or \
+                        (node_class is not Modulo and
+                                (id(node.arg1) in floats or id(node.arg2) in floats)):
+                    cost = cost or Cost()
+                    cost.float_ops += 1
+                    floats.add(id(node))
+                    self.uses_float = True
+            elif kind == EXPRESSION:
+                self.expressions += 1
+                if node_class is LiteralNumber:
+                    if isinstance(node.value, float):
+                        floats.add(id(node))
+                        self.uses_float = True
+                elif node_class is ReadVar:
+                    if self.types.get(node.varName) == "float":
+                        floats.add(id(node))
+                elif node_class is GetParam:
+                    if self.types.get((where, node.varName)) == "float":
+                        floats.add(id(node))
+                elif node_class is LiteralString:
+                    # Text in the code is copied into SRAM when the sketch starts
+                    self.string_literal_bytes += len(node.value.encode('utf-8')) + 1
+            elif kind == STATEMENT:
+                self.statements += 1
+                if node_class is DoRepeat:
+                    cost = self.repeat_cost(node, separate.pop(id(node.repeats), None),
+                            separate.pop(id(node.block), None), where, id(node) in outermost)
+                elif node_class is DoIfElse:
+                    # The slower branch
+                    branches = [separate.pop(id(node.if_block), None) or Cost(),
+                            separate.pop(id(node.else_block), None) or Cost()]
+                    cost = Cost()
+                    cost.add(separate.pop(id(node.condition), None))
+                    cost.add(max(branches, key=lambda branch: branch.blocking().microseconds()))
+                elif node_class is Wait:
+                    cost = cost or Cost()
+                    if isinstance(node.duration, LiteralNumber):
+                        cost.task_wait_ms = min(cost.task_wait_ms + node.duration.value * 1000,
+                                MAX_COUNT)
+                    else:
+                        cost.task_unknown_waits += 1
+                elif node_class is Call:
+                    called = self.function_cost(node.function_name)
+                    if called is not None:
+                        cost = cost or Cost()
+                        # Only functions that run as tasks pause, rather than block
+                        if not (self.tasks and node.function_name in self.pausing):
+                            called = called.blocking()
+                        cost.add(called)
+                elif node_class is Broadcast:
+                    for name in self.receivers.get(node.broadcast_token, ()):
+                        called = self.function_cost(name)
+                        if called is not None:
+                            cost = cost or Cost()
+                            cost.add(called if self.tasks else called.blocking())
+                elif node_class is DoForever:
+                    cost = cost or Cost()
+                    cost.task_never_ends = True
+            parent = parents[index]
+            if cost is None or parent is None:
+                continue
+            if type(parent) in BRANCHING:
+                separate[id(node)] = cost
+            elif id(parent) in sums:
+                sums[id(parent)].add(cost)
+            else:
+                sums[id(parent)] = cost
+        # The last node done was the root
+        return cost
+
+    def repeat_cost(self, node, repeats, body, where, report=True):
+        if body is None:
+            return repeats
+        count = repeat_count(node)
+        if count is None:
+            self.hot_spots.append("in {}, a repeat loop runs a number of times only " \
+                    "known as it runs, so it is counted once.".format(where))
+            count = 1
+        cost = body.times(count)
+        if report:
+            if cost.shows > 1:
+                self.hot_spots.append("in {}, a repeat loop calls lights.show() {} times. " \
+                        "Set all the lights, then show them once.".format(where, cost.shows))
+            if cost.float_ops > 1:
+                self.hot_spots.append("in {}, a repeat loop does {} float operations.".format(
+                        where, cost.float_ops))
+            wait_ms = cost.wait_ms + cost.task_wait_ms
+            if wait_ms and count > 1:
+                self.hot_spots.append("in {}, a repeat loop waits {} in all.".format(
+                        where, format_duration(wait_ms * 1000)))
+        cost.add(repeats)
+        return cost
+
+def estimate_sketch(plan, estimator, setup, loop, motion_sensor=False):
+    """Estimates a sketch's size, and the cost of a pass through loop. plan is its
+    StoragePlan, estimator an Estimator for the functions in it, and setup and
+    loop the code that setup() and loop() run. loop runs as a task if the
+    estimator's receivers do."""
+    loop_cost = estimator.cost(loop, "loop") or Cost()
+    if not estimator.tasks:
+        loop_cost = loop_cost.blocking()
+    # Only hot spots in loop() and the functions it calls matter, and those are
+    # all found while working out its cost
+    hot_spots = list(estimator.hot_spots)
+    # The rest of the sketch is only looked at to count its code
+    estimator.cost(setup, "setup")
+    for name in estimator.functions:
+        estimator.function_cost(name)
+
+    flash = BASE_FLASH + plan.flash_bytes() + estimator.string_literal_bytes + \
+            estimator.statements * STATEMENT_FLASH + estimator.expressions * EXPRESSION_FLASH
+    # A variable's starting value is copied from flash into SRAM
+    flash += plan.sram_bytes() - plan.reserved_sram
+    types = set(d.c_type for d in plan.decisions)
+    if motion_sensor:
+        flash += MOTION_SENSOR_FLASH
+    if estimator.uses_float or "float" in types:
+        flash += FLOAT_FLASH
+    if "String" in types:
+        flash += STRING_FLASH
+    return SketchEstimate(plan, flash, estimator.string_literal_bytes, loop_cost, hot_spots)
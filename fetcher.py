@@ -0,0 +1,173 @@
+# Fetches project JSON from the Scratch CDN. Connections are pooled and kept alive,
+# responses are cached for a short TTL, and stale responses are revalidated with
+# ETag/Last-Modified so that unchanged projects aren't downloaded again.
+# The backend is pluggable: DirectoryBackend (or HTTPBackend pointed at a stub
+# server) stands in for the CDN in tests and benchmarks.
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+CDN_URL = "http://cdn.projects.scratch.mit.edu/internalapi/project/{}/get/"
+
+class NotFoundError(Exception):
+    pass
+
+class FetchError(Exception):
+    pass
+
+class FetchResult(object):
+    "What a backend returns: the raw body plus validators, or not_modified"
+    def __init__(self, body=None, etag=None, last_modified=None, not_modified=False):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.not_modified = not_modified
+
+class HTTPBackend(object):
+    """Fetches projects over HTTP, sharing one pool of keep-alive connections.
+    requests is slow to import, so neither it nor the connections are set up
+    until the first fetch."""
+
+    def __init__(self, url_template=CDN_URL, timeout=10, pool_size=32, retries=1):
+        self.url_template = url_template
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.session = None
+        self.session_lock = threading.Lock()
+
+    def __repr__(self):
+        return "<HTTPBackend {}>".format(self.url_template)
+
+    def connect(self):
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size,
+                        pool_maxsize=self.pool_size, max_retries=self.retries)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+        return self.session
+
+    def fetch(self, scratch_id, etag=None, last_modified=None):
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        session = self.session or self.connect()
+        import requests
+        try:
+            response = session.get(self.url_template.format(scratch_id),
+                    headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise FetchError("Could not fetch project {}: {}".format(scratch_id, e))
+        if response.status_code == 304:
+            return FetchResult(not_modified=True)
+        elif response.status_code == 404:
+            raise NotFoundError("Invalid project ID")
+        elif not response.ok:
+            raise FetchError("Could not fetch project {}: HTTP {}".format(
+                    scratch_id, response.status_code))
+        return FetchResult(
+            body=response.content,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified")
+        )
+
+class DirectoryBackend(object):
+    "Reads projects from <directory>/<scratch_id>.json, using mtime as a validator"
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __repr__(self):
+        return "<DirectoryBackend {}>".format(self.directory)
+
+    def fetch(self, scratch_id, etag=None, last_modified=None):
+        path = os.path.join(self.directory, "{}.json".format(scratch_id))
+        try:
+            mtime = str(os.path.getmtime(path))
+            if last_modified == mtime:
+                return FetchResult(not_modified=True)
+            with open(path, 'rb') as project_file:
+                return FetchResult(body=project_file.read(), last_modified=mtime)
+        except (IOError, OSError):
+            raise NotFoundError("Invalid project ID")
+
+class CacheEntry(object):
+    def __init__(self, project, result, fetched_at):
+        self.project = project
+        self.etag = result.etag
+        self.last_modified = result.last_modified
+        self.fetched_at = fetched_at
+
+class ProjectFetcher(object):
+    """Returns decoded project JSON by ID. Responses younger than ttl seconds are
+    served from memory; older ones are revalidated with the backend."""
+
+    def __init__(self, backend, ttl=5, max_entries=512):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.downloads = 0
+
+    def get(self, scratch_id):
+        scratch_id = str(scratch_id)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(scratch_id, None)
+            if entry is not None:
+                self.entries[scratch_id] = entry
+                if now - entry.fetched_at < self.ttl:
+                    self.hits += 1
+                    return entry.project
+        if entry is not None:
+            result = self.backend.fetch(scratch_id, entry.etag, entry.last_modified)
+        else:
+            result = self.backend.fetch(scratch_id)
+        with self.lock:
+            if result.not_modified:
+                self.revalidations += 1
+                entry.fetched_at = now
+                return entry.project
+            try:
+                project = json.loads(result.body)
+            except ValueError:
+                raise FetchError("Project {} is not valid JSON".format(scratch_id))
+            self.downloads += 1
+            self.entries[scratch_id] = CacheEntry(project, result, now)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return project
+
+    def invalidate(self, scratch_id):
+        with self.lock:
+            self.entries.pop(str(scratch_id), None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": repr(self.backend),
+                "entries": len(self.entries),
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "downloads": self.downloads
+            }
+
+def backend_from_environment():
+    "SCRATCH2ARDUINO_PROJECT_DIR or SCRATCH2ARDUINO_CDN_URL replace the Scratch CDN"
+    if os.environ.get("SCRATCH2ARDUINO_PROJECT_DIR"):
+        return DirectoryBackend(os.environ["SCRATCH2ARDUINO_PROJECT_DIR"])
+    return HTTPBackend(os.environ.get("SCRATCH2ARDUINO_CDN_URL", CDN_URL))
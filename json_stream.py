@@ -0,0 +1,177 @@
+# An incremental pull parser for JSON, for reading projects without decoding the
+# whole document up front. The caller walks the structure it cares about with
+# keys() and items(), decodes the subtrees it needs with value(), and passes over
+# everything else with skip(), which scans without building any Python objects.
+
+import re
+import json
+import codecs
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+# Everything up to the next bracket, including whole strings (with any brackets in them)
+CONTENTS = re.compile(r'(?:[^"\[\]{}]+|"(?:[^"\\]|\\.)*")*', re.DOTALL)
+SCALAR = re.compile(r'[^\s,:\[\]{}"]+')
+# What can follow a number, true, false or null; anything else may be more of it
+AFTER_SCALAR = frozenset(u' \t\n\r,:]}')
+
+class JSONStream(object):
+    "Reads JSON incrementally from a file-like object"
+
+    def __init__(self, fileobj, chunk_size=64 * 1024):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = u""
+        self.pos = 0
+        # Where the value being read by value() starts, so it stays in the buffer
+        self.mark = None
+        self.eof = False
+
+    def fill(self):
+        "Reads another chunk into the buffer. Returns False at the end of the input."
+        if self.eof:
+            return False
+        start = self.pos if self.mark is None else self.mark
+        # While a value is being read, read as much again as is buffered, so that
+        # a large value is copied a few times rather than once per chunk
+        chunk = self.fileobj.read(self.chunk_size if self.mark is None else
+                max(self.chunk_size, len(self.buf) - start))
+        if start > len(self.buf) // 2:
+            self.buf = self.buf[start:]
+            self.pos -= start
+            if self.mark is not None:
+                self.mark = 0
+        if not chunk:
+            self.eof = True
+            self.buf += self.decoder.decode(b"", True)
+        elif isinstance(chunk, unicode):
+            self.buf += chunk
+        else:
+            self.buf += self.decoder.decode(chunk)
+        return True
+
+    def peek(self):
+        "Returns the next non-whitespace character without consuming it, or '' at the end"
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            self.error("Expected {!r} but found {!r}".format(char, found))
+        self.pos += 1
+
+    def value(self):
+        """Decodes and returns the next complete value. A value that isn't all in
+        the buffer has its end found first, as skip() finds it, so it is decoded
+        once however many chunks it spans."""
+        self.peek()
+        try:
+            value, end = self.json_decoder.raw_decode(self.buf, self.pos)
+            # A number might continue past what was decoded: past the end of the
+            # buffer, or past a "." or "e" the decoder stopped at
+            if self.eof or (end < len(self.buf) and (self.buf[self.pos] in u'"[{' or
+                    self.buf[end] in AFTER_SCALAR)):
+                self.pos = end
+                return value
+        except ValueError:
+            pass
+        self.mark = self.pos
+        try:
+            self.skip()
+        finally:
+            start, self.mark = self.mark, None
+        try:
+            value, end = self.json_decoder.raw_decode(self.buf, start)
+        except ValueError:
+            self.error("Invalid JSON value")
+        if end != self.pos:
+            self.error("Invalid JSON value")
+        return value
+
+    def skip(self):
+        "Consumes the next value without decoding it"
+        depth = 0
+        while True:
+            char = self.peek()
+            if char == '"':
+                self.skip_string()
+            elif char in ('[', '{'):
+                depth += 1
+                self.pos += 1
+            elif char in (']', '}'):
+                depth -= 1
+                self.pos += 1
+            elif not char:
+                self.error("Unexpected end of input")
+            elif depth:
+                self.pos = CONTENTS.match(self.buf, self.pos).end()
+                continue
+            else:
+                self.skip_scalar()
+            if depth == 0:
+                return
+
+    def skip_string(self):
+        while True:
+            match = STRING.match(self.buf, self.pos)
+            if match:
+                self.pos = match.end()
+                return
+            if not self.fill():
+                self.error("Unterminated string")
+
+    def skip_scalar(self):
+        while True:
+            match = SCALAR.match(self.buf, self.pos)
+            if match and (match.end() < len(self.buf) or self.eof):
+                self.pos = match.end()
+                return
+            if not self.fill():
+                self.error("Invalid JSON value")
+
+    def keys(self):
+        """Iterates over the keys of the object starting here. The caller must
+        consume each key's value (with value(), skip(), keys() or items())
+        before asking for the next key."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            self.end_of_member('}')
+            if self.buf[self.pos - 1] == '}':
+                return
+
+    def items(self):
+        """Iterates over the array starting here, yielding each index. The caller
+        must consume each item before asking for the next one."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            self.end_of_member(']')
+            if self.buf[self.pos - 1] == ']':
+                return
+
+    def end_of_member(self, closing):
+        char = self.peek()
+        if char not in (',', closing):
+            self.error("Expected ',' or {!r} but found {!r}".format(closing, char))
+        self.pos += 1
+
+    def error(self, message):
+        raise ValueError("{} at character {} of buffer".format(message, self.pos))
@@ -0,0 +1,192 @@
+# Records how long each phase of a translation takes (fetching, parsing, declaring
+# state, generating code, rendering) in histograms, and optionally how much memory
+# a sample of them allocate. Metrics are off unless enabled; when they are off,
+# measuring a phase costs one attribute check.
+
+import time
+import random
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1, 2.5, 5, 10)
+BYTES_BUCKETS = (64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20, 64 << 20, 256 << 20)
+
+class Histogram(object):
+    "Counts observations into buckets by upper bound, plus one for anything larger"
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, snapshot):
+        for i, count in enumerate(snapshot["counts"]):
+            self.counts[i] += count
+        self.count += snapshot["count"]
+        self.sum += snapshot["sum"]
+        self.max = max(self.max, snapshot["max"])
+
+    def snapshot(self):
+        return {
+            "bounds": list(self.bounds),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "mean": self.sum / float(self.count) if self.count else 0
+        }
+
+class NoPhase(object):
+    "Stands in for Phase when metrics are off"
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+
+NO_PHASE = NoPhase()
+
+class Phase(object):
+    def __init__(self, metrics, name, trace_memory):
+        self.metrics = metrics
+        self.name = name
+        self.trace_memory = trace_memory
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self.start
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.metrics.tracing = False
+        self.metrics.observe(self.name, seconds, peak)
+        return False
+
+class Metrics(object):
+    """Histograms of phase durations, by phase name. With memory_sample_rate
+    set (and tracemalloc available), that fraction of phases also record the
+    peak memory they allocate. Tracing memory slows a phase down considerably."""
+
+    def __init__(self, enabled=False, memory_sample_rate=0):
+        self.enabled = enabled
+        self.memory_sample_rate = memory_sample_rate
+        self.durations = {}
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.tracing = False
+
+    def enable(self, memory_sample_rate=None):
+        self.enabled = True
+        if memory_sample_rate is not None:
+            self.memory_sample_rate = memory_sample_rate
+
+    def phase(self, name):
+        "Returns a context manager that records how long its body takes"
+        if not self.enabled:
+            return NO_PHASE
+        return Phase(self, name, self.should_trace_memory())
+
+    def should_trace_memory(self):
+        "Samples phases to trace. Tracing is process-wide, so only one phase is traced at a time."
+        if not (tracemalloc and self.memory_sample_rate):
+            return False
+        if random.random() >= self.memory_sample_rate:
+            return False
+        with self.lock:
+            if self.tracing or tracemalloc.is_tracing():
+                return False
+            self.tracing = True
+            return True
+
+    def observe(self, name, seconds, peak_bytes=None):
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = Histogram(SECONDS_BUCKETS)
+            self.durations[name].observe(seconds)
+            if peak_bytes is not None:
+                if name not in self.memory:
+                    self.memory[name] = Histogram(BYTES_BUCKETS)
+                self.memory[name].observe(peak_bytes)
+
+    def snapshot(self):
+        with self.lock:
+            return self.describe(self.durations, self.memory)
+
+    def drain(self):
+        "Returns a snapshot and starts over, for passing metrics back from a worker process"
+        with self.lock:
+            snapshot = self.describe(self.durations, self.memory)
+            self.durations = {}
+            self.memory = {}
+            return snapshot
+
+    def describe(self, durations, memory):
+        return {
+            "enabled": self.enabled,
+            "memory_sample_rate": self.memory_sample_rate if tracemalloc else None,
+            "seconds": dict((name, h.snapshot()) for name, h in durations.items()),
+            "peak_bytes": dict((name, h.snapshot()) for name, h in memory.items())
+        }
+
+    def merge(self, snapshot):
+        "Adds a snapshot taken elsewhere (say, in a worker process) to these metrics"
+        with self.lock:
+            for kind, histograms, bounds in (("seconds", self.durations, SECONDS_BUCKETS),
+                    ("peak_bytes", self.memory, BYTES_BUCKETS)):
+                for name, histogram in snapshot[kind].items():
+                    if name not in histograms:
+                        histograms[name] = Histogram(bounds)
+                    histograms[name].merge(histogram)
+
+    def prometheus(self, prefix="scratch2arduino"):
+        "Formats the histograms in Prometheus' text exposition format"
+        lines = []
+        snapshot = self.snapshot()
+        for kind in ("seconds", "peak_bytes"):
+            metric = "{}_phase_{}".format(prefix, kind)
+            if snapshot[kind]:
+                lines.append("# TYPE {} histogram".format(metric))
+            for name, histogram in sorted(snapshot[kind].items()):
+                cumulative = 0
+                for bound, count in zip(histogram["bounds"] + ["+Inf"], histogram["counts"]):
+                    cumulative += count
+                    lines.append('{}_bucket{{phase="{}",le="{}"}} {}'.format(
+                            metric, name, bound, cumulative))
+                lines.append('{}_sum{{phase="{}"}} {}'.format(metric, name, histogram["sum"]))
+                lines.append('{}_count{{phase="{}"}} {}'.format(metric, name, histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        "A table of phase timings, for printing from the command line"
+        lines = ["{:<12} {:>8} {:>10} {:>10}".format("phase", "count", "mean ms", "max ms")]
+        snapshot = self.snapshot()
+        for name, histogram in sorted(snapshot["seconds"].items()):
+            lines.append("{:<12} {:>8} {:>10.3f} {:>10.3f}".format(name, histogram["count"],
+                    histogram["mean"] * 1000, histogram["max"] * 1000))
+        return "\n".join(lines)
+
+# Shared by everything in this process; the server and CLI enable it with --metrics.
+metrics = Metrics()
@@ -0,0 +1,152 @@
+# Rewrites for the NeoPixel workshop target. The Scratch simulation mocks the
+# board's motion sensor with variables; these hooks turn reads of those variables
+# back into calls to the sensor, and record that the sketch needs the sensor. The
+# messages the simulation broadcasts to drive itself are dropped, since on the
+# board the template does their work.
+# Another hook batches changes to the lights, so the strip is updated once per
+# run of changes rather than once per light.
+
+from scratch_blocks import *
+from optimizer import LoopInvariants, add_optimizations
+
+MOTION_SENSOR = "motion_sensor"
+BATCHED_LIGHTS = "batched_lights"
+
+# The template's functions that change a light, and versions of each that leave
+# the change to be shown by the next call to showLights()
+BUFFERED = {"turnOnLight": "turnOnLightBuffered", "turnOffLight": "turnOffLightBuffered",
+        "setLightToRgb": "setLightToRgbBuffered"}
+
+# The functions the template defines, and how many times each calls lights.show()
+SHOWS_PER_CALL = {"turnOnLight": 1, "turnOffLight": 1, "setLightToRgb": 1, "showLights": 1,
+        "turnOnLightBuffered": 0, "turnOffLightBuffered": 0, "setLightToRgbBuffered": 0}
+
+# Messages the simulation broadcasts: to start running the student's code once the
+# lights are set up, and to redraw the lights on the stage
+SIMULATION_MESSAGES = ["lightsAreReady", "updateLights"]
+
+hooks = RewriteHooks()
+
+@hooks.register(ReadVar)
+def read_acceleration(node, context):
+    if node.varName == "acceleration":
+        context.use(MOTION_SENSOR)
+        return ArduinoExpression("motionSensor.intensity()", context)
+
+@hooks.register(Equals)
+def compare_is_moving(node, context):
+    if isinstance(node.arg1, ReadVar) and node.arg1.varName == "isMoving":
+        val = node.arg2
+    elif isinstance(node.arg2, ReadVar) and node.arg2.varName == "isMoving":
+        val = node.arg1
+    else:
+        return None
+    if isinstance(val, LiteralString):
+        context.use(MOTION_SENSOR)
+        if val.value == "YES":
+            return ArduinoExpression("motionSensor.moving()", context)
+        else:
+            return ArduinoExpression("!motionSensor.moving()", context)
+
+@hooks.register(Broadcast)
+def drop_simulation_broadcast(node, context):
+    if node.broadcast_token in SIMULATION_MESSAGES:
+        return NullStatement(None, node.indent, context)
+
+# Statements that take no time worth seeing, and don't change the lights
+INSTANT = (SetVar, ChangeVarBy, SetListItemValue, NullStatement)
+
+def light_changes(root):
+    """Maps the id of each statement and block in root that runs straight through
+    to how many lights it may change: 0, 1, or 2 for more than one. Waits, forever
+    loops, calls to other functions and broadcasts are left out, along with
+    anything containing them, since the lights could be seen meanwhile. Only
+    statements and their blocks are visited: expressions can't change a light."""
+    nodes = []
+    blocks = [root.block]
+    while blocks:
+        block = blocks.pop()
+        nodes.append(block)
+        for statement in block.statements:
+            nodes.append(statement)
+            if type(statement) is LoopInvariants:
+                nodes.append(statement.loop)
+            blocks.extend(nested_blocks(statement))
+    changes = {}
+    for node in reversed(nodes):
+        kind = type(node)
+        if kind is Call:
+            if node.function_name in BUFFERED:
+                changes[id(node)] = 1
+        elif kind in INSTANT:
+            changes[id(node)] = 0
+        elif kind is ScratchCodeBlock:
+            if all(id(statement) in changes for statement in node.statements):
+                changes[id(node)] = min(2, sum(changes[id(statement)]
+                        for statement in node.statements))
+        elif kind is DoIf or kind is DoRepeat:
+            if id(node.block) in changes:
+                # A repeat may change the same light more than once
+                changes[id(node)] = changes[id(node.block)] * (2 if kind is DoRepeat else 1)
+        elif kind is DoIfElse:
+            if id(node.if_block) in changes and id(node.else_block) in changes:
+                changes[id(node)] = max(changes[id(node.if_block)], changes[id(node.else_block)])
+        elif kind is LoopInvariants:
+            if id(node.loop) in changes:
+                changes[id(node)] = changes[id(node.loop)]
+    return changes
+
+def nested_blocks(statement):
+    if isinstance(statement, LoopInvariants):
+        statement = statement.loop
+    if isinstance(statement, DoIfElse):
+        return [statement.if_block, statement.else_block]
+    if isinstance(statement, (DoIf, DoRepeat, DoForever)):
+        return [statement.block]
+    return []
+
+def show_lights(indent, context):
+    return Call(indent=indent, context=context, function_name="showLights")
+
+@hooks.register(Function)
+def batch_light_changes(node, context):
+    """Each template function that changes a light shows the whole strip. Where a
+    script changes more than one light without pausing, this changes them all
+    first and then shows the strip once, before the script pauses or moves on."""
+    changes = light_changes(node)
+    if not any(changes.itervalues()):
+        return None
+    batched = False
+    blocks = [node.block]
+    while blocks:
+        block = blocks.pop()
+        statements = []
+        run = []
+        run_changes = 0
+        for statement in block.statements + [None]:
+            if statement is not None and id(statement) in changes:
+                run.append(statement)
+                run_changes += changes[id(statement)]
+                continue
+            statements.extend(run)
+            if run_changes > 1:
+                for part in run:
+                    for call in walk(part):
+                        if type(call) is Call and call.function_name in BUFFERED:
+                            call.function_name = BUFFERED[call.function_name]
+                statements.append(show_lights(block.indent, context))
+                batched = True
+            run = []
+            run_changes = 0
+            if statement is not None:
+                statements.append(statement)
+                blocks.extend(nested_blocks(statement))
+        block.statements = statements
+    if batched:
+        context.use(BATCHED_LIGHTS)
+
+add_optimizations(hooks)
+
+def new_context(scheduler="delay"):
+    "Returns a fresh TranslationContext for one NeoPixel translation, under scheduler"
+    return TranslationContext(hooks, scheduler)
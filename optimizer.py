@@ -0,0 +1,234 @@
+# Simplifies arithmetic before any code is generated. Student projects are full of
+# expressions like (0 + (brightness / 3)), which the board would otherwise work out
+# on every pass through loop(). These rewrite hooks fold operations on constants,
+# drop additions of 0 and multiplications by 1, and work out expressions that can't
+# change while a repeat or forever loop runs once, before the loop. Multiplying by
+# a power of two is left to the compiler, which already turns it into a shift.
+
+from scratch_blocks import *
+
+# Arduino's int is 16 bits. Folding a sum of ints into a larger literal would make
+# it a long, where the board would have overflowed.
+INT_MIN = -32768
+INT_MAX = 32767
+
+class LoopInvariants(ScratchStatement):
+    """A loop, preceded by declarations of the values it uses that can't change
+    while it runs. The loop refers to each value by name."""
+    __slots__ = ('names', 'values', 'reads', 'loop')
+    fields = ('values', 'loop')
+    compound = True
+
+    def __init__(self, loop, context):
+        self.indent = loop.indent
+        self.context = context
+        self.names = []
+        self.values = []
+        # The variables each value reads
+        self.reads = []
+        self.loop = loop
+
+    def parts(self):
+        # auto keeps each value's type exactly what it was inside the loop
+        return ["const auto {} = {};".format(name, value.to_arduino())
+                for name, value in zip(self.names, self.values)] + [self.loop]
+
+    def declare(self, name, value, reads):
+        self.names.append(name)
+        self.values.append(value)
+        self.reads.append(reads)
+
+def is_integer_literal(node, value=None):
+    return isinstance(node, LiteralNumber) and isinstance(node.value, (int, long)) and \
+            not isinstance(node.value, bool) and (value is None or node.value == value)
+
+def evaluate(node, a, b):
+    "Works out node's value for literal arguments as the board would, or None if it can't"
+    integers = isinstance(a, (int, long)) and isinstance(b, (int, long))
+    if isinstance(node, Add):
+        value = a + b
+    elif isinstance(node, Subtract):
+        value = a - b
+    elif isinstance(node, Multiply):
+        value = a * b
+    elif isinstance(node, Divide):
+        if b == 0:
+            return None
+        # A whole number only if the division is exact, as in Scratch
+        if integers and a % b == 0:
+            value = a // b
+        else:
+            value = float(a) / b
+    elif isinstance(node, Modulo):
+        # Fractions are cut to whole numbers first (see Modulo)
+        a, b, integers = int(a), int(b), True
+        if b == 0 or not (INT_MIN <= a <= INT_MAX and INT_MIN <= b <= INT_MAX):
+            return None
+        value = abs(a) % abs(b) * (-1 if a < 0 else 1)
+    elif isinstance(node, Equals):
+        value = int(a == b)
+    elif isinstance(node, GreaterThan):
+        value = int(a > b)
+    elif isinstance(node, LessThan):
+        value = int(a < b)
+    elif isinstance(node, And):
+        value = int(bool(a) and bool(b))
+    else:
+        return None
+    if integers and not INT_MIN <= value <= INT_MAX:
+        return None
+    if isinstance(value, float) and (value != value or value in (float("inf"), float("-inf"))):
+        return None
+    return value
+
+def simplify(node, context):
+    arg1, arg2 = node.arg1, node.arg2
+    literal1, literal2 = type(arg1) is LiteralNumber, type(arg2) is LiteralNumber
+    if not (literal1 or literal2):
+        return None
+    if literal1 and literal2:
+        value = evaluate(node, arg1.value, arg2.value)
+        if value is not None:
+            return LiteralNumber(value, context)
+        return None
+    # Only int literals: adding 0.0 would also make an int expression a float
+    if isinstance(node, Add):
+        if is_integer_literal(arg1, 0):
+            return arg2
+        if is_integer_literal(arg2, 0):
+            return arg1
+    elif isinstance(node, Subtract) and is_integer_literal(arg2, 0):
+        return arg1
+    elif isinstance(node, Multiply):
+        if is_integer_literal(arg1, 1):
+            return arg2
+        if is_integer_literal(arg2, 1):
+            return arg1
+    elif isinstance(node, Divide) and is_integer_literal(arg2, 1):
+        return arg1
+
+def safe_to_evaluate_early(node):
+    "Dividing by a variable that's 0 is only an error if the division would have run"
+    if isinstance(node, (Divide, Modulo)):
+        return isinstance(node.arg2, LiteralNumber) and node.arg2.value != 0
+    return True
+
+LOOPS = (DoRepeat, DoForever)
+
+def loop_scope(loop):
+    """Returns the nodes in loop that run each time round it, parents before
+    children, and the parent of each. Nested loops have already been optimized,
+    so their bodies and the values hoisted out of them are skipped."""
+    nodes = []
+    parents = []
+    stack = [(loop, None)]
+    while stack:
+        node, parent = stack.pop()
+        nodes.append(node)
+        parents.append(parent)
+        fields = node.fields
+        if not fields:
+            continue
+        kind = type(node)
+        if kind is LoopInvariants:
+            fields = ('loop',)
+        elif kind in LOOPS and node is not loop:
+            fields = [field for field in fields if field != 'block']
+        for field in reversed(fields):
+            value = getattr(node, field)
+            if type(value) is list:
+                stack.extend([(child, node) for child in reversed(value)])
+            else:
+                stack.append((value, node))
+    return nodes, parents
+
+def hoist_invariants(loop, context):
+    """Declares each expression in the loop that can't change while it runs before
+    it, and refers to the expression by name inside it. An expression can't change
+    if it only reads parameters and variables the loop doesn't set, and the loop
+    doesn't call a function or broadcast a message (which could set any variable).
+    Where scripts run as tasks, neither can it pause, since other tasks run meanwhile."""
+    # id of each loop optimized so far -> (variables it sets, whether it calls or broadcasts)
+    effects = context.analysis.setdefault("loop effects", {})
+    nodes, parents = loop_scope(loop)
+    writes = set()
+    tasks = context.scheduler == "cooperative"
+    # A task lets the others run each time round a forever loop (see TaskWriter)
+    opaque = tasks and type(loop) is DoForever
+    nested = []
+    operators = False
+    for node in nodes:
+        kind = type(node)
+        if node.fields is BinaryOperator.fields:
+            operators = True
+        elif kind is LoopInvariants:
+            nested.append(node)
+        elif kind is SetVar or kind is ChangeVarBy:
+            writes.add(node.var_name)
+        elif kind is Call or kind is Broadcast or (tasks and kind is Wait):
+            opaque = True
+        elif kind in LOOPS and node is not loop:
+            # A loop some other hook rewrote instead could set anything
+            nested_writes, nested_opaque = effects.get(id(node), (set(), True))
+            writes.update(nested_writes)
+            opaque = opaque or nested_opaque
+    effects[id(loop)] = (writes, opaque)
+    if not operators and not nested:
+        return None
+
+    # Values hoisted out of nested loops that can't change in this loop either
+    # move out of it too. The rest may still have parts that can't change.
+    hoisted = LoopInvariants(loop, context)
+    for invariants in nested:
+        kept = []
+        for declaration in zip(invariants.names, invariants.values, invariants.reads):
+            reads = declaration[2]
+            if not reads or (not opaque and reads.isdisjoint(writes)):
+                hoisted.declare(*declaration)
+            else:
+                kept.append(declaration)
+                value_nodes, value_parents = loop_scope(declaration[1])
+                value_parents[0] = invariants
+                nodes.extend(value_nodes)
+                parents.extend(value_parents)
+        invariants.names, invariants.values, invariants.reads = \
+                [list(field) for field in zip(*kept)] or ([], [], [])
+
+    # id of each invariant expression -> whether it reads a variable or parameter
+    invariant = {}
+    for node in reversed(nodes):
+        kind = type(node)
+        if kind is LiteralNumber:
+            invariant[id(node)] = False
+        elif kind is GetParam:
+            invariant[id(node)] = True
+        elif kind is ReadVar:
+            if not opaque and node.varName not in writes:
+                invariant[id(node)] = True
+        elif node.fields is BinaryOperator.fields and id(node.arg1) in invariant and \
+                id(node.arg2) in invariant and safe_to_evaluate_early(node):
+            invariant[id(node)] = invariant[id(node.arg1)] or invariant[id(node.arg2)]
+
+    # Hoist the largest expressions that can't change, leaving literals where they are
+    names = {}
+    replacements = {}
+    for node, parent in zip(nodes, parents):
+        if node.fields is BinaryOperator.fields and invariant.get(id(node)) and \
+                id(parent) not in invariant:
+            code = node.to_arduino()
+            if code not in names:
+                names[code] = context.unique_name("invariant")
+                hoisted.declare(names[code], node, set(part.varName
+                        for part in walk(node) if type(part) is ReadVar))
+            replacements.setdefault(parent, {})[id(node)] = \
+                    ArduinoExpression(names[code], context)
+    for parent, replaced in replacements.items():
+        parent.replace_children(replaced)
+    if hoisted.names:
+        return hoisted
+
+def add_optimizations(hooks):
+    "Registers the optimizations with a target's rewrite hooks"
+    hooks.register(BinaryOperator)(simplify)
+    hooks.register(DoRepeat)(hoist_invariants)
+    hooks.register(DoForever)(hoist_invariants)
@@ -0,0 +1,126 @@
+# Tells clients when a project's translation changes, so that a classroom of
+# students watching their projects doesn't mean a classroom of clients re-requesting
+# translations on a timer. One background thread polls every watched project at a
+# fixed interval, and waiting clients are woken only when the translation differs.
+
+import time
+import hashlib
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+def content_version(text):
+    "Returns a short version string identifying a translation's content"
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()[:16]
+
+class Watch(object):
+    def __init__(self, now):
+        self.version = None
+        self.subscribers = 0
+        self.last_seen = now
+        self.checked_at = None
+
+class ProjectWatcher(object):
+    """Polls watched projects every `interval` seconds with check(project_id),
+    which returns the current version of the project's translation. A project
+    stops being polled once nobody has waited on it for `idle_after` seconds."""
+
+    def __init__(self, check, interval=30, idle_after=None, pollers=8):
+        self.check = check
+        self.interval = interval
+        self.idle_after = idle_after or 2 * interval
+        self.pollers = pollers
+        self.watches = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = None
+        self.polls = 0
+        self.changes = 0
+        self.errors = 0
+
+    def wait(self, project_id, since=None, timeout=25):
+        """Returns the project's current version as soon as it differs from `since`,
+        or after `timeout` seconds if it doesn't change."""
+        watch = self.subscribe(project_id)
+        deadline = time.time() + timeout
+        try:
+            if watch.version is None:
+                self.poll(project_id)
+            with self.lock:
+                while watch.version == since:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.changed.wait(remaining)
+                return watch.version
+        finally:
+            self.unsubscribe(watch)
+
+    def subscribe(self, project_id):
+        with self.lock:
+            watch = self.watches.get(project_id)
+            if watch is None:
+                watch = self.watches[project_id] = Watch(time.time())
+            watch.subscribers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="project-watcher")
+                self.thread.daemon = True
+                self.thread.start()
+            return watch
+
+    def unsubscribe(self, watch):
+        with self.lock:
+            watch.subscribers -= 1
+            watch.last_seen = time.time()
+
+    def poll(self, project_id):
+        "Checks one project, waking its waiters if its translation changed"
+        try:
+            version = self.check(project_id)
+        except Exception:
+            log.exception("Could not check project %s", project_id)
+            with self.lock:
+                self.errors += 1
+            return
+        with self.lock:
+            self.polls += 1
+            watch = self.watches.get(project_id)
+            if watch is None:
+                return
+            watch.checked_at = time.time()
+            if version != watch.version:
+                if watch.version is not None:
+                    self.changes += 1
+                watch.version = version
+                self.changed.notify_all()
+
+    def due(self, now):
+        "Forgets idle watches and returns the IDs of the projects to poll"
+        with self.lock:
+            for project_id, watch in self.watches.items():
+                if not watch.subscribers and now - watch.last_seen > self.idle_after:
+                    del self.watches[project_id]
+            return [project_id for project_id, watch in self.watches.items()
+                    if watch.checked_at is None or now - watch.checked_at >= self.interval]
+
+    def run(self):
+        "Polls each watched project once it was last checked `interval` seconds ago"
+        pool = ThreadPool(self.pollers)
+        while True:
+            pool.map(self.poll, self.due(time.time()))
+            time.sleep(min(self.interval, 1))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "interval": self.interval,
+                "watched": len(self.watches),
+                "subscribers": sum(w.subscribers for w in self.watches.values()),
+                "polls": self.polls,
+                "changes": self.changes,
+                "errors": self.errors
+            }
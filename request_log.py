@@ -0,0 +1,151 @@
+# Logs every translation request to SQLite without slowing the request down. The
+# request thread only queues a reference to the project; a background thread hashes
+# and serializes it, stores each distinct project body once, and inserts request
+# rows pointing at it in batches.
+
+import time
+import json
+import Queue
+import sqlite3
+import logging
+import threading
+from translation_cache import project_hash
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    hash TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    first_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    project_id INTEGER,
+    project_hash TEXT NOT NULL REFERENCES projects (hash)
+);
+CREATE INDEX IF NOT EXISTS requests_by_project ON requests (project_id, time);
+"""
+
+# Queued to make the writer flush what it has and stop
+STOP = object()
+
+class RequestLog(object):
+    """Records (time, project ID, project JSON) for each request. Entries are
+    written in batches of up to batch_size, at least every flush_interval seconds.
+    If the writer falls behind by more than max_queue entries, new ones are dropped
+    rather than making requests wait."""
+
+    def __init__(self, path, batch_size=200, flush_interval=1.0, max_queue=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(max_queue)
+        self.stored = set()
+        self.last_hashed = {}
+        self.lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="request-log")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, project_id, project_json):
+        "Queues a request to be logged. Never blocks."
+        try:
+            self.queue.put_nowait((time.time(), project_id, project_json))
+        except Queue.Full:
+            self.drop(1)
+
+    def drop(self, count):
+        with self.lock:
+            self.dropped += count
+
+    def close(self):
+        "Writes everything queued so far, then stops the writer"
+        self.queue.put(STOP)
+        self.thread.join()
+
+    def connect(self):
+        db = sqlite3.connect(self.path)
+        db.executescript(SCHEMA)
+        return db
+
+    def run(self):
+        try:
+            db = self.connect()
+        except sqlite3.Error:
+            log.exception("Could not open request log %s", self.path)
+            db = None
+        while True:
+            batch = self.next_batch()
+            entries = [entry for entry in batch if entry is not STOP]
+            if db is None:
+                self.drop(len(entries))
+            elif entries:
+                try:
+                    self.write(db, entries)
+                except sqlite3.Error:
+                    log.exception("Could not write to request log %s", self.path)
+                    self.drop(len(entries))
+            if len(entries) < len(batch):
+                if db is not None:
+                    db.close()
+                return
+
+    def next_batch(self):
+        "Waits for an entry, then collects more until the batch is full or it is time to flush"
+        batch = [self.queue.get()]
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not STOP:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def write(self, db, entries):
+        projects = []
+        requests = []
+        new_keys = set()
+        for logged_at, project_id, project_json in entries:
+            key = self.hash_of(project_id, project_json)
+            if key not in self.stored and key not in new_keys:
+                projects.append((key, json.dumps(project_json), logged_at))
+                new_keys.add(key)
+            requests.append((logged_at, project_id, key))
+        with db:
+            db.executemany("INSERT OR IGNORE INTO projects (hash, body, first_seen) " +
+                    "VALUES (?, ?, ?)", projects)
+            db.executemany("INSERT INTO requests (time, project_id, project_hash) " +
+                    "VALUES (?, ?, ?)", requests)
+        if len(self.stored) > 100000:
+            self.stored.clear()
+        self.stored.update(new_keys)
+        with self.lock:
+            self.written += len(requests)
+
+    def hash_of(self, project_id, project_json):
+        """The fetcher hands out the same object for an unchanged project, so a
+        refresh of the same project is recognized without hashing it again."""
+        last = self.last_hashed.get(project_id)
+        if last is not None and last[0] is project_json:
+            return last[1]
+        key = project_hash(project_json)
+        if len(self.last_hashed) > 10000:
+            self.last_hashed.clear()
+        self.last_hashed[project_id] = (project_json, key)
+        return key
+
+    def stats(self):
+        with self.lock:
+            return {
+                "path": self.path,
+                "queued": self.queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped
+            }
@@ -0,0 +1,139 @@
+# Compiles scripts into tasks for the cooperative scheduler. delay() stops the
+# whole board while one script waits. A task instead returns to loop() when its
+# script waits, and carries on from the same place the next time it's called
+# once the wait is over, so other tasks (and the sensor) keep running meanwhile.
+#
+# A task is a protothread: a switch on the step it has reached, with a case label
+# after each place it returns from (see TASK_BEGIN in the template). Jumping into
+# the middle of a loop is legal C, but local variables don't keep their values
+# across a return, so repeat counters and hoisted loop invariants are static. A
+# static can't be declared with auto, so each invariant's type comes from the
+# storage plan.
+#
+# loop and each when I receive script are tasks. A helper function that can
+# pause becomes a task too, with a copy for each task that calls it (since its
+# state is static), and the caller steps it until it finishes (see TASK_CALL).
+# A function that calls itself can't be a task, and stops the board while it
+# waits, as it does without the scheduler.
+
+from scratch_blocks import *
+from optimizer import LoopInvariants
+
+SCHEDULERS = ["delay", "cooperative"]
+
+class TaskWriter(CodeWriter):
+    "Writes a script's code as the body of a task"
+
+    def __init__(self, indent=0, invariant_types=None, subtasks=None):
+        CodeWriter.__init__(self, indent)
+        self.steps = 0
+        self.statics = []
+        self.invariant_types = invariant_types or {}
+        # The task each function called here that can pause runs as, by the function's name
+        self.subtasks = subtasks or {}
+
+    def next_step(self):
+        self.steps += 1
+        return self.steps
+
+    def parts_of(self, node):
+        if isinstance(node, DoForever):
+            # Scratch lets other scripts run after each time round a forever loop
+            return ["while (true) {", INDENT, node.block,
+                    "TASK_YIELD({});".format(self.next_step()), DEDENT, "}"]
+        if isinstance(node, DoRepeat):
+            self.statics.append("static int {};".format(node.counter_name))
+            return ["for ({0} = 0; {0} < {1}; {0}++) {{".format(node.counter_name,
+                    node.repeats.to_arduino()), INDENT, node.block, DEDENT, "}"]
+        if isinstance(node, LoopInvariants):
+            parts = []
+            for name, value in zip(node.names, node.values):
+                code = value.to_arduino()
+                self.statics.append("static {} {};".format(
+                        self.invariant_types.get(name, "int"), name))
+                parts.append("{} = {};".format(name, code))
+            return parts + [node.loop]
+        return node.parts()
+
+    def line_of(self, node):
+        if isinstance(node, Wait):
+            # Parenthesized, since the duration may contain commas
+            return "TASK_WAIT({}, (({}) * 1000));".format(self.next_step(),
+                    node.duration.to_arduino())
+        if isinstance(node, Call) and node.function_name in self.subtasks:
+            args = ["task_start"] + [arg.to_arduino() for arg in node.args]
+            return "TASK_CALL({}, {}({}));".format(self.next_step(),
+                    self.subtasks[node.function_name], ", ".join(args))
+        return node.line()
+
+def task_code(script, name, invariant_types=None, subtasks=None, arg_c_types=None):
+    """Returns the code for a function, called name, that runs a script as a task.
+    The script may be a function or an event binding. invariant_types gives the
+    C type of each of its loop invariants, subtasks the tasks it calls (see
+    TaskWriter), and arg_c_types the C types of a function's parameters. The
+    task's first argument says whether to start it again; a function's
+    arguments follow, and are kept in statics while it runs."""
+    if isinstance(script, EventBinding):
+        block, arg_names = script.fn.block, []
+    else:
+        block, arg_names = script.block, script.arg_names
+    arg_c_types = arg_c_types or ["int"] * len(arg_names)
+    writer = TaskWriter(1, invariant_types, subtasks)
+    writer.emit(block)
+    indent = writer.indent_chars
+    params = ["bool start"] + ["{} {}_arg".format(c_type, arg)
+            for c_type, arg in zip(arg_c_types, arg_names)]
+    lines = ["bool {}({}) {{".format(name, ", ".join(params))]
+    lines.extend(indent + "static {} {};".format(c_type, arg)
+            for c_type, arg in zip(arg_c_types, arg_names))
+    lines.extend(indent + static for static in writer.statics)
+    lines.append(indent + "TASK_BEGIN(start)")
+    lines.extend(indent + "{0} = {0}_arg;".format(arg) for arg in arg_names)
+    lines.extend([writer.getvalue(), indent + "TASK_END", "}"])
+    return "\n".join(lines)
+
+def calls_in(script):
+    "The names of the functions script calls"
+    return set(node.function_name for node in walk(script) if isinstance(node, Call))
+
+def pausing_functions(functions):
+    """Returns the names of the functions (Function nodes, by name) that can pause
+    a task, and so run as tasks themselves: those that wait, run a forever loop,
+    or call a function that can pause. Functions that call themselves, directly
+    or not, are left out."""
+    calls = dict((name, calls_in(function) & set(functions))
+            for name, function in functions.items())
+    recursive = set(name for name in functions if name in called_by(name, calls))
+    pausing = set(name for name, function in functions.items() if name not in recursive and
+            any(isinstance(node, (Wait, DoForever)) for node in walk(function)))
+    changed = True
+    while changed:
+        changed = False
+        for name in functions:
+            if name not in pausing and name not in recursive and calls[name] & pausing:
+                pausing.add(name)
+                changed = True
+    return pausing
+
+def called_by(name, calls, among=None):
+    """The names of the functions that the function called name calls, directly
+    or through others, given what each calls. among, if given, limits the
+    functions followed."""
+    reached = set()
+    pending = list(calls.get(name, ()))
+    while pending:
+        callee = pending.pop()
+        if callee in reached or (among is not None and callee not in among):
+            continue
+        reached.add(callee)
+        pending.extend(calls.get(callee, ()))
+    return reached
+
+def subtask_names(script, task_name, functions, pausing):
+    """Maps each function that can pause, which the task running script calls
+    (directly or through others that can pause), to the name of its copy for
+    that task"""
+    calls = dict((name, calls_in(functions[name])) for name in pausing)
+    calls[None] = calls_in(script)
+    return dict((name, "{}_{}".format(name, task_name))
+            for name in called_by(None, calls, pausing))
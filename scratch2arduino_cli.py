@@ -0,0 +1,134 @@
+# Translates a directory of Scratch projects offline. Projects may be JSON files
+# or .sb2 archives (read in place, without extracting them). Sketches are written
+# as .ino files alongside a summary of timings and failures.
+
+from translator import *
+from metrics import metrics
+from multiprocessing import Pool, cpu_count
+import os
+import sys
+import json
+import time
+import zipfile
+import argparse
+
+PROJECT_EXTENSIONS = (".json", ".sb2")
+
+def find_projects(source_dir):
+    for directory, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(PROJECT_EXTENSIONS):
+                yield os.path.join(directory, filename)
+
+def translate_path(path, summary=None):
+    "Translates a .json file, or the project.json inside an .sb2, reading it incrementally"
+    if path.lower().endswith(".sb2"):
+        with zipfile.ZipFile(path) as archive:
+            with archive.open("project.json") as project_file:
+                return translate_project_file(project_file, summary)
+    with open(path, 'rb') as project_file:
+        return translate_project_file(project_file, summary)
+
+def sketch_path(path, source_dir, output_dir):
+    relative_path = os.path.relpath(path, source_dir)
+    return os.path.join(output_dir, os.path.splitext(relative_path)[0] + ".ino")
+
+def translate_file(paths):
+    "Runs in a worker process. Returns a summary of translating one project."
+    path, output_path = paths
+    result = {"source": path, "sketch": None, "error": None, "error_type": None}
+    start = time.time()
+    try:
+        sketch = to_sketch(translate_path(path, result))
+        output_dir = os.path.dirname(output_path)
+        if not os.path.isdir(output_dir):
+            try:
+                os.makedirs(output_dir)
+            except OSError:
+                pass
+        with open(output_path, 'w') as sketch_file:
+            sketch_file.write(sketch.encode('utf-8'))
+        result["sketch"] = output_path
+    except Exception as e:
+        result["error"] = str(e)
+        result["error_type"] = e.__class__.__name__
+    result["seconds"] = time.time() - start
+    if metrics.enabled:
+        result["metrics"] = metrics.drain()
+    return result
+
+def summarize(results, seconds):
+    translated = [r for r in results if not r["error"]]
+    timings = sorted(r["seconds"] for r in results)
+    return {
+        "projects": len(results),
+        "translated": len(translated),
+        "failed": len(results) - len(translated),
+        "seconds": seconds,
+        "mean_seconds": sum(timings) / len(timings) if timings else 0,
+        "max_seconds": timings[-1] if timings else 0,
+        "unsupported_blocks": [r for r in results if r["error_type"] == "BlockNotSupportedError"],
+        "other_errors": [r for r in results if r["error"] and
+                r["error_type"] != "BlockNotSupportedError"],
+        "results": results
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate a directory of Scratch " +
+            "projects (.json or .sb2) into Arduino sketches")
+    parser.add_argument("source", help="Directory of projects")
+    parser.add_argument("-o", "--output", default="sketches", help="Directory for .ino files")
+    parser.add_argument("-j", "--jobs", type=int, default=cpu_count(),
+            help="Worker processes (default: one per core)")
+    parser.add_argument("--summary", help="Where to write the JSON summary " +
+            "(default: OUTPUT/summary.json)")
+    parser.add_argument("--metrics", action="store_true",
+            help="Time each phase of translation and include the timings in the summary")
+    parser.add_argument("--trace-memory", type=float, default=0,
+            help="With --metrics, the fraction of phases whose peak memory is traced " +
+            "(needs tracemalloc)")
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default=scheduler,
+            help="How scripts wait: delay() stops the board, cooperative runs scripts as " +
+            "tasks that take turns (default from SCRATCH2ARDUINO_SCHEDULER, else delay)")
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable(args.trace_memory)
+    use_scheduler(args.scheduler)
+
+    jobs = [(path, sketch_path(path, args.source, args.output))
+            for path in find_projects(args.source)]
+    start = time.time()
+    # Compiles the template once, here, rather than in every worker
+    warm_up()
+    pool = Pool(args.jobs)
+    results = []
+    try:
+        for result in pool.imap_unordered(translate_file, jobs, chunksize=4):
+            if "metrics" in result:
+                metrics.merge(result.pop("metrics"))
+            results.append(result)
+            if result["error"]:
+                sys.stderr.write("FAILED {}: {}: {}\n".format(result["source"],
+                        result["error_type"], result["error"]))
+    finally:
+        pool.close()
+        pool.join()
+    summary = summarize(sorted(results, key=lambda r: r["source"]), time.time() - start)
+    if metrics.enabled:
+        summary["metrics"] = metrics.snapshot()
+        print(metrics.report())
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    summary_path = args.summary or os.path.join(args.output, "summary.json")
+    with open(summary_path, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print("Translated {} of {} projects in {:.1f}s ({} unsupported blocks, {} other errors)".format(
+            summary["translated"], summary["projects"], summary["seconds"],
+            len(summary["unsupported_blocks"]), len(summary["other_errors"])))
+    print("Summary written to {}".format(summary_path))
+    return 0 if not summary["failed"] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
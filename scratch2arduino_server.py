@@ -1,165 +1,318 @@
-# Note: log everything in sqlite!
-
-
-from flask import Flask
-from scratch_object import *
-import requests
+from flask import Flask, jsonify, request, Response, stream_with_context
+from translator import *
+from translation_cache import TranslationCache
+from fetcher import ProjectFetcher, NotFoundError, backend_from_environment
+from worker_pool import WorkerPool, PoolSaturatedError, WorkerError
+from multiprocessing.pool import ThreadPool
+from admission import SingleFlight, RateLimiter, ConcurrencyLimit, OverloadedError
+from project_watcher import ProjectWatcher, content_version
+from request_log import RequestLog
+from metrics import metrics
+import argparse
 import json
-from jinja2 import Environment, FileSystemLoader
-from os.path import dirname, realpath
+import os
 import traceback
+import time
 import logging
-import datetime
 
-log = logging.getLogger(__name__)
-handler = logging.FileHandler("/var/log/scratch2arduino.log")
-log.addHandler(handler)
-log.setLevel(logging.INFO)
+# Each request is logged with its project, stored once per distinct version.
+request_log = RequestLog(os.environ.get("SCRATCH2ARDUINO_LOG_DB", "/var/log/scratch2arduino.db"))
 
+app = Flask(__name__)
 
-class NotFoundError(Exception):
-    pass
+# Set SCRATCH2ARDUINO_CACHE_DIR to keep translations across restarts.
+translation_cache = TranslationCache(
+    max_entries=int(os.environ.get("SCRATCH2ARDUINO_CACHE_ENTRIES", 256)),
+    max_bytes=int(os.environ.get("SCRATCH2ARDUINO_CACHE_BYTES", 32 * 1024 * 1024)),
+    cache_dir=os.environ.get("SCRATCH2ARDUINO_CACHE_DIR")
+)
+fetcher = ProjectFetcher(backend_from_environment(),
+        ttl=float(os.environ.get("SCRATCH2ARDUINO_FETCH_TTL", 5)))
 
-env = Environment(loader=FileSystemLoader(dirname(realpath(__file__))))
-program_template = env.get_template("neopixel_template.html")
-base_template = env.get_template("base_template.html")
-landing_template = env.get_template("landing_template.html")
-app = Flask(__name__)
+# When set (see --workers), translations run in this pool instead of on the request thread.
+worker_pool = None
 
-excluded_vars = [
-"acceleration",
-  "colorOffset",
-  "isMoving",
-  "howManyLights",
-  "mainColor",
-  "mainColorValue",
-  "lightColor",
-  "myLightNumber",
-  "lightMode",
-  "secondColorValue",
-  "lightIndex",
-  "secondColor",
-  "ready",
-  "changeInAcceleration",
-  "speed"
-]
-
-excluded_scripts = [
-    "waitATick",
-    "setLightToRgb",
-    "findMainAndSecondColors",
-    "loop",
-    "setup",
-    "findColorOffset",
-    "turnOffLight",
-    "turnOnLight",
-    "setupLights",
-    "scaleColorValues",
-    "reset"
-]
-
-def include_script(script):
-    if not script.name:
-        return False
-    if script.name in excluded_scripts:
-        return False
-    if isinstance(script, EventBinding):
-        return False
-    return True
-
-def change_indent(code, spaces):
-    statements = code.split("\n")
-    if spaces > 0:
-        statements = [(" " * spaces) + s for s in statements]
-    else:
-        statements = [s[(spaces * -1):] for s in statements]
-    return "\n".join(statements)
-
-# We mocked reading the motion sensor with a variable. Time to undo that.
-motion_sensor = False
-unpatched_to_arduino = Equals.to_arduino
-def patched_to_arduino(self):
-    special_case = False
-    if (isinstance(self.arg1, ReadVar) and self.arg1.varName == "isMoving"):
-        special_case = True
-        val = self.arg2
-    if (isinstance(self.arg2, ReadVar) and self.arg2.varName == "isMoving"):
-        special_case = True
-        val = self.arg1
-    if special_case and isinstance(val, LiteralString):
-        if val.value == "YES":
-            return "motionSensor.moving()"
-        else:
-            return "!motionSensor.moving()"
-    else:
-        return unpatched_to_arduino(self)
-Equals.to_arduino = patched_to_arduino
-unpatched_init = Equals.__init__
-def patched_init(*args, **kwargs):
-    global motion_sensor
-    motion_sensor = True
-    unpatched_init(*args, **kwargs)
-Equals.__init__ = patched_init
-
-unpatched_rv_init = ReadVar.__init__
-def patched_rv_init(self, *args, **kwargs):
-    unpatched_rv_init(self, *args, **kwargs)
-    if self.varName == "acceleration":
-        global motion_sensor
-        motion_sensor = True
-ReadVar.__init__ = patched_rv_init
-unpatched_rv_to_arduino = ReadVar.to_arduino
-def patched_rv_to_arduino(self):
-    if self.varName == "acceleration":
-        return "motionSensor.intensity()"
-    else:
-        return unpatched_rv_to_arduino(self)
-ReadVar.to_arduino = patched_rv_to_arduino
-    
+# Concurrent requests for the same project share one fetch (by ID) and one 
+# translation (by content hash).
+fetches_in_flight = SingleFlight()
+translations_in_flight = SingleFlight()
+# A classroom often shares one address, so per-client limits are off unless --rate is given.
+rate_limiter = None
+concurrency_limit = ConcurrencyLimit(64)
 
 def get_scratch_project(scratch_id):
-    response = requests.get("http://cdn.projects.scratch.mit.edu/internalapi/project/{}/get/".format(scratch_id))
-    if response.ok:
-        return response.json()
-    elif response.status_code == 404:
-        raise NotFoundError("Invalid project ID")
-    else:
-        return 0
+    with metrics.phase("fetch"):
+        return fetches_in_flight.do(scratch_id, fetcher.get, scratch_id)
+
+def translation_version(scratch_id):
+    "The version of a project's current translation, for watchers"
+    return content_version(scratch_project_json_to_arduino(get_scratch_project(scratch_id)))
+
+# Watched projects are polled centrally, however many clients are watching them.
+watcher = ProjectWatcher(translation_version,
+        interval=float(os.environ.get("SCRATCH2ARDUINO_WATCH_INTERVAL", 30)))
     
+# The NeoPixel Base Simulation, which students remix
+BASE_PROJECT_ID = int(os.environ.get("SCRATCH2ARDUINO_BASE_PROJECT", 79412942))
+
+def warm_up_server():
+    """Gets a freshly started server ready, so its first translation is as quick
+    as any other: loads the templates and parses the base project. A pre-forking
+    server should call this in each worker, or once before it forks."""
+    try:
+        base_project_json = get_scratch_project(BASE_PROJECT_ID)
+    except Exception as e:
+        logging.warning("Could not fetch the base project to warm up with: %s", e)
+        base_project_json = None
+    warm_up(base_project_json)
+
 @app.route('/')
 def landing():
     try:
-        return landing_template.render()
+        return load_template("landing_template.html").render()
     except e: 
         return traceback.format_exc()
 
 def scratch_project_json_to_arduino(scratch_project):
-    project = ScratchObject(scratch_project)
-    init_vars = project.state_to_arduino(exclude=excluded_vars, indent=0)
-    setup = project.get_script("setup").block.to_arduino()
-    loop = project.get_script("loop").block.to_arduino()
-    helpers = "\n".join(s.to_arduino() for s in project.get_scripts() if include_script(s))
-    return program_template.render(
-        init_vars=init_vars, 
-        setup=setup, 
-        loop=loop, 
-        helpers=helpers, 
-        motion_sensor=motion_sensor
-    )
+    "Translates a project, reusing the cached sketch if the project is unchanged"
+    with metrics.phase("hash"):
+        key = translation_key(scratch_project)
+    with metrics.phase("translation"):
+        return translation_cache.get_or_translate(key, translations_in_flight.do, key,
+                run_translation, scratch_project)
+
+def run_translation(scratch_project):
+    if worker_pool and worker_pool.kind == "process" and metrics.enabled:
+        # Phases inside a worker process are recorded there, so bring them back.
+        program, worker_metrics = worker_pool.run(translate_project_reporting, scratch_project)
+        metrics.merge(worker_metrics)
+        return program
+    elif worker_pool:
+        return worker_pool.run(translate_project, scratch_project)
+    else:
+        return translate_project(scratch_project)
 
 @app.route('/translate/<int:scratch_id>')
 def translate(scratch_id):
+    if rate_limiter and not rate_limiter.allow(request.remote_addr):
+        return busy()
     try:
-        project_json = get_scratch_project(scratch_id)
-        program = scratch_project_json_to_arduino(project_json)
-        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log.info(json.dumps({"time": now, "project": project_json}))
-        return baes_template.render(
-            program=program,
-            project_id=scratch_id
-        )
+        with concurrency_limit:
+            project_json = get_scratch_project(scratch_id)
+            program = scratch_project_json_to_arduino(project_json)
+        request_log.record(scratch_id, project_json)
+        with metrics.phase("page"):
+            return load_template("base_template.html").render(
+                program=program,
+                project_id=scratch_id
+            )
+    except (PoolSaturatedError, OverloadedError):
+        return busy()
     except Exception, e:
         return "<h1>Something went wrong:</h1> <pre>{}</pre>".format(traceback.format_exc())
 
+@app.route('/sketch/<int:scratch_id>.ino')
+def sketch(scratch_id):
+    """Returns a project's sketch as plain Arduino code, ready to save as an .ino
+    file. It is translated just as for /translate: through the cache, the worker
+    pool and the same limits."""
+    if rate_limiter and not rate_limiter.allow(request.remote_addr):
+        return busy()
+    try:
+        with concurrency_limit:
+            project_json = get_scratch_project(scratch_id)
+            program = scratch_project_json_to_arduino(project_json)
+        request_log.record(scratch_id, project_json)
+    except NotFoundError:
+        return ("Invalid project ID", 404)
+    except (PoolSaturatedError, OverloadedError):
+        return busy()
+    except Exception:
+        return ("Something went wrong:\n\n" + traceback.format_exc(), 500,
+                {"Content-Type": "text/plain"})
+    return Response(to_sketch(program), mimetype="text/plain",
+            headers={"Content-Disposition": "attachment; filename={}.ino".format(scratch_id)})
+
+WATCH_TIMEOUT = 25
+
+@app.route('/watch/<int:scratch_id>')
+def watch(scratch_id):
+    """Tells a client when a project's translation changes. EventSource clients
+    get a stream of server-sent events; other clients long-poll, passing the
+    last version they saw as ?since= and getting a response once it changes."""
+    if rate_limiter and not rate_limiter.allow(request.remote_addr):
+        return busy()
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        return Response(stream_with_context(translation_events(scratch_id)),
+                mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    since = request.args.get("since")
+    version = watcher.wait(scratch_id, since, timeout=WATCH_TIMEOUT)
+    return jsonify(version_event(scratch_id, version, since))
+
+def translation_events(scratch_id):
+    version = None
+    while True:
+        latest = watcher.wait(scratch_id, version, timeout=WATCH_TIMEOUT)
+        if latest != version:
+            version = latest
+            yield "event: translation\ndata: {}\n\n".format(
+                    json.dumps(version_event(scratch_id, version)))
+        else:
+            # Keeps proxies from closing an idle connection
+            yield ": still watching\n\n"
+
+def version_event(scratch_id, version, since=None):
+    return {
+        "project_id": scratch_id,
+        "version": version,
+        "changed": version != since,
+        "translate_url": "/translate/{}".format(scratch_id),
+        "sketch_url": "/sketch/{}.ino".format(scratch_id)
+    }
+
+MAX_BATCH_SIZE = 200
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Translates a list of projects, given by ID or as inline project JSON:
+    {"projects": [79412942, {...}, ...]}. Results are streamed back as one JSON
+    object per line, in the order they finish, each with the index of its project."""
+    if rate_limiter and not rate_limiter.allow(request.remote_addr):
+        return busy()
+    projects = (request.get_json(force=True, silent=True) or {}).get("projects")
+    if not isinstance(projects, list) or len(projects) > MAX_BATCH_SIZE:
+        return ("Expected {{\"projects\": [...]}} with at most {} projects".format(
+                MAX_BATCH_SIZE), 400)
+    def stream_results():
+        if not projects:
+            return
+        workers = worker_pool.workers if worker_pool else 4
+        pool = ThreadPool(min(workers, len(projects)))
+        try:
+            for result in pool.imap_unordered(translate_batch_item, enumerate(projects)):
+                yield json.dumps(result) + "\n"
+        finally:
+            pool.terminate()
+    return Response(stream_with_context(stream_results()), mimetype="application/x-ndjson")
+
+def translate_batch_item(indexed_project):
+    index, project = indexed_project
+    result = {"index": index}
+    try:
+        # Under the same limit as /translate, so a batch can't take more than its share;
+        # items turned away are reported as errors, like any other failure
+        with concurrency_limit:
+            if isinstance(project, dict):
+                result["project_id"] = project.get('info', {}).get('projectID')
+                project_json = project
+            else:
+                result["project_id"] = int(project)
+                project_json = get_scratch_project(result["project_id"])
+            result["sketch"] = when_admitted(scratch_project_json_to_arduino, project_json)
+    except Exception as e:
+        if isinstance(e, WorkerError):
+            e = e.error
+        result["error"] = "{}: {}".format(e.__class__.__name__, e)
+    return result
+
+def when_admitted(fn, *args):
+    "Batch items wait their turn for a worker rather than being turned away"
+    deadline = time.time() + (worker_pool.timeout if worker_pool else 0)
+    while True:
+        try:
+            return fn(*args)
+        except PoolSaturatedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+def busy():
+    "A fast response telling the client to retry, rather than making it wait in line"
+    return ("<h1>The translator is busy.</h1> <p>Please try again in a moment.</p>", 503,
+            {"Retry-After": "1"})
+
+@app.route('/stats/cache')
+def cache_stats():
+    return jsonify(translation_cache.stats())
+
+@app.route('/stats/fetcher')
+def fetcher_stats():
+    return jsonify(fetcher.stats())
+
+@app.route('/stats/workers')
+def worker_stats():
+    return jsonify(worker_pool.stats() if worker_pool else {"kind": None})
+
+@app.route('/stats/admission')
+def admission_stats():
+    return jsonify(
+        fetches=fetches_in_flight.stats(),
+        translations=translations_in_flight.stats(),
+        rate_limit=rate_limiter.stats() if rate_limiter else None,
+        concurrency=concurrency_limit.stats()
+    )
+
+@app.route('/metrics')
+def metrics_text():
+    "Phase timings as Prometheus histograms; start the server with --metrics to record them"
+    return Response(metrics.prometheus(), mimetype="text/plain")
+
+@app.route('/stats/metrics')
+def metrics_stats():
+    return jsonify(metrics.snapshot())
+
+@app.route('/stats/log')
+def log_stats():
+    return jsonify(request_log.stats())
+
+@app.route('/stats/watcher')
+def watcher_stats():
+    return jsonify(watcher.stats())
+
 if __name__ == '__main__':        
-    app.run()
+    parser = argparse.ArgumentParser(description="Serve the scratch2arduino translator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=0, 
+            help="Serve requests concurrently, translating in a pool of this many workers")
+    parser.add_argument("--pool", choices=["thread", "process"], default="thread")
+    parser.add_argument("--max-pending", type=int, default=None,
+            help="Translations allowed to wait for a worker before requests are turned away")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--max-concurrent", type=int, default=64,
+            help="Requests handled at once before new ones are turned away")
+    parser.add_argument("--rate", type=float, default=None,
+            help="Requests per second allowed from each client address")
+    parser.add_argument("--burst", type=int, default=20,
+            help="Requests a client may make at once before --rate applies")
+    parser.add_argument("--metrics", action="store_true",
+            help="Time each phase of every request (see /metrics)")
+    parser.add_argument("--trace-memory", type=float, default=0,
+            help="With --metrics, the fraction of phases whose peak memory is traced " +
+            "(needs tracemalloc)")
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default=scheduler,
+            help="How scripts wait: delay() stops the board, cooperative runs scripts as " +
+            "tasks that take turns (default from SCRATCH2ARDUINO_SCHEDULER, else delay)")
+    parser.add_argument("--warm-up", action="store_true",
+            help="Load the templates and parse the base project before serving")
+    parser.add_argument("--compile-templates", metavar="DIR",
+            help="Compile the templates into DIR and exit, for SCRATCH2ARDUINO_COMPILED_TEMPLATES")
+    args = parser.parse_args()
+    if args.compile_templates:
+        compile_templates(args.compile_templates)
+        raise SystemExit
+    use_scheduler(args.scheduler)
+    if args.warm_up:
+        # Before the worker pool starts, so that worker processes begin warm
+        warm_up_server()
+    if args.metrics:
+        metrics.enable(args.trace_memory)
+    concurrency_limit = ConcurrencyLimit(args.max_concurrent)
+    if args.rate:
+        rate_limiter = RateLimiter(args.rate, args.burst)
+    if args.workers:
+        worker_pool = WorkerPool(args.workers, kind=args.pool, max_pending=args.max_pending,
+                timeout=args.timeout)
+        app.run(host=args.host, port=args.port, threaded=True)
+    else:
+        app.run(host=args.host, port=args.port)
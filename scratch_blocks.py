@@ -1,14 +1,37 @@
 import re
+import copy
 import json
-from random import randint
+import hashlib
+from collections import deque
 
 # Define: 
 #   blocks are sequences of statements that stick together.
 #   statements are represented by vertical levels in a script.
 #   expressions are within statements, and evaluate to a value.
 
+def script_hash(script_json):
+    """Identifies a script by its blocks, ignoring where it sits in the editor.
+    Blocks are made of lists, not objects, so unlike project_hash this doesn't
+    need sort_keys, which would keep json from using its C encoder."""
+    x, y, blocks_json = script_json
+    canonical = json.dumps(blocks_json, separators=(',', ':'))
+    if isinstance(canonical, unicode):
+        canonical = canonical.encode('utf-8')
+    return hashlib.sha1(canonical).hexdigest()
+
+CLEAN_NAMES = {}
+
 def clean_name(name):
     "Converts a name to a canonical CamelCase"
+    try:
+        return CLEAN_NAMES[name]
+    except KeyError:
+        if len(CLEAN_NAMES) > 10000:
+            CLEAN_NAMES.clear()
+        cleaned = CLEAN_NAMES[name] = convert_name(name)
+        return cleaned
+
+def convert_name(name):
     name = name.lower()
     name = re.sub('%n', '', name)
     name = name.strip()
@@ -21,11 +44,236 @@ def clean_name(name):
 class BlockNotSupportedError(Exception):
     pass
 
+class RewriteHooks(object):
+    """A registry of target-specific rewrites. A hook registered for a node class
+    is called with each node of that class (or a subclass) as soon as it has been
+    parsed, and may return a replacement node."""
+
+    def __init__(self):
+        self.hooks = {}
+        self.resolved = {}
+
+    def register(self, node_class):
+        "Decorator registering fn(node, context) -> replacement node or None"
+        def register_hook(fn):
+            self.hooks.setdefault(node_class, []).append(fn)
+            self.resolved = {}
+            return fn
+        return register_hook
+
+    def hooks_for(self, node_class):
+        try:
+            return self.resolved[node_class]
+        except KeyError:
+            hooks = []
+            for cls in node_class.__mro__:
+                hooks += self.hooks.get(cls, [])
+            self.resolved[node_class] = hooks
+            return hooks
+
+    def rewrite(self, node, context, hooks=None):
+        for hook in hooks or self.hooks_for(type(node)):
+            replacement = hook(node, context)
+            if replacement is not None:
+                return replacement
+        return node
+
+class TranslationContext(object):
+    """State belonging to a single translation. It is threaded through every node
+    as it is parsed, so that translations can run concurrently without sharing
+    anything. Rewrite hooks record the target features they use here."""
+
+    def __init__(self, hooks=None, scheduler="delay"):
+        self.hooks = hooks or RewriteHooks()
+        # How the sketch runs scripts that wait (see scheduler.py), which decides
+        # what rewrites may move past a wait
+        self.scheduler = scheduler
+        self.features = set()
+        self.pending = None
+        self.parsing = None
+        self.name_counts = {}
+        # How many times each script (by hash) has been added to the project so far
+        self.script_copies = {}
+        # Results of analyses done by rewrite hooks, by name
+        self.analysis = {}
+
+    def use(self, feature):
+        self.features.add(feature)
+
+    def uses(self, feature):
+        return feature in self.features
+
+    def rewrite(self, node):
+        return self.hooks.rewrite(node, self)
+
+    def unique_name(self, prefix):
+        """Returns prefix followed by a number not yet used with it in the tree being
+        built. Numbering starts again for each script, so a script's names depend
+        only on its blocks, and are the same whichever translation parsed it."""
+        count = self.name_counts.get(prefix, 0)
+        self.name_counts[prefix] = count + 1
+        return "{}_{}".format(prefix, count)
+
+    def build(self, node_class, node_json, **kwargs):
+        """Returns a node of node_class built from node_json. Nodes requested while
+        a tree is being built are allocated right away but parsed later, from a
+        worklist, so parsing never recurses however deeply the JSON is nested.
+        Once the whole tree is parsed, rewrite hooks are applied to it."""
+        node = node_class.__new__(node_class)
+        if self.pending is not None:
+            self.pending.append((node, node_json, kwargs, self.parsing))
+            return node
+        self.pending = deque([(node, node_json, kwargs, None)])
+        self.name_counts = {}
+        parsed = []
+        try:
+            while self.pending:
+                pending_node, pending_json, pending_kwargs, parent = self.pending.popleft()
+                self.parsing = pending_node
+                pending_node.__init__(pending_json, context=self, **pending_kwargs)
+                parsed.append((pending_node, parent))
+        finally:
+            self.pending = None
+            self.parsing = None
+        return self.rewrite_parsed(node, parsed)
+
+    def rewrite_parsed(self, root, parsed):
+        """Applies rewrite hooks to a list of (node, parent) in the order they were
+        parsed. Every node is parsed after its parent, so walking the list backwards
+        rewrites children before their parents. Most nodes have no hooks, so they
+        are skipped without a call."""
+        if not self.hooks.hooks:
+            return root
+        hooks_for = self.hooks.hooks_for
+        for node, parent in reversed(parsed):
+            hooks = hooks_for(type(node))
+            if not hooks:
+                continue
+            replacement = self.hooks.rewrite(node, self, hooks)
+            if replacement is not node:
+                if parent is None:
+                    root = replacement
+                else:
+                    parent.replace_children({id(node): replacement})
+        return root
+
+def walk(node):
+    "Yields node and every node nested in it, parents before children, without recursion"
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.fields:
+            children = list(node.children())
+            children.reverse()
+            stack.extend(children)
+
+def whole_copy(script, whole):
+    """Returns a copy of script in which the divisions whose ids are in whole
+    divide as ints. A parsed script is shared by versions of its project, whose
+    types may differ, so its own nodes are left as they are."""
+    contexts = dict((id(node.context), node.context) for node in walk(script))
+    copied = copy.deepcopy(script, contexts)
+    for original, node in zip(walk(script), walk(copied)):
+        if id(original) in whole:
+            node.whole = True
+    return copied
+
+# Markers in a compound node's parts, around code that is indented one level deeper
+INDENT = object()
+DEDENT = object()
+
+class CodeWriter(object):
+    """Collects generated code in a single buffer (or writes it straight to a
+    stream), one line at a time. The writer keeps track of indentation, so
+    nested blocks don't have to re-indent their children's code."""
+    indent_chars = " " * 2
+
+    def __init__(self, indent=0, stream=None):
+        self.level = indent
+        self.stream = stream
+        self.parts = []
+        self.write = stream.write if stream else self.parts.append
+        self.lines = 0
+
+    def emit(self, node):
+        """Writes a node and everything nested in it. Compound nodes are expanded
+        with an explicit stack rather than recursion, so nesting depth is unlimited."""
+        if not node.compound:
+            text = self.line_of(node)
+            if text is not None:
+                self.line(text)
+            return
+        stack = [(iter(self.parts_of(node)), self.lines if node.blank_if_empty else None)]
+        while stack:
+            parts, lines = stack[-1]
+            for part in parts:
+                if part is INDENT:
+                    self.level += 1
+                elif part is DEDENT:
+                    self.level -= 1
+                elif isinstance(part, basestring):
+                    self.line(part)
+                elif part.compound:
+                    stack.append((iter(self.parts_of(part)),
+                            self.lines if part.blank_if_empty else None))
+                    break
+                else:
+                    text = self.line_of(part)
+                    if text is not None:
+                        self.line(text)
+            else:
+                stack.pop()
+                if lines == self.lines:
+                    self.blank()
+
+    # Subclasses can generate different code for some nodes by overriding these
+    def parts_of(self, node):
+        return node.parts()
+
+    def line_of(self, node):
+        return node.line()
+
+    def line(self, text):
+        if self.lines:
+            self.write("\n")
+        self.write(self.indent_chars * self.level + text)
+        self.lines += 1
+
+    def blank(self):
+        if self.lines:
+            self.write("\n")
+        self.lines += 1
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+    def drain(self):
+        "Returns the code written since the last drain, and forgets it"
+        code = self.getvalue()
+        del self.parts[:]
+        return code
+
+def generate_arduino(nodes, indent=0):
+    "Generates the code for each node in turn, yielding it as soon as it is written"
+    writer = CodeWriter(indent)
+    for node in nodes:
+        node.emit(writer)
+        yield writer.drain()
+
 class ScratchRepresentation(object):
+    __slots__ = ('context',)
     arduino_rep = "(Representation of Scratch code)"
     indent=0
     indent_chars = " " * 2
-    def __init__(self, rep_json):
+    # Names of the attributes holding nested nodes (or lists of them)
+    fields = ()
+    # Compound nodes generate their code with parts(); the rest with line()
+    compound = False
+    # Whether to write a blank line in place of no code at all
+    blank_if_empty = False
+    def __init__(self, rep_json, context=None):
+        self.context = context or TranslationContext()
         self.parse(rep_json)
     def parse(self, rep_json):
         pass
@@ -34,15 +282,48 @@ class ScratchRepresentation(object):
     def __str__(self):
         return "<ScratchRepresentation>"
     def to_arduino(self):
-        return self.arduino_rep.format(*self.__dict__)
+        return self.arduino_rep
+    def children(self):
+        "Yields the nodes directly nested in this one"
+        for field in self.fields:
+            value = getattr(self, field)
+            if isinstance(value, list):
+                for item in value:
+                    yield item
+            else:
+                yield value
+    def replace_children(self, replacements):
+        "Swaps in replacements (keyed by the id of the node they replace) for direct children"
+        for field in self.fields:
+            value = getattr(self, field)
+            if isinstance(value, list):
+                value[:] = [replacements.get(id(item), item) for item in value]
+            else:
+                setattr(self, field, replacements.get(id(value), value))
+    def line(self):
+        "The one line of code for a node that isn't compound, or None for no code"
+        return self.to_arduino()
+    def parts(self):
+        "For compound nodes, a list of lines of code, nodes, and INDENT/DEDENT markers"
+        return []
+    def emit(self, writer):
+        "Writes this node's code into a CodeWriter"
+        writer.emit(self)
+    def emitted(self):
+        "Returns the code written by emit, starting at this node's indent level"
+        writer = CodeWriter(self.indent)
+        self.emit(writer)
+        return writer.getvalue()
     def indented(self, string):
         return "{}{}".format(self.indent_chars * self.indent, string)
 
 class ScratchScript(ScratchRepresentation):
+    __slots__ = ('indent', 'name')
 
-    def __init__(self, script_json, indent=0, namespace=None):
+    def __init__(self, script_json, indent=0, namespace=None, context=None):
         self.indent = indent
         self.name = None
+        self.context = context or TranslationContext()
         self.parse(script_json)
 
     def __str__(self):
@@ -54,11 +335,15 @@ class ScratchScript(ScratchRepresentation):
         pass
 
     def to_arduino(self):
-        return self.indented("(SCRIPT)")
+        return self.emitted()
+
+    def line(self):
+        return "(SCRIPT)"
         
     @classmethod
-    def instantiate(cls, script_json):
-        return cls.identify(script_json)(script_json)
+    def instantiate(cls, script_json, context=None):
+        context = context or TranslationContext()
+        return context.build(cls.identify(script_json), script_json)
 
     @classmethod
     def identify(cls, script_json):
@@ -71,42 +356,48 @@ class ScratchScript(ScratchRepresentation):
                     "Scripts of type {} are not supported".format(signature[0]))
 
 class NullScript(ScratchScript):
+    __slots__ = ()
     def to_arduino(self):
         "(NULL SCRIPT)"
 
+    def line(self):
+        return None
+
 class Function(ScratchScript):
+    __slots__ = ('arg_names', 'arg_types', 'block')
+    fields = ('block',)
+    compound = True
 
-    def __init__(self, script_json, indent=0, namespace=None, signature=None):
+    def __init__(self, script_json, indent=0, namespace=None, signature=None, context=None):
         self.indent = indent
-        if signature:
-            self.signature = signature
-        self.parse(script_json)
+        self.context = context or TranslationContext()
+        self.parse(script_json, signature)
 
     def __str__(self):
         return "<Function {}>".format(self.name)
 
-    def parse(self, script_json):
+    def parse(self, script_json, signature=None):
         x, y, block_json = script_json
-        if hasattr(self, "signature"):
-            self.name = self.signature['name']
-            self.arg_names = self.signature['arg_names']
-            self.arg_types = self.signature['arg_types']
+        if signature:
+            self.name = signature['name']
+            self.arg_names = signature['arg_names']
+            self.arg_types = signature['arg_types']
         else:
             signature_json = block_json[0]
             _, self.name, self.arg_names, self.arg_types, _ = signature_json
             self.name = clean_name(self.name)
             self.arg_names = [clean_name(arg) for arg in self.arg_names]
         description_json = block_json[1:]
-        self.block = ScratchCodeBlock(description_json, indent=self.indent + 1)
+        self.block = self.context.build(ScratchCodeBlock, description_json,
+                indent=self.indent + 1)
 
-    def to_arduino(self):
-        return "\n".join([
-            self.indented("void {} ({}) {{".format(self.name, self.args_to_arduino())),
-            self.block.to_arduino(),
-            self.indented("}")
-        ])
+    def parts(self, arg_c_types=None):
+        return ["void {} ({}) {{".format(self.name, self.args_to_arduino(arg_c_types)),
+                INDENT, self.block, DEDENT, "}"]
 
-    def args_to_arduino(self):
+    def args_to_arduino(self, arg_c_types=None):
+        """Declares the parameters, as ints unless arg_c_types gives their C types
+        (as inferred from what the function is called with)"""
         def arduino_type(symbol):
             if symbol == 1:
                 return "int"
@@ -116,18 +407,45 @@ class Function(ScratchScript):
         arduino_args = []
         for i, arg in enumerate(self.arg_names):
             arduino_args.append("{} {}".format(
-                arduino_type(self.arg_types[i]),
+                arg_c_types[i] if arg_c_types else arduino_type(self.arg_types[i]),
                 arg
             ))
         return ", ".join(arduino_args)
 
+class SignatureWriter(CodeWriter):
+    "Writes a function with its parameters declared in the given C types"
+
+    def __init__(self, function, arg_c_types, indent=0):
+        CodeWriter.__init__(self, indent)
+        self.function = function
+        self.arg_c_types = arg_c_types
+
+    def parts_of(self, node):
+        if node is self.function:
+            return node.parts(self.arg_c_types)
+        return node.parts()
+
 class EventBinding(ScratchScript):
+    """A script that runs when a message is broadcast. It becomes a function, which
+    the function generated for its message calls (see message_function)."""
+    __slots__ = ('event_name', 'fn_id', 'fn_name', 'fn')
+    fields = ('fn',)
+    compound = True
+
     def parse(self, script_json):
         x, y, block_json = script_json
         signature_json = block_json[0]
         self.get_fn_name(signature_json)
+        # Named after its blocks, so that an unchanged script keeps its name from one
+        # version to the next. Identical receivers are numbered in project order.
+        key = script_hash(script_json)
+        self.fn_id = key[:8]
+        copy = self.context.script_copies.get(key, 1) - 1
+        if copy:
+            self.fn_id = "{}_{}".format(self.fn_id, copy)
+        self.fn_name = "{}_function_{}".format(self.event_name, self.fn_id)
         self.name = "Event binding for {}".format(self.event_name)
-        self.fn = Function(script_json, indent=self.indent, signature={
+        self.fn = self.context.build(Function, script_json, indent=self.indent, signature={
             "name": self.fn_name,
             "arg_names": [],
             "arg_types": []
@@ -136,51 +454,58 @@ class EventBinding(ScratchScript):
     def get_fn_name(self, signature_json):
         identifier, self.event_name = signature_json
         self.event_name = clean_name(self.event_name)
-        self.fn_id = randint(0, 100000)
-        self.fn_name = "{}_function_{}".format(self.event_name, self.fn_id)
-        
-    def to_arduino(self):
-        return "\n".join([
-            self.fn.to_arduino(),
-            self.indented("dispatcher.bind({}, {});".format(self.event_name, self.fn_name))
-        ])
+
+    def parts(self):
+        return [self.fn]
 
     def __str__(self):
         return "<EventBinding {} -> {}>".format(self.event_name, self.fn_name)
 
 class GreenFlag(EventBinding):
+    __slots__ = ()
     def get_fn_name(self, signature_json):
         self.event_name = "green_flag"
-        self.fn_id = randint(0, 100000)
-        self.fn_name = "{}_function_{}".format(self.event_name, self.fn_id)
 
 class ScratchCodeBlock(ScratchRepresentation):
     "Represents a code block: a list of statements"
+    __slots__ = ('indent', 'statements')
+    fields = ('statements',)
+    compound = True
+    blank_if_empty = True
 
-    def __init__(self, code_block_json, indent=0):
+    def __init__(self, code_block_json, indent=0, context=None):
         self.indent = indent
-        self.statements = [ScratchStatement.instantiate(st, indent=self.indent) for st in code_block_json]
+        self.context = context or TranslationContext()
+        self.statements = [ScratchStatement.instantiate(st, indent=self.indent, context=self.context)
+                for st in code_block_json]
             
     def to_arduino(self):
-        statement_representations = [s.to_arduino() for s in self.statements]
-        statement_reps = filter(lambda x: x, statement_representations)
-        return "\n".join(statement_reps)
+        return self.emitted()
+
+    def parts(self):
+        return self.statements
 
 class ScratchStatement(ScratchRepresentation):
     "Represents one line in a Scratch script, including any nested blocks"
+    __slots__ = ('indent',)
     arduino_rep = "(STATEMENT)"
 
-    def __init__(self, statement_json, indent=0):
+    def __init__(self, statement_json, indent=0, context=None):
         self.indent = indent
+        self.context = context or TranslationContext()
         self.parse(statement_json)
 
     def to_arduino(self):
-        return self.indented(self.arduino_rep.format(*self.__dict__))
+        return self.emitted()
+
+    def line(self):
+        return self.arduino_rep
 
     @classmethod
-    def instantiate(cls, statement_json, indent=0):
+    def instantiate(cls, statement_json, indent=0, context=None):
         "Returns an instance of the appropriate class"
-        return cls.identify(statement_json)(statement_json, indent=indent)
+        context = context or TranslationContext()
+        return context.build(cls.identify(statement_json), statement_json, indent=indent)
 
     @classmethod
     def identify(cls, statement_json):
@@ -192,109 +517,124 @@ class ScratchStatement(ScratchRepresentation):
             raise BlockNotSupportedError("No statement matches {}".format(identifier))
 
 class SetVar(ScratchStatement):
+    __slots__ = ('var_name', 'set_value')
+    fields = ('set_value',)
+
     def parse(self, statement_json):
         self.var_name = clean_name(statement_json[1])
-        self.set_value = ScratchExpression.instantiate(statement_json[2])
-    def to_arduino(self):
-        return self.indented(
-            "{} = {};".format(self.var_name, self.set_value.to_arduino())
-        )
+        self.set_value = ScratchExpression.instantiate(statement_json[2], self.context)
+    def line(self):
+        return "{} = {};".format(self.var_name, self.set_value.to_arduino())
 
 class ChangeVarBy(ScratchStatement):
+    __slots__ = ('var_name', 'change_value')
+    fields = ('change_value',)
+
     def parse(self, statement_json):
         self.var_name = clean_name(statement_json[1])
-        self.change_value = ScratchExpression.instantiate(statement_json[2])
-    def to_arduino(self):
-        return self.indented(
-            "{} = {} + {};".format(self.var_name, self.var_name, self.change_value.to_arduino())
-        )
+        self.change_value = ScratchExpression.instantiate(statement_json[2], self.context)
+    def line(self):
+        return "{} = {} + {};".format(self.var_name, self.var_name,
+                self.change_value.to_arduino())
 
 class SetListItemValue(ScratchStatement):
+    __slots__ = ('index', 'array_name', 'value')
+    fields = ('index', 'value')
+
     def parse(self, statement_json):
-        self.index = ScratchExpression.instantiate(statement_json[1])
+        self.index = ScratchExpression.instantiate(statement_json[1], self.context)
         self.array_name = clean_name(statement_json[2])
-        self.value = ScratchExpression.instantiate(statement_json[3])
+        self.value = ScratchExpression.instantiate(statement_json[3], self.context)
 
-    def to_arduino(self):
-        return self.indented("{}[{}] = {};".format(self.array_name, 
-                self.index.to_arduino(), self.value.to_arduino()))
+    def line(self):
+        return "{}[{}] = {};".format(self.array_name,
+                integer_code(self.index, self.index.to_arduino()), self.value.to_arduino())
+
+def message_function(message):
+    """The name of the function that calls each script receiving message. Which
+    scripts those are is known when the project is translated, so a broadcast is
+    a plain function call rather than a lookup while the sketch runs."""
+    return "broadcast_{}".format(message)
 
 class Broadcast(ScratchStatement):
-    # TODO It will be necessary to provide a dispatcher!
+    __slots__ = ('broadcast_token',)
 
     def parse(self, statement_json):
         self.broadcast_token = clean_name(statement_json[1])
 
-    def to_arduino(self):
-        return  self.indented(
-            "dispatcher.broadcast({});".format(self.broadcast_token)
-        )
+    def line(self):
+        return "{}();".format(message_function(self.broadcast_token))
 
 class Wait(ScratchStatement):
+    __slots__ = ('duration',)
+    fields = ('duration',)
+
     def parse(self, statement_json):
-        self.duration = ScratchExpression.instantiate(statement_json[1])
-    def to_arduino(self):
-        return self.indented("delay(({}) * 1000);".format(self.duration.to_arduino()))
+        self.duration = ScratchExpression.instantiate(statement_json[1], self.context)
+    def line(self):
+        return "delay(({}) * 1000);".format(self.duration.to_arduino())
 
 
 class DoIf(ScratchStatement):
+    __slots__ = ('condition', 'block')
+    fields = ('condition', 'block')
+    compound = True
+
     def parse(self, statement_json):
-        self.condition = ScratchExpression.instantiate(statement_json[1])
-        self.block = ScratchCodeBlock(statement_json[2], indent=self.indent+1)
-    def to_arduino(self):
-        return "\n".join([
-            self.indented("if ({}) {{".format(self.condition.to_arduino())),
-            self.block.to_arduino(),
-            self.indented("}")
-        ])
+        self.condition = ScratchExpression.instantiate(statement_json[1], self.context)
+        self.block = self.context.build(ScratchCodeBlock, statement_json[2], indent=self.indent+1)
+    def parts(self):
+        return ["if ({}) {{".format(self.condition.to_arduino()), INDENT, self.block, DEDENT, "}"]
 
 class DoIfElse(ScratchStatement):
+    __slots__ = ('condition', 'if_block', 'else_block')
+    fields = ('condition', 'if_block', 'else_block')
+    compound = True
+
     def parse(self, statement_json):
-        self.condition = ScratchExpression.instantiate(statement_json[1])
-        self.if_block = ScratchCodeBlock(statement_json[2], indent=self.indent+1)
-        self.else_block = ScratchCodeBlock(statement_json[3], indent=self.indent+1)
-    def to_arduino(self):
-        return "\n".join([
-            self.indented("if ({}) {{".format(self.condition.to_arduino())),
-            self.if_block.to_arduino(),
-            self.indented("} else {"),
-            self.else_block.to_arduino(),
-            self.indented("}")
-        ])
+        self.condition = ScratchExpression.instantiate(statement_json[1], self.context)
+        self.if_block = self.context.build(ScratchCodeBlock, statement_json[2], indent=self.indent+1)
+        self.else_block = self.context.build(ScratchCodeBlock, statement_json[3], indent=self.indent+1)
+    def parts(self):
+        return ["if ({}) {{".format(self.condition.to_arduino()), INDENT, self.if_block, DEDENT,
+                "} else {", INDENT, self.else_block, DEDENT, "}"]
 
 class DoRepeat(ScratchStatement):
+    __slots__ = ('repeats', 'block', 'counter_name')
+    fields = ('repeats', 'block')
+    compound = True
+
     def parse(self, statement_json):
-        self.repeats = ScratchExpression.instantiate(statement_json[1])
-        self.block = ScratchCodeBlock(statement_json[2], indent=self.indent+1)
-        self.counter_name = "counter_{}".format(randint(0,100000))
+        self.repeats = ScratchExpression.instantiate(statement_json[1], self.context)
+        self.block = self.context.build(ScratchCodeBlock, statement_json[2], indent=self.indent+1)
+        self.counter_name = self.context.unique_name("counter")
 
-    def to_arduino(self):
-        return "\n".join([
-            self.indented("for (int {} = 0; {} < {}; {}++) {{".format(self.counter_name, 
-                    self.counter_name, self.repeats.to_arduino(), self.counter_name)),
-            self.block.to_arduino(),
-            self.indented("}")
-        ])
+    def parts(self):
+        return ["for (int {} = 0; {} < {}; {}++) {{".format(self.counter_name, 
+                self.counter_name, self.repeats.to_arduino(), self.counter_name),
+                INDENT, self.block, DEDENT, "}"]
 
 class DoForever(ScratchStatement):
+    __slots__ = ('block',)
+    fields = ('block',)
+    compound = True
+
     def parse(self, statement_json):
-        self.block = ScratchCodeBlock(statement_json[1], indent=self.indent+1)
-    def to_arduino(self):
-        return "\n".join([
-            self.indented("while (true) {"),
-            self.block.to_arduino(),
-            self.indented("}")
-        ])
+        self.block = self.context.build(ScratchCodeBlock, statement_json[1], indent=self.indent+1)
+    def parts(self):
+        return ["while (true) {", INDENT, self.block, DEDENT, "}"]
         
 class ScratchExpression(ScratchRepresentation):
     """ Represents an expression that evaluates to a number, string, or boolean. 
     In Scratch, these will be shaped as hexagons or rounded rectangles.    """
+    __slots__ = ()
 
     arduino_rep = "(EXPRESSION)"
 
     @classmethod
-    def instantiate(cls, exp_json):
-        return cls.identify(exp_json)(exp_json)
+    def instantiate(cls, exp_json, context=None):
+        context = context or TranslationContext()
+        return context.build(cls.identify(exp_json), exp_json)
 
     @classmethod
     def identify(cls, exp_json):
@@ -319,12 +659,14 @@ class Literal():
         return json.dumps(self.value)
 
 class LiteralString(ScratchExpression):
+    __slots__ = ('value',)
     def parse(self, value):
         self.value = value
     def to_arduino(self):
         return json.dumps(self.value)
 
 class LiteralNumber(ScratchExpression):
+    __slots__ = ('value',)
     def parse(self, value):
         if isinstance(value, (int, float)):
             self.value = value
@@ -337,44 +679,101 @@ class LiteralNumber(ScratchExpression):
         return json.dumps(self.value)
 
 class BinaryOperator(ScratchExpression):
+    __slots__ = ('arg1', 'arg2')
     operator = "(SYMBOL)"
+    fields = ('arg1', 'arg2')
+
     def parse(self, exp_json):
-        self.arg1 = ScratchExpression.instantiate(exp_json[1])
-        self.arg2 = ScratchExpression.instantiate(exp_json[2])
+        self.arg1 = ScratchExpression.instantiate(exp_json[1], self.context)
+        self.arg2 = ScratchExpression.instantiate(exp_json[2], self.context)
 
     def to_arduino(self):
-        return "({} {} {})".format(self.arg1.to_arduino(), self.operator, 
-                self.arg2.to_arduino())
+        """Formats the whole tree of operators under this one with an explicit stack,
+        so long chains of arithmetic don't recurse. Subclasses customize format()."""
+        arg1, arg2 = self.arg1, self.arg2
+        if not (isinstance(arg1, BinaryOperator) or isinstance(arg2, BinaryOperator)):
+            return self.format(arg1.to_arduino(), arg2.to_arduino())
+        values = []
+        stack = [(self, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                arg2 = values.pop()
+                values.append(node.format(values.pop(), arg2))
+            elif isinstance(node, BinaryOperator):
+                stack.append((node, True))
+                stack.append((node.arg2, False))
+                stack.append((node.arg1, False))
+            else:
+                values.append(node.to_arduino())
+        return values[0]
+
+    def format(self, arg1, arg2):
+        return "({} {} {})".format(arg1, self.operator, arg2)
 
 class Equals(BinaryOperator):
+    __slots__ = ()
     operator = "=="
 
 class Add(BinaryOperator):
+    __slots__ = ()
     operator = "+"
 
 class Subtract(BinaryOperator):
+    __slots__ = ()
     operator = "-"
 
 class Multiply(BinaryOperator):
+    __slots__ = ()
     operator = "*"
 
 class Divide(BinaryOperator):
+    """Divides as Scratch does, giving a fraction even when both numbers are whole,
+    unless type inference shows the division comes out whole (see whole_copy)"""
+    __slots__ = ('whole',)
     operator = "/"
 
+    def parse(self, exp_json):
+        self.whole = False
+        BinaryOperator.parse(self, exp_json)
+
+    def format(self, arg1, arg2):
+        if self.whole:
+            return "({} / {})".format(arg1, arg2)
+        return "({} / (float) {})".format(arg1, arg2)
+
+def integer_code(node, code):
+    """The code for node's value where C only takes an int, cutting a fraction to
+    a whole number as a cast does"""
+    if (type(node) is Divide and not node.whole) or \
+            (type(node) is LiteralNumber and isinstance(node.value, float)):
+        return "(int) " + code
+    return code
+
 class Modulo(BinaryOperator):
+    "The remainder of whole numbers: a fraction is cut to a whole number first"
+    __slots__ = ()
     operator = "%"
 
+    def format(self, arg1, arg2):
+        return "({} % {})".format(integer_code(self.arg1, arg1), integer_code(self.arg2, arg2))
+
 class GreaterThan(BinaryOperator):
+    __slots__ = ()
     operator = ">"
 
 class LessThan(BinaryOperator):
+    __slots__ = ()
     operator = "<"
 
 class And(BinaryOperator):
+    __slots__ = ()
     operator = "&&"
 
 class ReadVar(ScratchExpression):
-    def __init__(self, exp_json, namespace=None):
+    __slots__ = ('varName',)
+    def __init__(self, exp_json, namespace=None, context=None):
+        self.context = context or TranslationContext()
         self.varName = clean_name(exp_json[1])
         if namespace and self.varName not in namespace:
             raise ValueError("{} is not a variable in {}".format(
@@ -383,8 +782,18 @@ class ReadVar(ScratchExpression):
     def to_arduino(self):
         return self.varName
 
+class ArduinoExpression(ScratchExpression):
+    "An expression given directly as Arduino code, usually by a target's rewrite hook"
+    __slots__ = ('code',)
+    def parse(self, code):
+        self.code = code
+
+    def to_arduino(self):
+        return self.code
+
 class KeyPressed(ScratchExpression):
     "NOT REALLY SUPPORTED"
+    __slots__ = ('key',)
     def parse(self, exp_json):
         self.key = exp_json[1]
 
@@ -393,7 +802,9 @@ class KeyPressed(ScratchExpression):
         
 
 class GetParam(ScratchExpression):
-    def __init__(self, exp_json, namespace=None):
+    __slots__ = ('varName',)
+    def __init__(self, exp_json, namespace=None, context=None):
+        self.context = context or TranslationContext()
         self.varName = clean_name(exp_json[1])
         if namespace and self.varName not in namespace:
             raise ValueError("{} is not a parameter in {}".format(
@@ -403,6 +814,7 @@ class GetParam(ScratchExpression):
         return self.varName
 
 class RandomFromTo(ScratchExpression):
+    __slots__ = ('fromVal', 'toVal')
     def parse(self, exp_json):
         self.fromVal = exp_json[1]
         self.toVal = exp_json[2]
@@ -411,20 +823,36 @@ class RandomFromTo(ScratchExpression):
         return "random({}, {})".format(self.fromVal, self.toVal)
 
 class Call(ScratchStatement):
+    __slots__ = ('function_name', 'args')
+    fields = ('args',)
+
+    def __init__(self, statement_json=None, indent=0, context=None, function_name=None, args=()):
+        """Parses a call block, or, without statement_json, makes up a call to
+        function_name (named as it is in C) with args, for a target's rewrites"""
+        if statement_json is not None:
+            ScratchStatement.__init__(self, statement_json, indent, context)
+            return
+        self.indent = indent
+        self.context = context or TranslationContext()
+        self.function_name = function_name
+        self.args = list(args)
+
     def parse(self, statement_json):
         self.function_name = clean_name(statement_json[1])
-        self.args = [ScratchExpression.instantiate(arg) for arg in statement_json[2:]]
+        self.args = [ScratchExpression.instantiate(arg, self.context) for arg in statement_json[2:]]
 
-    def to_arduino(self):
+    def line(self):
         arduino_args = [arg.to_arduino() for arg in self.args]
-        return self.indented(
-                "{}({});".format(self.function_name, ", ".join(arduino_args))
-        )
+        return "{}({});".format(self.function_name, ", ".join(arduino_args))
 
 class NullStatement(ScratchStatement):
+    __slots__ = ()
     def to_arduino(self):
         return None
 
+    def line(self):
+        return None
+
 BLOCK_IDENTIFIERS = {
     # 'procDef'   : Function,
 #    '='         : OpEq,
@@ -3,34 +3,234 @@
 # Check for when a program's hash changes.
 
 from scratch_blocks import *
+from translation_cache import project_hash
+from storage_planner import plan_storage
+from type_inference import infer_types, ScriptSites
 
-TYPE_TRANSLATIONS = {
-    "int": "int",
-    "str": "String",
-    "unicode": "String",
-    "float": "float"
-}
+class ScriptTranslation(object):
+    """A parsed script, the target features it uses, and the code generated from
+    it so far. Unchanged scripts carry theirs over to a project's next version."""
+    __slots__ = ('key', 'node', 'features', 'code', 'references', 'sites')
+
+    def __init__(self, key, node, features):
+        self.key = key
+        self.node = node
+        self.features = features
+        self.code = {}
+        self.references = None
+        self.sites = None
+
+    def get_references(self):
+        """Returns what the script refers to: the functions it calls and the
+        messages it broadcasts"""
+        if self.references is None:
+            calls = set()
+            broadcasts = set()
+            for node in walk(self.node):
+                if isinstance(node, Call):
+                    calls.add(node.function_name)
+                elif isinstance(node, Broadcast):
+                    broadcasts.add(node.broadcast_token)
+            self.references = (calls, broadcasts)
+        return self.references
+
+    def get_sites(self):
+        """Returns the places the script gives variables, lists and parameters values,
+        and divides (see ScriptSites)"""
+        if self.sites is None:
+            self.sites = ScriptSites(self.node)
+        return self.sites
+
+class ProjectIndex(object):
+    """Everything in a project, gathered from the stage and its sprites at any
+    depth: scripts by name (and the hash of each), variables by the sprite that
+    owns them, which functions each script calls and which messages it
+    broadcasts, and where each script gives variables values and divides (see
+    type_inference)."""
+
+    def __init__(self, project):
+        self.scripts = []
+        self.scripts_by_name = {}
+        self.variables_by_owner = {}
+        self.calls = {}
+        self.broadcasts = {}
+        self.receivers = {}
+        self.script_keys = []
+        # The key, script and ScriptSites of each script
+        self.sites = []
+        objects = [project]
+        while objects:
+            obj = objects.pop(0)
+            objects.extend(obj.children)
+            self.variables_by_owner[obj.name] = obj.state
+            for script in obj.scripts:
+                self.add_script(script, obj.translations.get(id(script)))
+
+    def add_script(self, script, translation):
+        self.scripts.append(script)
+        if translation is None:
+            translation = ScriptTranslation(None, script, set())
+        self.script_keys.append(translation.key)
+        self.sites.append((translation.key, script, translation.get_sites()))
+        if script.name is None:
+            return
+        self.scripts_by_name.setdefault(script.name, script)
+        calls, broadcasts = translation.get_references()
+        self.calls.setdefault(script.name, set()).update(calls)
+        self.broadcasts.setdefault(script.name, set()).update(broadcasts)
+        if isinstance(script, EventBinding):
+            self.receivers.setdefault(script.event_name, []).append(script.name)
+
+    def reachable(self, roots, opaque=()):
+        """Returns the names of the scripts that roots call or broadcast to, directly
+        or not. Calls to scripts in opaque aren't followed."""
+        reached = set()
+        pending = [root for root in roots if root in self.scripts_by_name]
+        while pending:
+            name = pending.pop()
+            if name in reached or (name in opaque and name not in roots):
+                continue
+            reached.add(name)
+            pending.extend(callee for callee in self.calls.get(name, ())
+                    if callee in self.scripts_by_name)
+            for message in self.broadcasts.get(name, ()):
+                pending.extend(self.receivers.get(message, ()))
+        return reached
 
 class ScratchObject(object):
-    def __init__(self, object_json):
-        if object_json.get('info', {}).get('projectID'):
-            self.project_id = object_json.get('info').get('projectID')
-        else: 
-            self.project_id = None
-        self.name = object_json.get('objName')
+    """A sprite or stage and its scripts. Given the previous version of the same
+    project, scripts whose blocks are unchanged reuse its parsed nodes and
+    generated code rather than being translated again."""
+
+    def __init__(self, object_json=None, context=None, previous=None, reusable=None):
+        self.context = context or TranslationContext()
+        self.project_id = None
+        self.name = None
         self.state = {}
         self.scripts = []
         self.children = []
         self.translation_errors = []
-        for var in object_json.get('variables', []):
-            self.state[clean_name(var['name'])] = var['value']
-        for lis in object_json.get('lists', []):
-            self.state[clean_name(lis['listName'])] = lis['contents']
-        for script_json in object_json.get('scripts', []):
-            self.scripts.append(ScratchScript.instantiate(script_json))
-        for child_json in object_json.get('children', []):
-            if child_json.get('objName'):
-                self.children.append(ScratchObject(child_json))
+        self.translations = {}
+        self.project_index = None
+        self.state_translation = previous.state_translation if previous else None
+        # The parts of the project whose types were last inferred (see infer_types)
+        self.type_parts = previous.type_parts if previous else None
+        self.reusable = reusable
+        if reusable is None:
+            self.reusable = previous.reusable_translations() if previous else {}
+        if object_json is not None:
+            self.set_info(object_json.get('info', {}))
+            self.name = object_json.get('objName')
+            for var in object_json.get('variables', []):
+                self.add_variable(var)
+            for lis in object_json.get('lists', []):
+                self.add_list(lis)
+            for script_json in object_json.get('scripts', []):
+                self.add_script(script_json)
+            for child_json in object_json.get('children', []):
+                if child_json.get('objName'):
+                    self.children.append(ScratchObject(child_json, self.context,
+                            reusable=self.reusable))
+        if reusable is None:
+            # Let go of the previous version's scripts that weren't reused.
+            self.reusable.clear()
+
+    @classmethod
+    def from_stream(cls, stream, context=None):
+        """Builds a ScratchObject from a JSONStream positioned at an object, adding
+        variables, lists, scripts and children as they are read. Everything else
+        (costumes, sounds, ...) is skipped without being decoded."""
+        obj = cls(context=context)
+        for key in stream.keys():
+            if key == 'info':
+                obj.set_info(stream.value())
+            elif key == 'objName':
+                obj.name = stream.value()
+            elif key == 'variables':
+                for _ in stream.items():
+                    obj.add_variable(stream.value())
+            elif key == 'lists':
+                for _ in stream.items():
+                    obj.add_list(stream.value())
+            elif key == 'scripts':
+                for _ in stream.items():
+                    obj.add_script(stream.value())
+            elif key == 'children':
+                for _ in stream.items():
+                    if stream.peek() == '{':
+                        child = cls.from_stream(stream, obj.context)
+                        if child.name:
+                            obj.children.append(child)
+                    else:
+                        stream.skip()
+            else:
+                stream.skip()
+        return obj
+
+    def set_info(self, info_json):
+        if info_json.get('projectID'):
+            self.project_id = info_json.get('projectID')
+
+    def add_variable(self, var_json):
+        self.state[clean_name(var_json['name'])] = var_json['value']
+        self.project_index = None
+
+    def add_list(self, list_json):
+        self.state[clean_name(list_json['listName'])] = list_json['contents']
+        self.project_index = None
+
+    def add_script(self, script_json):
+        key = script_hash(script_json)
+        self.context.script_copies[key] = self.context.script_copies.get(key, 0) + 1
+        previous = self.reusable.get(key)
+        if previous:
+            translation = previous.pop(0)
+            for feature in translation.features:
+                self.context.use(feature)
+        else:
+            # Parse with an empty feature set, to learn which features this script uses.
+            features, self.context.features = self.context.features, set()
+            try:
+                node = ScratchScript.instantiate(script_json, self.context)
+            finally:
+                used, self.context.features = self.context.features, features
+            features.update(used)
+            translation = ScriptTranslation(key, node, used)
+        self.translations[id(translation.node)] = translation
+        self.scripts.append(translation.node)
+        self.project_index = None
+
+    def reusable_translations(self):
+        """Returns this object's (and its children's) script translations, by hash.
+        Identical scripts are listed in project order, as they are added."""
+        reusable = {}
+        for obj in [self] + self.children:
+            for script in obj.scripts:
+                translation = obj.translations[id(script)]
+                reusable.setdefault(translation.key, []).append(translation)
+        return reusable
+
+    def script_code(self, script, part=None, generate=None, whole=None):
+        """Returns the code for one of this object's scripts, or for one of its
+        fields (such as a function's block), generating it only the first time
+        it is asked for in any version of the project. generate, if given, makes
+        some other code from the script, and part names that code. whole holds
+        the ids of the script's divisions that come out whole (see whole_copy)."""
+        if generate is None:
+            generate = lambda script: (getattr(script, part) if part else script).emitted()
+        key = part
+        if whole:
+            key = (part, tuple(sorted(whole)))
+            generate_code = generate
+            generate = lambda script: generate_code(whole_copy(script, whole))
+        for obj in [self] + self.children:
+            translation = obj.translations.get(id(script))
+            if translation is not None:
+                code = translation.code.get(key)
+                if code is None:
+                    code = translation.code[key] = generate(script)
+                return code
+        return generate(script)
 
     def __str__(self):
         return "<ScratchObject {}>".format(self.name)
@@ -41,17 +241,17 @@ class ScratchObject(object):
     def is_a_project(self):
         return self.project_id is not None
 
+    def index(self):
+        "Returns the project's index, built the first time it is needed after loading"
+        if self.project_index is None:
+            self.project_index = ProjectIndex(self)
+        return self.project_index
+
     def get_script(self, script_name):
-        for script in self.get_scripts():
-            if script.name == script_name:
-                return script
+        return self.index().scripts_by_name.get(script_name)
 
     def get_scripts(self):
-        all_scripts = []
-        all_scripts += self.scripts
-        for child in self.children:
-            all_scripts += child.scripts
-        return all_scripts
+        return self.index().scripts
 
     def get_state(self):
         state = {}
@@ -60,34 +260,34 @@ class ScratchObject(object):
             state.update(child.get_state())
         return state
 
-    def state_to_arduino(self, exclude=None, include=None, indent=0):
-        translations = []
-        if not exclude:
-            exclude = []
-        for key, val in self.get_state().items():
-            if (key in exclude) or (include and (key not in include)):
-                continue
-            if isinstance(val, list):
-                type_sigs = list(set(type(i).__name__ for i in val))
-                if len(type_sigs) == 1:
-                    type_sig = type_sigs[0]
-                elif len(type_sigs) == 0:
-                    type_sig = 'int'
-                    self.warn("Could not infer type for empty list {}".format(key))
-                else:
-                    type_sig = type_sigs[0]
-                    self.warn("Not all items in list {} are of type {}".format(key, type_sig))
-
-                translations.append("{} {}[{}] = {{ {} }};".format(
-                    TYPE_TRANSLATIONS[type_sig], 
-                    clean_name(key), len(val), ", ".join(json.dumps(v) for v in val)
-                ))
-            else:
-                type_sig = type(val).__name__
-                translations.append("{} {} = {};".format(
-                    TYPE_TRANSLATIONS[type_sig], key, json.dumps(val)
-                ))
-        return "\n".join(" " * indent + t for t in translations)
+    def state_to_arduino(self, exclude=None, include=None, indent=0, reserved_sram=0):
+        "Declares the project's variables and lists"
+        plan = self.storage_plan(exclude, include, reserved_sram)
+        return "\n".join(" " * indent + d for d in plan.declarations())
+
+    def storage_plan(self, exclude=None, include=None, reserved_sram=0, functions=()):
+        """Plans how the project's variables and lists, and the parameters of
+        functions, are stored (see storage_planner), reusing the previous
+        version's plan if no script and no variable has changed.
+        Types are inferred from every script, including those left out of the sketch,
+        and from the initial values of all variables, declared or not. Only the
+        parts of the project that changed have their types inferred again."""
+        all_state = self.get_state()
+        state = dict((name, value) for name, value in all_state.items()
+                if name not in (exclude or []) and not (include and name not in include))
+        index = self.index()
+        key = project_hash([all_state, sorted(state), sorted(index.script_keys), reserved_sram,
+                [(function.name, function.arg_names) for function in functions]])
+        if self.state_translation and self.state_translation[0] == key:
+            plan = self.state_translation[1]
+        else:
+            types, self.type_parts = infer_types(index.sites, index.scripts_by_name, all_state,
+                    self.type_parts)
+            plan = plan_storage(state, types, reserved_sram, functions, index.sites)
+            self.state_translation = (key, plan)
+        for warning in plan.warnings:
+            self.warn(warning)
+        return plan
 
     def warn(self, warning):
         self.translation_errors.append(warning)
@@ -0,0 +1,205 @@
+# Decides how to declare a project's variables and lists so they fit on a small
+# board. An ATmega328 has 2 KB of SRAM, so every list is stored in the narrowest
+# integer type that holds its values, and lists the program never writes to are
+# kept in flash (PROGMEM) rather than copied into SRAM. The plan also adds up how
+# much of each memory the declarations use. What each variable and list holds is
+# worked out from the whole project by type_inference, and so is the type of each
+# function parameter.
+# Generated code never reads a list by index (Scratch's "item of list" isn't
+# supported yet); when it does, reads from PROGMEM lists will need pgm_read_*.
+
+import json
+from type_inference import FLOAT, TEXT, integer_values, number_value
+
+# The ATmega328 (Arduino Uno), less the bootloader's share of flash
+TARGET_SRAM = 2048
+TARGET_FLASH = 32256
+
+# Narrowest first: (type, smallest value, largest value, bytes)
+INTEGER_TYPES = [
+    ("uint8_t", 0, 255, 1),
+    ("int8_t", -128, 127, 1),
+    ("int16_t", -32768, 32767, 2),
+    ("long", -2 ** 31, 2 ** 31 - 1, 4),
+]
+
+# Bytes per value on AVR. A String is a pointer and two lengths, plus its text on the heap.
+TYPE_SIZES = {"int": 2, "float": 4, "String": 6}
+
+def narrowest_integer_type(values):
+    "Returns the narrowest (type, bytes) holding all of values, or None if none does"
+    low, high = min(values), max(values)
+    for c_type, smallest, largest, size in INTEGER_TYPES:
+        if smallest <= low and high <= largest:
+            return c_type, size
+    return None
+
+def integer_type(value_type):
+    """Returns (type, bytes) for whole numbers of value_type. Numbers without a
+    bound, such as a counter, are ints, as in the rest of the generated code."""
+    if value_type.bounded():
+        return narrowest_integer_type([value_type.low, value_type.high]) or ("long", 4)
+    return "int", TYPE_SIZES["int"]
+
+def text_value(value):
+    return value if isinstance(value, basestring) else json.dumps(value)
+
+class StorageDecision(object):
+    "How one variable or list is declared, and where it lives"
+
+    def __init__(self, name, c_type, size, values=None, value=None, section="sram",
+            const=False):
+        self.name = name
+        self.c_type = c_type
+        self.size = size
+        self.values = values
+        self.value = value
+        self.section = section
+        self.const = const
+
+    def declaration(self):
+        const = "const " if self.const else ""
+        if self.values is None:
+            return "{}{} {} = {};".format(const, self.c_type, self.name, json.dumps(self.value))
+        progmem = " PROGMEM" if self.section == "flash" else ""
+        return "{}{} {}[{}]{} = {{ {} }};".format(const, self.c_type, self.name,
+                len(self.values), progmem, ", ".join(json.dumps(v) for v in self.values))
+
+class StoragePlan(object):
+    def __init__(self, reserved_sram=0, sram=TARGET_SRAM, flash=TARGET_FLASH):
+        self.decisions = []
+        # The C type of each parameter of each function, by the function's name
+        self.parameters = {}
+        # The C type of each loop invariant, by the name of the function it's in
+        self.invariants = {}
+        # The ids of the divisions that come out whole, by the id of their script
+        self.whole_divisions = {}
+        self.warnings = []
+        # Why variables and lists that hold fractions or text aren't integers
+        self.promotions = []
+        self.reserved_sram = reserved_sram
+        self.sram = sram
+        self.flash = flash
+
+    def add(self, decision):
+        self.decisions.append(decision)
+
+    def sram_bytes(self):
+        return self.reserved_sram + sum(d.size for d in self.decisions if d.section == "sram")
+
+    def flash_bytes(self):
+        return sum(d.size for d in self.decisions if d.section == "flash")
+
+    def declarations(self):
+        return [d.declaration() for d in self.decisions]
+
+    def report(self):
+        "Summarizes the plan as lines of comments for the top of the sketch"
+        lines = ["MEMORY: variables and lists use {} of {} bytes of SRAM and {} bytes of flash.".format(
+                self.sram_bytes(), self.sram, self.flash_bytes())]
+        moved = [d.name for d in self.decisions if d.section == "flash" and d.values is not None]
+        if moved:
+            lines.append("These lists are never changed, so they are kept in flash (PROGMEM): " +
+                    ", ".join(moved))
+        lines.extend(self.promotions)
+        if self.sram_bytes() > self.sram * 3 // 4:
+            lines.append("WARNING: that leaves less than a quarter of SRAM for everything else. " +
+                    "The sketch may crash or behave strangely.")
+        return lines
+
+    def to_json(self):
+        return {
+            "sram_bytes": self.sram_bytes(),
+            "flash_bytes": self.flash_bytes(),
+            "sram": self.sram,
+            "flash": self.flash,
+            "promotions": self.promotions,
+            "parameters": self.parameters,
+            "variables": dict((d.name, {"type": d.c_type, "bytes": d.size,
+                    "section": d.section, "const": d.const}) for d in self.decisions)
+        }
+
+def plan_storage(state, types, reserved_sram=0, functions=(), scripts=()):
+    """Plans declarations for state, a dict of names to values (lists for lists),
+    and for the parameters of functions (Function nodes), given the TypeInference
+    for the project's scripts. The plan also says which divisions in scripts
+    (see TypeInference.whole_divisions) divide as ints."""
+    plan = StoragePlan(reserved_sram)
+    for name, value in state.items():
+        kind = "list" if isinstance(value, list) else "variable"
+        if kind == "list":
+            decision = plan_list(plan, name, value, types.list_items(name),
+                    types.written(kind, name))
+        else:
+            decision = plan_variable(name, value, types.variable(name), types.written(kind, name))
+        plan.add(decision)
+        reason = types.reason(kind, name)
+        if reason and decision.c_type == "float":
+            plan.promotions.append("FLOAT: {} holds fractions, since {}. ".format(name, reason) +
+                    "The board works them out in software, which is slow.")
+        elif reason and decision.c_type == "String":
+            plan.promotions.append("TEXT: {} holds text, since {}.".format(name, reason))
+    for function in functions:
+        plan.parameters[function.name] = c_types = []
+        for name in function.arg_names:
+            c_type = parameter_type(types.parameter(function.name, name))
+            c_types.append(c_type)
+            reason = types.parameter_reason(function.name, name)
+            if reason and c_type == "float":
+                plan.promotions.append("FLOAT: {} of {} holds fractions, since {}. ".format(
+                        name, function.name, reason) +
+                        "The board works them out in software, which is slow.")
+    for (function, name), value_type in types.invariants().items():
+        plan.invariants.setdefault(function, {})[name] = invariant_type(value_type)
+    plan.whole_divisions = types.whole_divisions(scripts)
+    return plan
+
+def parameter_type(value_type):
+    """Parameters are floats if they can hold fractions, and otherwise ints (or
+    longs, for bigger numbers). Text passed to one is taken to be a number."""
+    if value_type is None or value_type.kind == TEXT:
+        return "int"
+    if value_type.kind == FLOAT:
+        return "float"
+    c_type, size = integer_type(value_type)
+    return "long" if c_type == "long" else "int"
+
+def invariant_type(value_type):
+    "A loop invariant is a String if it holds text, and otherwise typed as a parameter"
+    if value_type is not None and value_type.kind == TEXT:
+        return "String"
+    return parameter_type(value_type)
+
+def plan_variable(name, value, value_type, written):
+    if value_type is None or value_type.kind == TEXT:
+        text = text_value(value)
+        return StorageDecision(name, "String", TYPE_SIZES["String"] + len(text) + 1, value=text)
+    if value_type.kind == FLOAT:
+        c_type, size = "float", TYPE_SIZES["float"]
+        value = number_value(value)
+    else:
+        c_type, size = integer_type(value_type)
+        value = int(number_value(value))
+    if written:
+        return StorageDecision(name, c_type, size, value=value)
+    # The compiler folds a constant number into the code that uses it.
+    return StorageDecision(name, c_type, 0, value=value, section="flash", const=True)
+
+def plan_list(plan, name, values, item_type, written):
+    if item_type is None:
+        plan.warnings.append("Could not infer type for empty list {}".format(name))
+        return StorageDecision(name, "int", 0, values=[])
+    if item_type.kind == TEXT:
+        values = [text_value(v) for v in values]
+        return StorageDecision(name, "String", sum(TYPE_SIZES["String"] + len(v) + 1
+                for v in values), values=values)
+    if item_type.kind == FLOAT:
+        c_type, size = "float", TYPE_SIZES["float"]
+        values = [number_value(v) for v in values]
+    else:
+        c_type, size = integer_type(item_type)
+        values = integer_values(values) or [int(number_value(v)) for v in values]
+    if written:
+        return StorageDecision(name, c_type, size * len(values), values=values)
+    return StorageDecision(name, c_type, size * len(values), values=values,
+            section="flash", const=True)
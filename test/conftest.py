@@ -0,0 +1,47 @@
+# Shared setup for the tests: puts the translator's modules on the path.
+#
+#     cd test && python -m pytest
+
+import os
+import sys
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+import json
+import pytest
+import translator
+from translator import *
+
+def scratch_project(scripts, variables=None, lists=None):
+    """Project JSON with the given scripts (each a list of blocks) in one sprite,
+    and the given variables and lists (dicts of names to values) on the stage"""
+    return {
+        "objName": "Stage",
+        "variables": [{"name": name, "value": value, "isPersistent": False}
+                for name, value in sorted((variables or {}).items())],
+        "lists": [{"listName": name, "contents": contents}
+                for name, contents in sorted((lists or {}).items())],
+        "children": [{"objName": "program",
+                "scripts": [[0, 0, script] for script in scripts]}]
+    }
+
+def procedure(name, *blocks):
+    return [["procDef", name, [], [], False]] + list(blocks)
+
+def translate(project_json, summary=None):
+    "Translates project JSON from scratch, without reusing any earlier translation"
+    project = ScratchObject(project_json, neopixel_target.new_context(translator.scheduler))
+    return to_sketch(render_project(project, summary))
+
+def load_json(name):
+    with open(os.path.join(TEST_DIR, name)) as json_file:
+        return json.load(json_file)
+
+@pytest.fixture
+def cooperative():
+    "Translates with the cooperative scheduler for the length of a test"
+    previous = translator.scheduler
+    use_scheduler("cooperative")
+    yield
+    use_scheduler(previous)
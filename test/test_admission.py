@@ -0,0 +1,81 @@
+# Admission control: concurrent identical calls share one result, each client
+# has a token bucket, and requests beyond the concurrency limit are shed.
+
+import time
+import threading
+import pytest
+import admission
+from admission import *
+
+def test_concurrent_calls_share_one_result():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+    def translate(project):
+        calls.append(project)
+        started.set()
+        release.wait(5)
+        return "sketch of " + project
+    results = []
+    def request():
+        results.append(flights.do("key", translate, "p"))
+    leader = threading.Thread(target=request)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=request) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while flights.stats()["shared"] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert calls == ["p"]
+    assert results == ["sketch of p"] * 4
+    assert flights.stats() == {"in_flight": 0, "calls": 1, "shared": 3}
+
+def test_errors_are_raised_in_every_caller_and_not_kept():
+    flights = SingleFlight()
+    def fail():
+        raise ValueError("bad project")
+    with pytest.raises(ValueError):
+        flights.do("key", fail)
+    assert flights.do("key", lambda: "fine") == "fine"
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+def test_each_client_gets_a_burst_then_the_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission, "time", clock)
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.allow("a") for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow("b")
+    clock.now += 0.5
+    assert limiter.allow("a")
+    assert not limiter.allow("a")
+    assert limiter.stats()["limited"] == 2
+
+def test_idle_clients_are_forgotten(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission, "time", clock)
+    limiter = RateLimiter(rate=1, burst=1, max_clients=2)
+    limiter.allow("a")
+    limiter.allow("b")
+    clock.now += 10
+    limiter.allow("c")
+    assert sorted(limiter.buckets) == ["c"]
+
+def test_requests_beyond_the_limit_are_shed():
+    limit = ConcurrencyLimit(2)
+    with limit:
+        with limit:
+            with pytest.raises(OverloadedError):
+                with limit:
+                    pass
+            assert limit.stats()["active"] == 2
+    assert limit.stats() == {"max_concurrent": 2, "active": 0, "shed": 1}
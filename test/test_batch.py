@@ -0,0 +1,39 @@
+# The /batch endpoint: inline projects are translated, and each item is
+# admitted under the server's concurrency limit.
+
+import os
+import json
+import tempfile
+import pytest
+
+os.environ.setdefault("SCRATCH2ARDUINO_LOG_DB", os.path.join(tempfile.mkdtemp(), "log.db"))
+import scratch2arduino_server as server
+from admission import ConcurrencyLimit
+
+PROJECT = {"objName": "Stage", "variables": [], "lists": [], "children": [
+    {"objName": "program", "scripts": [
+        [0, 0, [["procDef", "setup", [], [], False]]],
+        [0, 0, [["procDef", "loop", [], [], False], ["call", "Turn on light %n", 1]]]]}]}
+
+def post_batch(projects):
+    response = server.app.test_client().post("/batch", data=json.dumps({"projects": projects}))
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.get_data().splitlines()]
+    return sorted(results, key=lambda result: result["index"])
+
+def test_translates_inline_projects():
+    results = post_batch([PROJECT, PROJECT])
+    assert [result["index"] for result in results] == [0, 1]
+    assert all("turnOnLight(1);" in result["sketch"] for result in results)
+
+def test_items_beyond_the_concurrency_limit_are_errors(monkeypatch):
+    limit = ConcurrencyLimit(1)
+    monkeypatch.setattr(server, "concurrency_limit", limit)
+    with limit:
+        results = post_batch([PROJECT, PROJECT])
+    assert [result["error"].split(":")[0] for result in results] == ["OverloadedError"] * 2
+    assert limit.stats()["shed"] == 2
+
+def test_rejects_a_malformed_batch():
+    response = server.app.test_client().post("/batch", data=json.dumps({"projects": 3}))
+    assert response.status_code == 400
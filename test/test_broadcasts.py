@@ -0,0 +1,67 @@
+# When-I-receive scripts: how they are named, which are kept, and how a
+# broadcast runs them, one after the other or as tasks.
+
+import re
+from conftest import scratch_project, procedure, translate
+
+RECEIVER = [["whenIReceive", "go"], ["call", "Blink %n", 1], ["call", "Other"]]
+
+def sketch(*loop):
+    return translate(scratch_project([
+        procedure("setup"),
+        procedure("loop", *loop),
+        [["procDef", "Blink %n", ["times"], [1], False],
+                ["wait:elapsed:from:", ["getParam", "times", "r"]]],
+        procedure("Other", ["changeVar:by:", "x", 1]),
+        RECEIVER,
+        RECEIVER,
+        [["whenIReceive", "stop"], ["call", "Other"]],
+    ], {"x": 0}))
+
+def receiver_names(code):
+    return re.findall(r"^void (go_function_[0-9a-f]{8}(?:_\d+)?) \(\) \{$", code, re.M)
+
+def function_body(code, signature):
+    start = code.index(signature + " {\n") + len(signature) + 3
+    return code[start:code.index("\n}\n", start)].split("\n")
+
+def test_identical_receivers_are_numbered():
+    code = sketch(["broadcast:", "go"])
+    first, second = receiver_names(code)
+    assert second == first + "_1"
+    assert function_body(code, "void broadcast_go()") == ["  {}();".format(first),
+            "  {}();".format(second)]
+
+def test_names_do_not_change_between_translations():
+    assert receiver_names(sketch(["broadcast:", "go"])) == \
+            receiver_names(sketch(["broadcast:", "go"], ["changeVar:by:", "x", 2]))
+
+def test_messages_never_broadcast_are_left_out():
+    code = sketch(["broadcast:", "go"])
+    assert "stop" not in code
+    assert "go_function" not in sketch(["call", "Other"])
+
+def test_receivers_run_as_tasks(cooperative):
+    code = sketch(["call", "Blink %n", 2], ["broadcast:", "go"])
+    first, second = re.findall(r"^bool (go_function_[0-9a-f]{8}(?:_\d+)?)\(bool start\)",
+            code, re.M)
+    assert second == first + "_1"
+    assert function_body(code, "void loop()") == ["  loop_task(false);",
+            "  TASK_STEP({});".format(first), "  TASK_STEP({});".format(second)]
+    assert function_body(code, "void broadcast_go()") == ["  {}_start = true;".format(first),
+            "  {}_start = true;".format(second)]
+    # Each task gets its own copy of a helper that waits, so they can wait at once
+    assert function_body(code, "bool loop_task(bool start)") == ["  TASK_BEGIN(start)",
+            "  TASK_CALL(1, blink_loop_task(task_start, 2));", "  broadcast_go();",
+            "  TASK_END"]
+    assert "  TASK_CALL(1, blink_{}(task_start, 1));".format(first) in \
+            function_body(code, "bool {}(bool start)".format(first))
+    assert function_body(code, "bool blink_loop_task(bool start, int times_arg)") == [
+        "  static int times;",
+        "  TASK_BEGIN(start)",
+        "  times = times_arg;",
+        "  TASK_WAIT(1, ((times) * 1000));",
+        "  TASK_END"]
+    # Helpers that don't wait are called as usual
+    assert "void other () {" in code
+    assert "void blink (" not in code
@@ -0,0 +1,67 @@
+# The estimated cost of a pass through loop(), the hot spots found, and how
+# waits are counted when scripts run as tasks.
+
+from conftest import scratch_project, procedure, translate
+from cost_model import SHOW_MICROSECONDS, FLOAT_OP_MICROSECONDS, format_duration
+
+def estimate(*blocks):
+    summary = {}
+    translate(scratch_project([
+        procedure("setup"),
+        procedure("loop", *blocks),
+        procedure("Pause", ["wait:elapsed:from:", 0.25], ["call", "Turn on light %n", 1]),
+        [["whenIReceive", "go"], ["wait:elapsed:from:", 2]],
+    ], {"speed": 1, "x": 0}), summary)
+    return summary["estimate"]
+
+def test_waits_add_up():
+    loop = estimate(["wait:elapsed:from:", 1], ["wait:elapsed:from:", 0.5])["loop"]
+    assert loop["wait_ms"] == 1500
+    assert loop["ms"] == 1500
+    assert not loop["never_ends"]
+
+def test_repeats_multiply_their_cost():
+    result = estimate(["doRepeat", 10, [["wait:elapsed:from:", 0.1],
+            ["call", "Turn on light %n", 1]]])
+    assert result["loop"]["wait_ms"] == 1000
+    assert result["loop"]["shows"] == 10
+    assert result["loop_ms"] == 1000 + 10 * SHOW_MICROSECONDS / 1000.0
+    assert result["hot_spots"] == [
+        "in loop, a repeat loop calls lights.show() 10 times. Set all the lights, then show them once.",
+        "in loop, a repeat loop waits 1.0 s in all."]
+
+def test_float_operations_and_unknown_waits():
+    loop = estimate(["changeVar:by:", "speed", 1],
+            ["wait:elapsed:from:", ["/", 5, ["readVariable", "speed"]]],
+            ["setVar:to:", "x", ["*", 2, ["/", ["readVariable", "speed"], 3]]])["loop"]
+    assert loop["unknown_waits"] == 1
+    assert loop["wait_ms"] == 0
+    # Both divisions, and multiplying the fraction one gives
+    assert loop["float_ops"] == 3
+    assert loop["ms"] == 3 * FLOAT_OP_MICROSECONDS / 1000.0
+
+def test_calls_and_broadcasts_count_what_they_run():
+    loop = estimate(["call", "Pause"], ["call", "Pause"], ["broadcast:", "go"])["loop"]
+    assert loop["wait_ms"] == 2500
+    assert loop["shows"] == 2
+
+def test_forever_never_ends():
+    assert estimate(["doForever", [["call", "Turn on light %n", 1]]])["loop"]["never_ends"]
+
+def test_waits_in_tasks_leave_loop_running(cooperative):
+    result = estimate(["wait:elapsed:from:", 1], ["call", "Pause"], ["broadcast:", "go"])
+    assert result["loop"]["wait_ms"] == 0
+    assert result["loop"]["task_wait_ms"] == 3250
+    assert result["loop_ms"] == SHOW_MICROSECONDS / 1000.0
+
+def test_sizes():
+    result = estimate()
+    assert result["sram_bytes"] > 0
+    assert estimate(["doRepeat", 10, [["call", "Turn on light %n", 1]]])["flash_bytes"] > \
+            result["flash_bytes"]
+
+def test_durations():
+    assert format_duration(30) == "30 us"
+    assert format_duration(2500) == "2.5 ms"
+    assert format_duration(1500000) == "1.5 s"
+    assert format_duration(2 * 86400 * 1000000) == "more than a day"
@@ -0,0 +1,110 @@
+# The project fetcher: fresh responses come from memory, stale ones are
+# revalidated with their ETag, and only changed projects are downloaded again.
+
+import json
+import threading
+import pytest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from fetcher import *
+
+class ProjectServer(HTTPServer):
+    "Serves one project, answering 304 to a request with its current ETag"
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), ProjectHandler)
+        self.project = {"objName": "Stage"}
+        self.etag = '"v1"'
+        self.requests = []
+
+class ProjectHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get("If-None-Match")))
+        if "/404/" in self.path:
+            self.send_response(404)
+            self.end_headers()
+        elif self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            body = json.dumps(server.project)
+            self.send_response(200)
+            self.send_header("ETag", server.etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ProjectServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def http_fetcher(server):
+    url = "http://127.0.0.1:{}/project/{{}}/get/".format(server.server_port)
+    return ProjectFetcher(HTTPBackend(url), ttl=0)
+
+def test_revalidates_with_the_etag(server):
+    fetcher = http_fetcher(server)
+    assert fetcher.get(1) == {"objName": "Stage"}
+    assert fetcher.get(1) == {"objName": "Stage"}
+    assert server.requests == [("/project/1/get/", None), ("/project/1/get/", '"v1"')]
+    assert fetcher.stats()["downloads"] == 1
+    assert fetcher.stats()["revalidations"] == 1
+
+def test_downloads_a_changed_project_again(server):
+    fetcher = http_fetcher(server)
+    fetcher.get(1)
+    server.project, server.etag = {"objName": "Changed"}, '"v2"'
+    assert fetcher.get(1) == {"objName": "Changed"}
+    assert fetcher.stats()["downloads"] == 2
+
+def test_missing_projects(server):
+    with pytest.raises(NotFoundError):
+        http_fetcher(server).get(404)
+
+class CountingBackend(object):
+    def __init__(self):
+        self.fetches = 0
+
+    def fetch(self, scratch_id, etag=None, last_modified=None):
+        self.fetches += 1
+        return FetchResult(body=json.dumps({"id": scratch_id}), etag="e")
+
+def test_fresh_responses_come_from_memory():
+    backend = CountingBackend()
+    fetcher = ProjectFetcher(backend, ttl=60)
+    assert fetcher.get(7) == fetcher.get("7") == {"id": "7"}
+    assert backend.fetches == 1
+    fetcher.invalidate(7)
+    fetcher.get(7)
+    assert backend.fetches == 2
+
+def test_oldest_projects_are_dropped():
+    fetcher = ProjectFetcher(CountingBackend(), ttl=60, max_entries=2)
+    for scratch_id in (1, 2, 1, 3):
+        fetcher.get(scratch_id)
+    assert list(fetcher.entries) == ["1", "3"]
+
+def test_directory_backend_revalidates_by_mtime(tmpdir):
+    tmpdir.join("5.json").write(json.dumps({"objName": "Stage"}))
+    backend = DirectoryBackend(str(tmpdir))
+    first = backend.fetch(5)
+    assert json.loads(first.body) == {"objName": "Stage"}
+    assert backend.fetch(5, last_modified=first.last_modified).not_modified
+    with pytest.raises(NotFoundError):
+        backend.fetch(6)
+
+def test_invalid_json():
+    class Garbage(object):
+        def fetch(self, scratch_id, etag=None, last_modified=None):
+            return FetchResult(body="{not json")
+    with pytest.raises(FetchError):
+        ProjectFetcher(Garbage()).get(1)
@@ -0,0 +1,78 @@
+# JSONStream reads the same values json.loads would, however the input is split
+# into chunks: values, strings and UTF-8 characters can all span a boundary.
+
+import io
+import json
+import pytest
+from json_stream import JSONStream
+from scratch_object import ScratchObject
+import neopixel_target
+
+DOCUMENT = {
+    "name": u"caf\xe9 \u2603 \"quoted\" [brackets] {braces}",
+    "numbers": [0, -12345, 3.25, 1e10, True, False, None],
+    "nested": {"list": [[1, [2, [3]]], {"a": "b,c"}], "empty": {}, "none": []},
+    "long": list(range(200)),
+}
+
+def stream(document, chunk_size):
+    return JSONStream(io.BytesIO(json.dumps(document, ensure_ascii=False).encode('utf-8')),
+            chunk_size)
+
+def read(stream):
+    "Decodes the value starting here by walking it, as ScratchObject does"
+    char = stream.peek()
+    if char == '{':
+        return dict((key, read(stream)) for key in stream.keys())
+    if char == '[':
+        return [read(stream) for _ in stream.items()]
+    return stream.value()
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64, 64 * 1024])
+def test_walking_gives_what_json_loads_does(chunk_size):
+    assert read(stream(DOCUMENT, chunk_size)) == DOCUMENT
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 64 * 1024])
+def test_value_decodes_whole_subtrees(chunk_size):
+    json_stream = stream(DOCUMENT, chunk_size)
+    found = {}
+    for key in json_stream.keys():
+        if key == "long":
+            json_stream.skip()
+        else:
+            found[key] = json_stream.value()
+    assert found == dict((key, value) for key, value in DOCUMENT.items() if key != "long")
+
+@pytest.mark.parametrize("text", [b"3.25", b"-12.5e-3", b"1E10", b"true", b"null"])
+def test_scalars_split_anywhere(text):
+    for chunk_size in range(1, len(text) + 1):
+        json_stream = JSONStream(io.BytesIO(b"[" + text + b", " + text + b"]"), chunk_size)
+        assert [json_stream.value() for _ in json_stream.items()] == [json.loads(text)] * 2
+
+def test_a_value_spanning_chunks_is_decoded_once():
+    class CountingDecoder(json.JSONDecoder):
+        calls = 0
+        def raw_decode(self, s, idx=0):
+            CountingDecoder.calls += 1
+            return json.JSONDecoder.raw_decode(self, s, idx)
+    json_stream = stream(list(range(5000)), 16)
+    json_stream.json_decoder = CountingDecoder()
+    assert json_stream.value() == list(range(5000))
+    assert CountingDecoder.calls <= 2
+
+def test_errors():
+    with pytest.raises(ValueError):
+        read(JSONStream(io.BytesIO(b'{"a": [1, 2}'), 2))
+    with pytest.raises(ValueError):
+        JSONStream(io.BytesIO(b'"unterminated'), 4).skip()
+
+def test_streamed_projects_translate_as_decoded_ones():
+    with open("sample_project.json", "rb") as project_file:
+        project_json = json.load(project_file)
+    with open("sample_project.json", "rb") as project_file:
+        streamed = ScratchObject.from_stream(JSONStream(project_file, 100),
+                neopixel_target.new_context())
+    decoded = ScratchObject(project_json, neopixel_target.new_context())
+    assert streamed.get_state() == decoded.get_state()
+    assert [script.name for script in streamed.get_scripts()] == \
+            [script.name for script in decoded.get_scripts()]
@@ -0,0 +1,53 @@
+# Where the NeoPixel target batches changes to the lights: each run of changes
+# that doesn't pause is shown once, after the run and before the script moves on.
+
+from conftest import scratch_project, procedure, translate
+
+def loop_code(*blocks):
+    sketch = translate(scratch_project([procedure("setup"), procedure("loop", *blocks),
+            procedure("Other")], {"i": 0}))
+    start = sketch.index("void loop() {\n")
+    return sketch[start:sketch.index("\n}\n", start) + 2].split("\n")[1:-1]
+
+def test_one_change_is_shown_at_once():
+    assert loop_code(["call", "Turn on light %n", 1]) == ["  turnOnLight(1);"]
+
+def test_a_run_of_changes_is_shown_before_waiting():
+    assert loop_code(["call", "Turn on light %n", 1], ["call", "Turn off light %n", 2],
+            ["wait:elapsed:from:", 0.5], ["call", "Turn on light %n", 3]) == [
+        "  turnOnLightBuffered(1);",
+        "  turnOffLightBuffered(2);",
+        "  showLights();",
+        "  delay((0.5) * 1000);",
+        "  turnOnLight(3);"]
+
+def test_changes_in_a_repeat_are_shown_after_it():
+    assert loop_code(["doRepeat", 3, [["call", "Turn on light %n", ["readVariable", "i"]],
+            ["changeVar:by:", "i", 1]]], ["wait:elapsed:from:", 1]) == [
+        "  for (int counter_0 = 0; counter_0 < 3; counter_0++) {",
+        "    turnOnLightBuffered(i);",
+        "    i = i + 1;",
+        "  }",
+        "  showLights();",
+        "  delay((1) * 1000);"]
+
+def test_calls_to_other_functions_end_a_run():
+    assert loop_code(["call", "Turn on light %n", 1], ["call", "Other"],
+            ["call", "Turn on light %n", 2],
+            ["doIfElse", ["=", 1, ["readVariable", "i"]],
+                [["call", "Turn on light %n", 3]],
+                [["call", "Turn off light %n", 3], ["call", "Set light %n to RGB %n %n %n", 4, 1, 2, 3]]]) == [
+        "  turnOnLight(1);",
+        "  other();",
+        "  turnOnLightBuffered(2);",
+        "  if ((1 == i)) {",
+        "    turnOnLightBuffered(3);",
+        "  } else {",
+        "    turnOffLightBuffered(3);",
+        "    setLightToRgbBuffered(4, 1, 2, 3);",
+        "  }",
+        "  showLights();"]
+
+def test_simulation_broadcasts_are_dropped():
+    assert loop_code(["broadcast:", "update lights"], ["call", "Turn on light %n", 1]) == [
+        "  turnOnLight(1);"]
@@ -0,0 +1,83 @@
+# Constant folding, dropping operations that do nothing, and hoisting what can't
+# change while a loop runs out of it.
+
+from conftest import scratch_project, procedure, translate
+
+def loop_code(*blocks):
+    sketch = translate(scratch_project([procedure("setup"), procedure("loop", *blocks),
+            procedure("Other")], {"a": 1, "b": 2}))
+    start = sketch.index("void loop() {\n")
+    return sketch[start:sketch.index("\n}\n", start) + 2].split("\n")[1:-1]
+
+def read(name):
+    return ["readVariable", name]
+
+def test_constants_are_folded_and_identities_dropped():
+    assert loop_code(
+        ["setVar:to:", "a", ["+", 2, ["*", 3, 4]]],
+        ["setVar:to:", "a", ["+", 0, read("b")]],
+        ["setVar:to:", "a", ["-", read("b"), 0]],
+        ["setVar:to:", "a", ["*", read("b"), 1]],
+        ["setVar:to:", "a", ["*", read("b"), 4]]) == [
+            "  a = 14;",
+            "  a = b;",
+            "  a = b;",
+            "  a = b;",
+            "  a = (b * 4);"]
+
+def test_folding_stops_where_an_int_would_overflow():
+    assert loop_code(["setVar:to:", "a", ["*", 300, 300]]) == ["  a = (300 * 300);"]
+
+def test_divisions_fold_to_fractions_unless_exact():
+    assert loop_code(
+        ["setVar:to:", "a", ["/", 6, 3]],
+        ["setVar:to:", "a", ["/", 7, 2]],
+        ["setVar:to:", "a", ["%", ["/", 7, 2], 3]]) == [
+            "  a = 2;",
+            "  a = 3.5;",
+            "  a = 0;"]
+
+def test_invariants_are_hoisted_out_of_loops():
+    assert loop_code(["doRepeat", 10, [
+        ["setVar:to:", "a", ["+", read("a"), ["*", read("b"), 3]]],
+        ["setVar:to:", "a", ["%", read("a"), read("b")]]]]) == [
+            "  const auto invariant_0 = (b * 3);",
+            "  for (int counter_0 = 0; counter_0 < 10; counter_0++) {",
+            "    a = (a + invariant_0);",
+            "    a = (a % b);",
+            "  }"]
+
+def test_values_the_loop_may_change_stay_in_it():
+    changed = ["doRepeat", 10, [["setVar:to:", "a", ["*", read("b"), 3]],
+            ["changeVar:by:", "b", 1]]]
+    called = ["doRepeat", 10, [["setVar:to:", "a", ["*", read("b"), 3]], ["call", "Other"]]]
+    assert "    a = (b * 3);" in loop_code(changed)
+    assert "    a = (b * 3);" in loop_code(called)
+
+def task_code(*loop):
+    sketch = translate(scratch_project([
+        procedure("setup"),
+        procedure("loop", *loop),
+        [["whenIReceive", "go"], ["doForever", [["changeVar:by:", "c", 1]]]],
+    ], {"c": 0, "z": 0}))
+    start = sketch.index("bool loop_task(bool start) {\n")
+    return sketch[start:sketch.index("\n}\n", start) + 2].split("\n")[1:-1]
+
+def test_loops_that_pause_are_left_alone_in_tasks(cooperative):
+    # The receiver changes c while loop's task waits
+    assert task_code(["broadcast:", "go"], ["doForever", [
+        ["setVar:to:", "z", ["+", read("c"), 1]],
+        ["wait:elapsed:from:", 1]]]) == [
+            "  TASK_BEGIN(start)",
+            "  broadcast_go();",
+            "  while (true) {",
+            "    z = (c + 1);",
+            "    TASK_WAIT(2, ((1) * 1000));",
+            "    TASK_YIELD(1);",
+            "  }",
+            "  TASK_END"]
+    assert "    z = (c + 1);" in task_code(["broadcast:", "go"], ["doRepeat", 3, [
+        ["setVar:to:", "z", ["+", read("c"), 1]],
+        ["wait:elapsed:from:", 1]]])
+    assert "    z = (c + 1);" in task_code(["broadcast:", "go"], ["doForever", [
+        ["setVar:to:", "z", ["+", read("c"), 1]]]])
@@ -0,0 +1,41 @@
+# The project index's call graph, and the helpers left out of the sketch
+# because nothing it runs calls them.
+
+from conftest import scratch_project, procedure, translate
+from translator import *
+
+SCRIPTS = [
+    procedure("setup", ["call", "Start"]),
+    procedure("loop", ["call", "Step"], ["broadcast:", "go"]),
+    procedure("Start", ["changeVar:by:", "x", 1]),
+    procedure("Step", ["call", "Nested"]),
+    procedure("Nested", ["changeVar:by:", "x", 2]),
+    procedure("Unused", ["call", "Only from unused"]),
+    procedure("Only from unused", ["changeVar:by:", "x", 3]),
+    [["whenIReceive", "go"], ["call", "From receiver"]],
+    procedure("From receiver", ["changeVar:by:", "x", 4]),
+    [["whenGreenFlag"], ["call", "Only from flag"]],
+    procedure("Only from flag", ["changeVar:by:", "x", 5]),
+]
+
+def project():
+    return ScratchObject(scratch_project(SCRIPTS, {"x": 0}), neopixel_target.new_context())
+
+def test_reachable_follows_calls_and_broadcasts():
+    reachable = reachable_scripts(project())
+    assert set(["setup", "loop", "start", "step", "nested", "fromReceiver"]) <= set(reachable)
+    assert not set(["unused", "onlyFromUnused", "onlyFromFlag"]) & set(reachable)
+
+def test_opaque_scripts_are_not_followed():
+    index = project().index()
+    assert "nested" in index.reachable(["loop"])
+    assert "nested" not in index.reachable(["loop"], opaque=["step"])
+    # A root is followed even if it is opaque
+    assert "nested" in index.reachable(["step"], opaque=["step"])
+
+def test_uncalled_helpers_are_left_out():
+    sketch = translate(scratch_project(SCRIPTS, {"x": 0}))
+    for kept in ("void start ()", "void step ()", "void nested ()", "void fromReceiver ()"):
+        assert kept in sketch
+    for dropped in ("unused", "onlyFromUnused", "onlyFromFlag"):
+        assert dropped not in sketch
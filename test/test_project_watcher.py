@@ -0,0 +1,78 @@
+# The project watcher: waiters get a project's version as soon as it differs
+# from the one they saw, and idle projects stop being polled.
+
+import time
+import threading
+from project_watcher import ProjectWatcher, content_version
+
+class Versions(object):
+    "Stands in for translating a project: returns its current version"
+    def __init__(self):
+        self.current = {}
+        self.checks = []
+
+    def __call__(self, project_id):
+        self.checks.append(project_id)
+        return self.current[project_id]
+
+def watcher(versions):
+    # Long enough that the background thread doesn't poll during a test
+    return ProjectWatcher(versions, interval=1000)
+
+def test_first_wait_polls_and_returns_the_version():
+    versions = Versions()
+    versions.current[1] = "v1"
+    projects = watcher(versions)
+    assert projects.wait(1) == "v1"
+    assert versions.checks == [1]
+
+def test_waiting_on_the_current_version_times_out_with_it():
+    versions = Versions()
+    versions.current[1] = "v1"
+    projects = watcher(versions)
+    projects.wait(1)
+    start = time.time()
+    assert projects.wait(1, since="v1", timeout=0.1) == "v1"
+    assert time.time() - start >= 0.1
+
+def test_a_change_wakes_waiters():
+    versions = Versions()
+    versions.current[1] = "v1"
+    projects = watcher(versions)
+    projects.wait(1)
+    woken = []
+    waiters = [threading.Thread(target=lambda: woken.append(projects.wait(1, "v1", 5)))
+            for _ in range(2)]
+    for waiter in waiters:
+        waiter.start()
+    while projects.stats()["subscribers"] < 2:
+        time.sleep(0.001)
+    versions.current[1] = "v2"
+    projects.poll(1)
+    for waiter in waiters:
+        waiter.join(5)
+    assert woken == ["v2", "v2"]
+    assert projects.stats()["changes"] == 1
+
+def test_idle_projects_are_forgotten_and_checked_ones_not_due():
+    versions = Versions()
+    versions.current.update({1: "v1", 2: "v1"})
+    projects = ProjectWatcher(versions, interval=1000, idle_after=5000)
+    projects.wait(1)
+    projects.wait(2)
+    now = time.time()
+    assert projects.due(now) == []
+    assert sorted(projects.due(now + 1000)) == [1, 2]
+    projects.watches[2].last_seen = now - 6000
+    assert projects.due(now) == []
+    assert list(projects.watches) == [1]
+
+def test_failed_checks_are_counted():
+    projects = watcher(Versions())
+    projects.poll(3)
+    assert projects.stats()["errors"] == 1
+
+def test_content_version():
+    assert content_version(u"caf\xe9") == content_version(u"caf\xe9".encode('utf-8'))
+    assert content_version(u"a") != content_version(u"b")
+    assert len(content_version(u"a")) == 16
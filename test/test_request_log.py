@@ -0,0 +1,61 @@
+# The request log: requests are written in batches, and each distinct project
+# body is stored once.
+
+import time
+import sqlite3
+from request_log import RequestLog
+
+class CountingLog(RequestLog):
+    "Remembers the size of each batch written"
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+        RequestLog.__init__(self, *args, **kwargs)
+
+    def write(self, db, entries):
+        self.batches.append(len(entries))
+        RequestLog.write(self, db, entries)
+
+def rows(path, query):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute(query).fetchall()
+    finally:
+        db.close()
+
+def test_requests_are_written_in_batches(tmpdir):
+    path = str(tmpdir.join("log.db"))
+    log = CountingLog(path, batch_size=3, flush_interval=5)
+    for project_id in range(7):
+        log.record(project_id, {"objName": "Stage", "id": project_id % 2})
+    log.close()
+    assert log.batches == [3, 3, 1]
+    assert rows(path, "SELECT COUNT(*) FROM requests") == [(7,)]
+    assert log.stats()["written"] == 7
+
+def test_each_project_body_is_stored_once(tmpdir):
+    path = str(tmpdir.join("log.db"))
+    log = RequestLog(path)
+    project = {"objName": "Stage"}
+    for _ in range(3):
+        log.record(1, project)
+    log.record(2, {"objName": "Stage"})
+    log.record(2, {"objName": "Other"})
+    log.close()
+    assert rows(path, "SELECT COUNT(*) FROM projects") == [(2,)]
+    assert rows(path, "SELECT project_id, COUNT(DISTINCT project_hash) FROM requests " +
+            "GROUP BY project_id") == [(1, 1), (2, 2)]
+
+def test_entries_are_flushed_without_a_full_batch(tmpdir):
+    log = RequestLog(str(tmpdir.join("log.db")), batch_size=100, flush_interval=0.05)
+    log.record(1, {})
+    deadline = time.time() + 5
+    while log.stats()["written"] < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    assert log.stats()["written"] == 1
+    log.close()
+
+def test_entries_are_dropped_when_the_log_cannot_be_opened(tmpdir):
+    log = RequestLog(str(tmpdir.join("missing", "log.db")))
+    log.record(1, {})
+    log.close()
+    assert log.stats()["dropped"] == 1
@@ -0,0 +1,28 @@
+# How lists and constants are stored: the narrowest integer type that holds
+# them, in flash when nothing changes them, and what that uses of the board.
+
+from conftest import scratch_project, procedure, translate
+
+def plan(scripts, variables=None, lists=None):
+    summary = {}
+    translate(scratch_project(scripts, variables, lists), summary)
+    return summary["memory"]
+
+def test_lists_never_changed_are_kept_in_flash():
+    memory = plan([
+        procedure("setup", ["setLine:ofList:to:", 1, "levels", 300]),
+        procedure("loop"),
+    ], lists={"levels": [1, 2, 3], "colors": [10, 20, 30]})
+    assert memory["variables"]["levels"]["type"] == "int16_t"
+    assert memory["variables"]["levels"]["section"] == "sram"
+    assert memory["variables"]["colors"]["type"] == "uint8_t"
+    assert memory["variables"]["colors"]["section"] == "flash"
+    assert memory["flash_bytes"] == 3
+    assert memory["sram_bytes"] == 90 + 6
+
+def test_constants_take_no_sram():
+    memory = plan([procedure("setup"), procedure("loop", ["changeVar:by:", "count", 1])],
+            {"limit": 12, "count": 0})
+    assert memory["variables"]["limit"] == {"type": "uint8_t", "bytes": 0,
+            "section": "flash", "const": True}
+    assert memory["variables"]["count"]["section"] == "sram"
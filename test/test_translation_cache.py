@@ -0,0 +1,60 @@
+# The translation cache: content keys, LRU eviction, the disk mirror, and keys
+# that change with the translator's version.
+
+import translator
+from translation_cache import TranslationCache, project_hash
+
+def test_project_hash_ignores_key_order():
+    assert project_hash({"a": 1, "b": [1, 2]}) == project_hash({"b": [1, 2], "a": 1})
+    assert project_hash({"a": 1}) != project_hash({"a": 2})
+
+def test_least_recently_used_entries_are_evicted():
+    cache = TranslationCache(max_entries=2)
+    cache.put("a", u"one")
+    cache.put("b", u"two")
+    assert cache.get("a") == u"one"
+    cache.put("c", u"three")
+    assert cache.get("b") is None
+    assert cache.get("a") == u"one"
+    assert cache.stats()["evictions"] == 1
+
+def test_entries_are_evicted_to_stay_under_max_bytes():
+    cache = TranslationCache(max_bytes=10)
+    cache.put("a", u"12345")
+    cache.put("b", u"123456")
+    assert "a" not in cache
+    assert cache.stats()["bytes"] == 6
+
+def test_translates_only_on_a_miss():
+    cache = TranslationCache()
+    calls = []
+    def translate(project):
+        calls.append(project)
+        return u"sketch of " + project
+    assert cache.get_or_translate("k", translate, "p") == u"sketch of p"
+    assert cache.get_or_translate("k", translate, "p") == u"sketch of p"
+    assert calls == ["p"]
+    assert cache.stats()["hits"] == 1
+
+def test_translations_survive_a_restart_on_disk(tmpdir):
+    TranslationCache(cache_dir=str(tmpdir)).put("abcdef", u"caf\xe9")
+    restarted = TranslationCache(cache_dir=str(tmpdir))
+    assert "abcdef" in restarted
+    assert restarted.get("abcdef") == u"caf\xe9"
+    assert restarted.stats()["disk_hits"] == 1
+
+def test_key_changes_with_the_translator_version(monkeypatch, tmpdir):
+    project = {"objName": "Stage"}
+    key = translator.translation_key(project)
+    assert key.startswith(project_hash(project))
+    TranslationCache(cache_dir=str(tmpdir)).put(key, u"old sketch")
+    monkeypatch.setattr(translator, "TRANSLATOR_VERSION", "newer")
+    new_key = translator.translation_key(project)
+    assert new_key != key
+    assert TranslationCache(cache_dir=str(tmpdir)).get(new_key) is None
+
+def test_key_changes_with_the_scheduler(monkeypatch):
+    project = {"objName": "Stage"}
+    key = translator.translation_key(project)
+    monkeypatch.setattr(translator, "scheduler", "cooperative")
+    assert translator.translation_key(project) != key
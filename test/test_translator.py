@@ -22,7 +22,7 @@ for script in test_data['scripts']:
 with open('sample_project.json') as projectfile:
     project_json = json.load(projectfile)
     project = ScratchObject(project_json)
-    script = project.get_script("instructions_for_each_update")
+    script = project.get_script("instructionsForEachUpdate")
     print(script.to_arduino())
 
 
@@ -0,0 +1,100 @@
+# The types inferred for variables, lists and function parameters, and the
+# promotions reported for those that hold fractions or text.
+
+from conftest import scratch_project, procedure, translate
+from type_inference import *
+from scratch_blocks import Add, Subtract, Multiply, Divide, Modulo
+
+def plan(scripts, variables=None, lists=None):
+    summary = {}
+    translate(scratch_project(scripts, variables, lists), summary)
+    return summary["memory"]
+
+def variable_types(memory):
+    return dict((name, variable["type"]) for name, variable in memory["variables"].items())
+
+def test_arithmetic_ranges():
+    digit = ValueType(INT, 0, 9)
+    assert arithmetic_type(Add, digit, ValueType(INT, 1, 1)) == ValueType(INT, 1, 10)
+    assert arithmetic_type(Subtract, digit, digit) == ValueType(INT, -9, 9)
+    assert arithmetic_type(Multiply, digit, ValueType(INT, -2, 3)) == ValueType(INT, -18, 27)
+    assert arithmetic_type(Modulo, UNKNOWN, ValueType(INT, 4, 4)) == ValueType(INT, -3, 3)
+    assert arithmetic_type(Modulo, digit, ValueType(INT, 4, 4)) == ValueType(INT, 0, 3)
+    # A fraction is cut to a whole number first
+    assert arithmetic_type(Modulo, ValueType(FLOAT), ValueType(INT, 4, 4)) == ValueType(INT, -3, 3)
+
+def test_dividing_gives_fractions_unless_exact():
+    six, three, four = [ValueType(INT, n, n) for n in (6, 3, 4)]
+    assert arithmetic_type(Divide, six, three) == ValueType(INT, 2, 2)
+    assert arithmetic_type(Divide, six, four) == ValueType(FLOAT)
+    assert arithmetic_type(Divide, ValueType(INT, 0, 9), three) == ValueType(FLOAT)
+
+def test_text_only_joins():
+    assert arithmetic_type(Add, ValueType(TEXT), ValueType(INT, 1, 1)) == ValueType(TEXT)
+    assert arithmetic_type(Multiply, ValueType(TEXT), ValueType(INT, 1, 1)) == UNKNOWN
+
+def test_widening_drops_the_bounds_that_grew():
+    counter = ValueType(INT, 0, 1)
+    assert counter.widen(counter.join(ValueType(INT, 2, 2))) == ValueType(INT, 0, None)
+
+def test_narrowest_integer_types():
+    memory = plan([
+        procedure("setup", ["setVar:to:", "small", 200], ["setVar:to:", "negative", -5],
+                ["setVar:to:", "big", 100000], ["setVar:to:", "whole", ["/", 6, 3]]),
+        procedure("loop", ["changeVar:by:", "counter", 1]),
+    ], {"small": 0, "negative": 0, "big": 0, "whole": 0, "counter": 0})
+    assert variable_types(memory) == {"small": "uint8_t", "negative": "int8_t",
+            "big": "long", "whole": "uint8_t", "counter": "int"}
+    assert memory["promotions"] == []
+
+def test_promotions_are_reported():
+    memory = plan([
+        procedure("setup", ["setVar:to:", "name", "hello"]),
+        procedure("loop", ["changeVar:by:", "counter", 1],
+                ["setVar:to:", "ratio", ["/", ["readVariable", "counter"], 3]]),
+    ], {"name": "", "counter": 0, "ratio": 0})
+    assert variable_types(memory) == {"name": "String", "counter": "int", "ratio": "float"}
+    assert memory["promotions"] == [
+        "FLOAT: ratio holds fractions, since loop sets it to (counter / (float) 3). " +
+                "The board works them out in software, which is slow.",
+        "TEXT: name holds text, since setup sets it to \"hello\"."]
+
+def test_parameters_take_the_types_passed_to_them():
+    memory = plan([
+        procedure("setup"),
+        procedure("loop", ["call", "Blink %n", 2.5], ["call", "Blink %n", 1],
+                ["call", "Flash %n", 3]),
+        [["procDef", "Blink %n", ["times"], [1], False],
+                ["setVar:to:", "offset", ["getParam", "times", "r"]]],
+        [["procDef", "Flash %n", ["times"], [1], False]],
+    ], {"offset": 0})
+    assert memory["parameters"] == {"blink": ["float"], "flash": ["int"]}
+    assert variable_types(memory) == {"offset": "float"}
+    assert "FLOAT: times of blink holds fractions, since loop passes 2.5. " + \
+            "The board works them out in software, which is slow." in memory["promotions"]
+
+def test_exact_divisions_divide_as_ints():
+    summary = {}
+    sketch = translate(scratch_project([
+        procedure("setup", ["setVar:to:", "x", ["/", ["readVariable", "a"], 2]]),
+        procedure("loop", ["setVar:to:", "y", ["/", ["readVariable", "a"], 2]],
+                ["setVar:to:", "z", ["/", ["readVariable", "a"], 3]]),
+    ], {"a": 10, "x": 0, "y": 0, "z": 0}), summary)
+    assert "x = (a / 2);" in sketch and "y = (a / 2);" in sketch
+    assert "z = (a / (float) 3);" in sketch
+    assert variable_types(summary["memory"]) == {"a": "uint8_t", "x": "uint8_t",
+            "y": "uint8_t", "z": "float"}
+    assert summary["estimate"]["loop"]["float_ops"] == 1
+
+def test_fractions_are_cut_for_remainders_and_items():
+    summary = {}
+    halves = ["/", ["readVariable", "counter"], 2]
+    sketch = translate(scratch_project([
+        procedure("setup"),
+        procedure("loop", ["changeVar:by:", "counter", 1],
+                ["setVar:to:", "r", ["%", halves, 3]],
+                ["setLine:ofList:to:", halves, "levels", 5]),
+    ], {"counter": 0, "r": 0}, {"levels": [1, 2]}), summary)
+    assert "r = ((int) (counter / (float) 2) % 3);" in sketch
+    assert "levels[(int) (counter / (float) 2)] = 5;" in sketch
+    assert variable_types(summary["memory"])["r"] == "int8_t"
@@ -0,0 +1,50 @@
+# The bounded worker pool: jobs beyond max_pending are refused at once, and a
+# job's failure is raised in the caller with the worker's traceback.
+
+import threading
+import pytest
+from worker_pool import *
+
+def wait_for(event):
+    event.wait(5)
+    return "done"
+
+def fail():
+    raise KeyError("missing")
+
+def square(n):
+    return n * n
+
+def test_refuses_work_beyond_max_pending():
+    pool = WorkerPool(workers=1, max_pending=2)
+    release = threading.Event()
+    try:
+        running = [pool.submit(wait_for, release) for _ in range(2)]
+        with pytest.raises(PoolSaturatedError):
+            pool.submit(wait_for, release)
+        assert pool.stats()["rejected"] == 1
+        assert pool.stats()["pending"] == 2
+    finally:
+        release.set()
+    assert [result.get(5) for result in running] == [(True, "done", None)] * 2
+    # The finished jobs free their slots
+    assert pool.run(square, 3) == 9
+    assert pool.stats()["completed"] == 3
+    pool.close()
+
+def test_failures_carry_the_worker_traceback():
+    pool = WorkerPool(workers=1)
+    with pytest.raises(WorkerError) as raised:
+        pool.run(fail)
+    assert isinstance(raised.value.error, KeyError)
+    assert "in fail" in raised.value.worker_traceback
+    pool.close()
+
+def test_process_pool():
+    pool = WorkerPool(workers=2, kind="process")
+    assert pool.run(square, 4) == 16
+    pool.close()
+
+def test_unknown_kind():
+    with pytest.raises(ValueError):
+        WorkerPool(kind="fiber")
@@ -0,0 +1,136 @@
+# A content-addressed cache for translated sketches. During a workshop, the same
+# unchanged project gets translated over and over; keying on a hash of the project
+# JSON lets us skip building a ScratchObject and running codegen entirely.
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+def project_hash(project_json):
+    "Returns a canonical content hash for a project's JSON"
+    canonical = json.dumps(project_json, sort_keys=True, separators=(',', ':'))
+    if isinstance(canonical, unicode):
+        canonical = canonical.encode('utf-8')
+    return hashlib.sha1(canonical).hexdigest()
+
+class TranslationCache(object):
+    """An LRU cache of translations, held in memory and optionally mirrored on disk
+    so that translations survive a restart. Entries are evicted from memory when
+    there are more than max_entries of them or they take more than max_bytes."""
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024, cache_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries or (self.cache_dir and os.path.exists(self.disk_path(key)))
+
+    def get(self, key):
+        "Returns the cached translation for key, or None"
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+                self.hits += 1
+                return value
+        value = self.read_disk(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self.remember(key, value)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.remember(key, value)
+        self.write_disk(key, value)
+
+    def get_or_translate(self, key, translate, *args):
+        "Returns the cached translation for key, calling translate(*args) on a miss"
+        value = self.get(key)
+        if value is None:
+            value = translate(*args)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                "disk": self.cache_dir
+            }
+
+    # Callers must hold self.lock.
+    def remember(self, key, value):
+        if key in self.entries:
+            self.size -= entry_size(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += entry_size(value)
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= entry_size(evicted)
+            self.evictions += 1
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".ino")
+
+    def read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.disk_path(key)) as cached:
+                return cached.read().decode('utf-8')
+        except IOError:
+            return None
+
+    def write_disk(self, key, value):
+        "Writes atomically, so a concurrent reader never sees a partial translation"
+        if not self.cache_dir:
+            return
+        path = self.disk_path(key)
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as temp:
+                temp.write(value.encode('utf-8'))
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            pass
+
+def entry_size(value):
+    return len(value.encode('utf-8'))
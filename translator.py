@@ -0,0 +1,387 @@
+# The translation pipeline: turns a project's JSON into an Arduino sketch for the
+# NeoPixel workshop. Shared by the server and the command-line translator.
+
+from scratch_object import *
+from translation_cache import project_hash
+from scheduler import SCHEDULERS, task_code, pausing_functions, subtask_names, calls_in, called_by
+from cost_model import Estimator, estimate_sketch
+from type_inference import code_name
+import neopixel_target
+from json_stream import JSONStream
+from metrics import metrics
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, ChoiceLoader, \
+        ModuleLoader
+from os.path import dirname, realpath, join
+from HTMLParser import HTMLParser
+from collections import OrderedDict
+import threading
+import hashlib
+import glob
+import os
+
+TEMPLATE_DIR = dirname(realpath(__file__))
+TEMPLATES = ["neopixel_template.html", "base_template.html", "landing_template.html"]
+
+def template_environment():
+    """Templates are compiled to Python the first time each is used. Every new
+    process would do that again, so SCRATCH2ARDUINO_TEMPLATE_CACHE names a
+    directory to keep the compiled bytecode in, and SCRATCH2ARDUINO_COMPILED_TEMPLATES
+    one holding templates compiled ahead of time (see compile_templates)."""
+    loader = FileSystemLoader(TEMPLATE_DIR)
+    compiled = os.environ.get("SCRATCH2ARDUINO_COMPILED_TEMPLATES")
+    if compiled:
+        loader = ChoiceLoader([ModuleLoader(compiled), loader])
+    cache_dir = os.environ.get("SCRATCH2ARDUINO_TEMPLATE_CACHE")
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return Environment(loader=loader,
+            bytecode_cache=FileSystemBytecodeCache(cache_dir) if cache_dir else None)
+
+env = template_environment()
+
+def load_template(name):
+    "Templates are loaded when first used, so processes that don't render one don't pay for it"
+    return env.get_template(name)
+
+def compile_templates(target):
+    """Compiles the templates into Python modules in target, to be loaded from
+    there with SCRATCH2ARDUINO_COMPILED_TEMPLATES. Compile them again whenever
+    a template changes: compiled templates are used even if they're out of date."""
+    env.compile_templates(target, zip=None, filter_func=lambda name: name in TEMPLATES,
+            ignore_errors=False)
+
+excluded_vars = [
+"acceleration",
+  "colorOffset",
+  "isMoving",
+  "howManyLights",
+  "mainColor",
+  "mainColorValue",
+  "lightColor",
+  "myLightNumber",
+  "lightMode",
+  "secondColorValue",
+  "lightIndex",
+  "secondColor",
+  "ready",
+  "changeInAcceleration",
+  "speed"
+]
+
+excluded_scripts = [
+    "waitATick",
+    "setLightToRgb",
+    "findMainAndSecondColors",
+    "loop",
+    "setup",
+    "findColorOffset",
+    "turnOffLight",
+    "turnOnLight",
+    "setupLights",
+    "scaleColorValues",
+    "reset"
+]
+
+# How scripts wait: "delay" stops the board while a script waits; "cooperative"
+# runs scripts as tasks, which loop() steps in turn (see scheduler.py)
+scheduler = os.environ.get("SCRATCH2ARDUINO_SCHEDULER", "delay")
+
+def use_scheduler(name):
+    "Sets the scheduler for translations from now on, in this process"
+    global scheduler
+    if name not in SCHEDULERS:
+        raise ValueError("No scheduler called {}".format(name))
+    scheduler = name
+
+def translator_version():
+    """A hash of the code and templates that make sketches. Translations cached
+    on disk by another version of the translator aren't used."""
+    digest = hashlib.sha1()
+    for path in sorted(glob.glob(join(TEMPLATE_DIR, "*.py"))) + \
+            [join(TEMPLATE_DIR, name) for name in TEMPLATES]:
+        with open(path, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()[:8]
+
+TRANSLATOR_VERSION = translator_version()
+
+def translation_key(scratch_project):
+    """Identifies a project's translation, by this version of the translator and
+    under the options translations are made with"""
+    key = "{}-{}".format(project_hash(scratch_project), TRANSLATOR_VERSION)
+    if scheduler != "delay":
+        key += "-" + scheduler
+    return key
+
+# SRAM the template itself uses: the colors table and the NeoPixel library's pixel buffer
+TEMPLATE_SRAM = 15 * 3 + 15 * 3
+
+def include_script(script):
+    if not script.name:
+        return False
+    if script.name in excluded_scripts:
+        return False
+    # setup() and loop() take the place of the simulation's green flag scripts
+    if isinstance(script, GreenFlag):
+        return False
+    return True
+
+def change_indent(code, spaces):
+    statements = code.split("\n")
+    if spaces > 0:
+        statements = [(" " * spaces) + s for s in statements]
+    else:
+        statements = [s[(spaces * -1):] for s in statements]
+    return "\n".join(statements)
+
+# The latest version of each recently translated project, by project ID. When a
+# student changes one script, only that script is parsed and generated again.
+MAX_RECENT_PROJECTS = 256
+recent_projects = OrderedDict()
+recent_projects_lock = threading.Lock()
+
+# The project students remix, parsed ahead of time by warm_up. A project seen
+# for the first time reuses the scripts it hasn't changed from this one.
+base_project = None
+
+def parse_project(scratch_project):
+    """Builds a ScratchObject, reusing what it can from the project's previous
+    version, or from the base project if there isn't one"""
+    project_id = scratch_project.get('info', {}).get('projectID')
+    with recent_projects_lock:
+        previous = recent_projects.get(project_id) if project_id else None
+    if previous is None:
+        previous = base_project
+    # Scripts are rewritten differently for each scheduler (see hoist_invariants)
+    if previous is not None and previous.context.scheduler != scheduler:
+        previous = None
+    with metrics.phase("parse"):
+        project = ScratchObject(scratch_project, neopixel_target.new_context(scheduler), previous)
+    if project_id:
+        with recent_projects_lock:
+            recent_projects.pop(project_id, None)
+            recent_projects[project_id] = project
+            while len(recent_projects) > MAX_RECENT_PROJECTS:
+                recent_projects.popitem(last=False)
+    return project
+
+def translate_project(scratch_project):
+    return render_project(parse_project(scratch_project))
+
+def translate_project_file(project_file, summary=None):
+    """Like translate_project, but reads the project's JSON incrementally from a
+    file. Given a summary dict, adds the sketch's memory plan and estimate to it."""
+    context = neopixel_target.new_context(scheduler)
+    with metrics.phase("parse"):
+        project = ScratchObject.from_stream(JSONStream(project_file), context)
+    return render_project(project, summary)
+
+def translate_project_reporting(scratch_project):
+    "For worker processes: returns the translation along with the metrics it recorded"
+    return translate_project(scratch_project), metrics.drain()
+
+def render_project(project, summary=None):
+    parts = program_parts(project)
+    plan, estimate = parts.pop("plan"), parts.pop("estimate")
+    if summary is not None:
+        summary["memory"] = plan.to_json()
+        summary["estimate"] = estimate.to_json()
+    with metrics.phase("helpers"):
+        parts["helpers"] = list(parts["helpers"])
+    with metrics.phase("render"):
+        return load_template("neopixel_template.html").render(**parts)
+
+def generate_program(project):
+    "Yields the program in pieces as it is generated, for streaming into a response"
+    parts = program_parts(project)
+    del parts["plan"], parts["estimate"]
+    return load_template("neopixel_template.html").generate(**parts)
+
+def warm_up(base_project_json=None):
+    """Gets this process ready to translate: loads the templates and, given the
+    project students remix, parses and renders it. The first translation of a
+    remix then reuses the scripts and generated code it shares with the base."""
+    global base_project
+    for name in TEMPLATES:
+        load_template(name)
+    if base_project_json is not None:
+        project = ScratchObject(base_project_json, neopixel_target.new_context(scheduler))
+        render_project(project)
+        base_project = project
+
+def program_parts(project):
+    "The template's arguments. Helper functions are generated as the template asks for them."
+    context = project.context
+    helpers = helper_scripts(project)
+    with metrics.phase("state"):
+        plan = project.storage_plan(exclude=excluded_vars, reserved_sram=TEMPLATE_SRAM,
+                functions=helpers)
+        init_vars = "\n".join(plan.declarations())
+    receivers = broadcast_receivers(project)
+    pausing = set()
+    with metrics.phase("codegen"):
+        setup = script_code(project, plan, project.get_script("setup"), "block")
+        if scheduler == "cooperative":
+            loop = None
+            pausing = pausing_functions(dict((script.name, script) for script in helpers))
+            tasks = task_functions(project, plan, helpers, receivers, pausing)
+            # Receivers run as tasks, and so do helpers that can pause, unless
+            # something that isn't a task calls them too
+            called = blocking_calls(project, helpers, pausing)
+            functions = [script for script in helpers
+                    if script.name not in pausing or script.name in called]
+        else:
+            loop = script_code(project, plan, project.get_script("loop"), "block")
+            tasks = []
+            functions = helpers + receiver_scripts(receivers)
+    with metrics.phase("estimate"):
+        estimate = estimate_project(project, plan, helpers, receivers, pausing)
+    return {
+        "plan": plan,
+        "estimate": estimate,
+        "init_vars": init_vars,
+        "memory_report": plan.report(),
+        "estimate_report": estimate.report(),
+        "setup": setup,
+        "loop": loop,
+        "tasks": tasks,
+        "receiver_tasks": [script.fn_name for script in receiver_scripts(receivers)] if tasks else [],
+        "broadcasts": broadcast_code(receivers, bool(tasks)),
+        "helpers": helper_code(project, functions, plan),
+        "motion_sensor": context.uses(neopixel_target.MOTION_SENSOR),
+        "batched_lights": context.uses(neopixel_target.BATCHED_LIGHTS)
+    }
+
+def script_code(project, plan, script, part=None, generate=None):
+    """The code for script (see ScratchObject.script_code), with the divisions
+    the plan says come out whole dividing as ints"""
+    return project.script_code(script, part, generate, plan.whole_divisions.get(id(script)))
+
+def task_functions(project, plan, helpers, receivers, pausing):
+    """The name and code of each task in the sketch: loop's, each receiver's, and
+    for each of those, a copy of each helper it calls that can pause"""
+    functions = dict((script.name, script) for script in helpers)
+    tasks = []
+    for name, script in task_scripts(project, receivers):
+        subtasks = subtask_names(script, name, functions, pausing)
+        tasks.append((name, task(project, plan, script, name, subtasks)))
+        tasks.extend((subtasks[helper.name], task(project, plan, helper, subtasks[helper.name],
+                subtasks, plan.parameters.get(helper.name))) for helper in helpers
+                if helper.name in subtasks)
+    return tasks
+
+def task(project, plan, script, name, subtasks, arg_c_types=None):
+    """The code for a task called name that runs script, with its loop invariants
+    and parameters in the types planned for them"""
+    types = plan.invariants.get(code_name(script), {})
+    part = ("task", name, tuple(sorted(types.items())), tuple(sorted(subtasks.items())),
+            tuple(arg_c_types or ()))
+    return script_code(project, plan, script, part,
+            lambda script: task_code(script, name, types, subtasks, arg_c_types))
+
+def blocking_calls(project, helpers, pausing):
+    """The names of the helpers called, directly or not, from setup or from helpers
+    that don't run as tasks, and so called as plain functions"""
+    calls = dict((script.name, calls_in(script)) for script in helpers)
+    calls[None] = calls_in(project.get_script("setup")).union(*[calls[script.name]
+            for script in helpers if script.name not in pausing])
+    return called_by(None, calls)
+
+def task_scripts(project, receivers):
+    "The scripts the cooperative scheduler runs, by task name: loop, and each receiver"
+    return [("loop_task", project.get_script("loop"))] + \
+            [(script.fn_name, script) for script in receiver_scripts(receivers)]
+
+def receiver_scripts(receivers):
+    "The scripts in receivers (see broadcast_receivers), message by message"
+    return [script for message_receivers in receivers.values() for script in message_receivers]
+
+def entry_points(project):
+    """The scripts the sketch runs without being called: setup and loop. Receivers
+    run when a script in the sketch broadcasts their message."""
+    return ["setup", "loop"]
+
+def reachable_scripts(project):
+    """The names of the scripts the sketch runs: the entry points and the scripts
+    they call or broadcast to, directly or not. The template's functions take the
+    place of the excluded scripts, so calls to those aren't followed."""
+    return project.index().reachable(entry_points(project), opaque=excluded_scripts)
+
+def helper_scripts(project):
+    """The helper functions in the sketch. Helpers that nothing reachable from an
+    entry point calls are left out."""
+    reachable = reachable_scripts(project)
+    return [script for script in project.get_scripts() if include_script(script) and
+            not isinstance(script, EventBinding) and script.name in reachable]
+
+def helper_code(project, functions, plan):
+    """Yields the code for each function (helpers, then receivers), one line apart,
+    with each helper's parameters in the C types the plan gives them"""
+    separator = ""
+    for script in functions:
+        c_types = plan.parameters.get(script.name) if isinstance(script, Function) else None
+        if c_types:
+            code = script_code(project, plan, script, ("function",) + tuple(c_types),
+                    lambda script: function_code(script, c_types))
+        else:
+            code = script_code(project, plan, script)
+        yield separator + code
+        separator = "\n"
+
+def function_code(function, arg_c_types):
+    "The code for a function, with its parameters declared in arg_c_types"
+    writer = SignatureWriter(function, arg_c_types, function.indent)
+    function.emit(writer)
+    return writer.getvalue()
+
+def broadcast_receivers(project):
+    """Maps each message broadcast in the sketch to the scripts that receive it,
+    in the order of the project's scripts. Each receiver becomes a function of
+    the sketch, which the message's function calls."""
+    index = project.index()
+    reachable = reachable_scripts(project)
+    receivers = OrderedDict((message, []) for message in
+            sorted(set().union(*[index.broadcasts[name] for name in reachable])))
+    for script in index.scripts:
+        if isinstance(script, EventBinding) and script.event_name in receivers and \
+                include_script(script):
+            receivers[script.event_name].append(script)
+    return receivers
+
+def broadcast_code(receivers, tasks=False):
+    """Returns a function for each message, which calls each script that receives
+    it, or, if receivers are tasks, starts each of them (again)"""
+    code = []
+    for message, scripts in receivers.items():
+        lines = ["void {}() {{".format(message_function(message))]
+        if tasks:
+            lines.extend("  {}_start = true;".format(script.fn_name) for script in scripts)
+        else:
+            lines.extend("  {}();".format(script.fn_name) for script in scripts)
+        lines.append("}")
+        code.append("\n".join(lines))
+    return code
+
+def estimate_project(project, plan, helpers, receivers, pausing=()):
+    """Estimates the sketch's size and the cost of a pass through loop(). pausing
+    names the helpers that run as tasks when a task calls them."""
+    functions = dict((script.name, script) for script in helpers)
+    for message_receivers in receivers.values():
+        for script in message_receivers:
+            functions[script.fn_name] = script.fn
+    types = dict((d.name, d.c_type) for d in plan.decisions)
+    for name, c_types in plan.parameters.items():
+        types.update(((name, arg), c_type) for arg, c_type in
+                zip(functions[name].arg_names, c_types))
+    estimator = Estimator(functions,
+            dict((message, [script.fn_name for script in message_receivers])
+                    for message, message_receivers in receivers.items()),
+            neopixel_target.SHOWS_PER_CALL, types, tasks=scheduler == "cooperative",
+            pausing=pausing, whole_divisions=set().union(*plan.whole_divisions.values()))
+    return estimate_sketch(plan, estimator, project.get_script("setup").block,
+            project.get_script("loop").block,
+            motion_sensor=project.context.uses(neopixel_target.MOTION_SENSOR))
+
+def to_sketch(program):
+    "The program template is escaped for display in HTML; this returns plain Arduino code"
+    return HTMLParser().unescape(program)
@@ -0,0 +1,565 @@
+# Works out which values each variable, list and function parameter can hold,
+# from every place the project gives it one: its initial value, set and change
+# blocks, the items set in lists, and the arguments each function is called with.
+# Whole numbers are tracked as a range, so the storage planner can declare each
+# in the narrowest integer type that holds it. A variable is only a float or a
+# String where some block really gives it a fraction or text, and those places
+# are reported, since the board does float arithmetic in software and keeps
+# Strings on its small heap.
+#
+# Dividing gives a fraction, as it does in Scratch, unless both sides can only be
+# one whole number each, and one divides the other. The sketch divides those as
+# ints, and the rest as floats (see whole_divisions, and Divide in scratch_blocks).
+
+import re
+import json
+from collections import deque
+from scratch_blocks import *
+from optimizer import LoopInvariants
+
+# Kinds of value, each of which can hold the ones before it
+INT, FLOAT, TEXT = 0, 1, 2
+
+# How many times a range can grow because something it depends on did before
+# it is taken to be unbounded
+WIDEN_AFTER = 3
+
+# How a site gives its target a value
+SET, CHANGE = "set", "change"
+
+COMPARISONS = (Equals, GreaterThan, LessThan, And, KeyPressed)
+
+class ValueType(object):
+    """The values something can hold: whole numbers from low to high (either of
+    which is None if there is no bound), fractions, or text"""
+    __slots__ = ('kind', 'low', 'high')
+
+    def __init__(self, kind=INT, low=None, high=None):
+        self.kind = kind
+        self.low = low if kind == INT else None
+        self.high = high if kind == INT else None
+
+    def __eq__(self, other):
+        return isinstance(other, ValueType) and (self.kind, self.low, self.high) == \
+                (other.kind, other.low, other.high)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.kind, self.low, self.high))
+
+    def __repr__(self):
+        return "<ValueType {} {}..{}>".format(self.kind, self.low, self.high)
+
+    def bounded(self):
+        return self.kind == INT and self.low is not None and self.high is not None
+
+    def holds(self, other):
+        "Whether self can hold every value other can"
+        if self.kind != other.kind:
+            return self.kind > other.kind
+        return (self.low is None or (other.low is not None and self.low <= other.low)) and \
+                (self.high is None or (other.high is not None and other.high <= self.high))
+
+    def join(self, other):
+        "The values either self or other can hold"
+        if other is None:
+            return self
+        kind = max(self.kind, other.kind)
+        low = None if self.low is None or other.low is None else min(self.low, other.low)
+        high = None if self.high is None or other.high is None else max(self.high, other.high)
+        return ValueType(kind, low, high)
+
+    def widen(self, joined):
+        "Returns joined, unbounded on each side where it grew beyond self"
+        low, high = joined.low, joined.high
+        if low is not None and (self.low is None or low < self.low):
+            low = None
+        if high is not None and (self.high is None or high > self.high):
+            high = None
+        return ValueType(joined.kind, low, high)
+
+UNKNOWN = ValueType(INT)
+BOOLEAN = ValueType(INT, 0, 1)
+
+INTEGER = re.compile(r'^-?[0-9]+$')
+
+def integer_value(value):
+    "Returns value as an int if it is a whole number (Scratch often stores numbers as strings)"
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, long)):
+        return value
+    if isinstance(value, basestring) and INTEGER.match(value):
+        return int(value)
+    return None
+
+def integer_values(values):
+    "Returns values as ints if they are all whole numbers, otherwise None"
+    if all(type(value) is int for value in values):
+        return values
+    integers = [integer_value(value) for value in values]
+    return None if None in integers else integers
+
+def number_value(value):
+    "Returns value as a number, counting text that isn't one as 0, as Scratch does"
+    if isinstance(value, bool):
+        return int(value)
+    number = integer_value(value)
+    if number is not None:
+        return number
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+# The type of each value seen, by its type and value (since 1 == 1.0 == True)
+VALUE_TYPES = {}
+
+def value_type(value):
+    "The type of a value stored in the project, or None for an empty one"
+    key = (type(value), value)
+    try:
+        return VALUE_TYPES[key]
+    except (KeyError, TypeError):
+        pass
+    if len(VALUE_TYPES) > 10000:
+        VALUE_TYPES.clear()
+    result = compute_value_type(value)
+    try:
+        VALUE_TYPES[key] = result
+    except TypeError:
+        pass
+    return result
+
+def compute_value_type(value):
+    if value == "":
+        return None
+    if isinstance(value, bool):
+        return BOOLEAN
+    if isinstance(value, float):
+        return ValueType(INT, int(value), int(value)) if value.is_integer() else ValueType(FLOAT)
+    number = integer_value(value)
+    if number is not None:
+        return ValueType(INT, number, number)
+    if isinstance(value, basestring):
+        try:
+            return compute_value_type(float(value))
+        except ValueError:
+            return ValueType(TEXT)
+    return ValueType(TEXT)
+
+def add_bounds(a, b):
+    return None if a is None or b is None else a + b
+
+def negate(bound):
+    return None if bound is None else -bound
+
+def arithmetic_type(operator, a, b):
+    """The type of the value of an operator (a BinaryOperator class), given the
+    types of its arguments"""
+    kind = max(a.kind, b.kind)
+    if kind == TEXT:
+        # On the board, adding to a String joins them
+        if operator is Add:
+            return ValueType(TEXT)
+        # and no other arithmetic on text compiles, so there's nothing to go on
+        return UNKNOWN
+    if operator is Modulo:
+        # Fractions are cut to whole numbers first (see Modulo)
+        a, b = [UNKNOWN if value_type.kind == FLOAT else value_type for value_type in (a, b)]
+    elif kind == FLOAT:
+        return ValueType(FLOAT)
+    if operator is Add:
+        return ValueType(INT, add_bounds(a.low, b.low), add_bounds(a.high, b.high))
+    if operator is Subtract:
+        return ValueType(INT, add_bounds(a.low, negate(b.high)), add_bounds(a.high, negate(b.low)))
+    if operator is Multiply:
+        if a.bounded() and b.bounded():
+            products = [x * y for x in (a.low, a.high) for y in (b.low, b.high)]
+            return ValueType(INT, min(products), max(products))
+        return UNKNOWN
+    if operator is Divide:
+        # Only exact when both are constants, and one divides the other
+        if a.bounded() and b.bounded() and a.low == a.high and b.low == b.high and \
+                b.low != 0 and a.low % b.low == 0:
+            return ValueType(INT, a.low // b.low, a.low // b.low)
+        return ValueType(FLOAT)
+    if operator is Modulo:
+        # In C, the remainder has the sign of the number divided
+        if not b.bounded() or b.low == b.high == 0:
+            return ValueType(INT, None if a.low is None or a.low < 0 else 0,
+                    None if a.high is None or a.high > 0 else 0)
+        largest = max(abs(b.low), abs(b.high)) - 1
+        return ValueType(INT, 0 if a.low is not None and a.low >= 0 else -largest,
+                0 if a.high is not None and a.high <= 0 else largest)
+    return UNKNOWN
+
+def fixed_type(node):
+    "The type of a node that reads nothing, or whose type doesn't depend on what it reads"
+    kind = type(node)
+    if kind is LiteralNumber:
+        return value_type(node.value)
+    if kind is LiteralString:
+        return value_type(node.value) or ValueType(TEXT)
+    if kind is RandomFromTo:
+        low, high = integer_value(node.fromVal), integer_value(node.toVal)
+        if low is not None and high is not None:
+            return ValueType(INT, min(low, high), max(low, high))
+    elif issubclass(kind, COMPARISONS):
+        return BOOLEAN
+    return UNKNOWN
+
+def nodes_type(nodes, known):
+    """The type of an expression's value, given the nodes whose types depend on
+    what they read (see Site) and the types known so far by key. Returns None if
+    it reads something that hasn't been given a value yet."""
+    types = {}
+    node_type = None
+    for node_id, read, kind, arg1, arg2 in nodes:
+        if read is not None:
+            node_type = known.get(read)
+            if node_type is None:
+                return None
+            # Parameters are ints or floats, so text passed to one is taken to be a number
+            if kind is GetParam and node_type.kind == TEXT:
+                node_type = UNKNOWN
+        else:
+            node_type = arithmetic_type(kind,
+                    arg1 if type(arg1) is ValueType else types[arg1],
+                    arg2 if type(arg2) is ValueType else types[arg2])
+        types[node_id] = node_type
+    return node_type
+
+def code_name(script):
+    "The name of the function a script's code is in"
+    return script.fn_name if isinstance(script, EventBinding) else script.name
+
+def script_description(script):
+    if isinstance(script, EventBinding):
+        return "the {} script".format(script.event_name)
+    return script.name
+
+class Site(object):
+    """A place a script gives something a value: a variable, an item of a list,
+    a loop invariant, or (as an argument) a function parameter. The parts of the
+    value whose types can't change are worked out once, here. The rest are kept
+    in nodes, children first, each with the key of what it reads, if anything,
+    and otherwise with its arguments: a type, or the id of another node."""
+    __slots__ = ('key', 'how', 'value', 'nodes', 'reads', 'where', 'constant')
+
+    def __init__(self, key, how, value, scope, where):
+        self.key = key
+        self.how = how
+        self.value = value
+        self.where = where
+        self.nodes = []
+        self.reads = set()
+        order = []
+        stack = [value]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if isinstance(node, BinaryOperator) and not isinstance(node, COMPARISONS):
+                stack.extend((node.arg1, node.arg2))
+        fixed = {}
+        for node in reversed(order):
+            kind = type(node)
+            if kind is ReadVar:
+                read = ("variable", node.varName)
+            elif kind is GetParam:
+                read = ("parameter", scope[0], node.varName)
+            elif kind is ArduinoExpression:
+                read = ("invariant", scope[1], node.code)
+            elif issubclass(kind, BinaryOperator) and not issubclass(kind, COMPARISONS):
+                arg1 = fixed.get(id(node.arg1), id(node.arg1))
+                arg2 = fixed.get(id(node.arg2), id(node.arg2))
+                if type(arg1) is ValueType and type(arg2) is ValueType:
+                    fixed[id(node)] = arithmetic_type(kind, arg1, arg2)
+                else:
+                    self.nodes.append((id(node), None, kind, arg1, arg2))
+                continue
+            else:
+                fixed[id(node)] = fixed_type(node)
+                continue
+            self.reads.add(read)
+            self.nodes.append((id(node), read, kind, None, None))
+        # The value's type, if it can't change
+        self.constant = fixed.get(id(value))
+        if how == CHANGE:
+            # Changing by a value adds it to what the target held before
+            self.reads.add(key)
+
+    def reason(self):
+        "Why the value given here may be a fraction or text"
+        if self.how == CHANGE:
+            return "{} changes it by {}".format(self.where, self.value.to_arduino())
+        if self.key[0] == "list":
+            return "{} sets an item to {}".format(self.where, self.value.to_arduino())
+        if self.key[0] == "argument":
+            return "{} passes {}".format(self.where, self.value.to_arduino())
+        return "{} sets it to {}".format(self.where, self.value.to_arduino())
+
+def script_scope(script):
+    "What reads in script refer to: the function whose parameters they are, and where its invariants are"
+    return (script.name if isinstance(script, Function) else None, code_name(script))
+
+def group_of(key):
+    """The group a site's key, or something a site reads, belongs to: a variable,
+    a list, a function's parameters, or a script's loop invariants. Groups that no
+    script links can have their types inferred separately (see infer_types)."""
+    if key[0] == "parameter" or key[0] == "argument":
+        return ("function", key[1])
+    if key[0] == "invariant":
+        return key[:2]
+    return key
+
+class ScriptSites(object):
+    """The Sites in a script, and one for each of its divisions, to tell those
+    that come out whole. A call's arguments are keyed by the function's name and
+    their position, since which parameter each is depends on the function, which
+    may be in another script. groups holds the groups (see group_of) they touch."""
+    __slots__ = ('sites', 'divisions', 'groups')
+
+    def __init__(self, script):
+        self.sites = sites = []
+        self.divisions = []
+        where = script_description(script)
+        scope = script_scope(script)
+        for node in walk(script):
+            kind = type(node)
+            if kind is Divide:
+                self.divisions.append(Site(None, SET, node, scope, where))
+            elif kind is SetVar:
+                sites.append(Site(("variable", node.var_name), SET, node.set_value, scope, where))
+            elif kind is ChangeVarBy:
+                sites.append(Site(("variable", node.var_name), CHANGE, node.change_value, scope, where))
+            elif kind is SetListItemValue:
+                sites.append(Site(("list", node.array_name), SET, node.value, scope, where))
+            elif kind is Call:
+                for position, arg in enumerate(node.args):
+                    sites.append(Site(("argument", node.function_name, position), SET, arg, scope, where))
+            elif kind is LoopInvariants:
+                for name, value in zip(node.names, node.values):
+                    sites.append(Site(("invariant", scope[1], name), SET, value, scope, where))
+        self.groups = set()
+        for site in sites + self.divisions:
+            if site.key is not None:
+                self.groups.add(group_of(site.key))
+            self.groups.update(group_of(read) for read in site.reads)
+        # A function's parameters are given values by position, so depend on its definition
+        if isinstance(script, Function):
+            self.groups.add(("function", script.name))
+
+class TypeInference(object):
+    """Infers the type of every variable, list and function parameter, given the
+    Sites in a project's scripts, its functions by name, and its state (its
+    variables and lists, with their initial values). Each is a ValueType, or
+    None if nothing gives it a value. A list's type is the type of its items."""
+
+    def __init__(self, sites, functions, state):
+        self.types = {}
+        # Why each thing that isn't a whole number is a fraction or text
+        self.reasons = {}
+        # The divisions that come out whole, by the key of their script (see
+        # infer_types): their positions among its divisions
+        self.whole = {}
+        for name, value in state.items():
+            if isinstance(value, list):
+                integers = integer_values(value)
+                if integers:
+                    self.give(("list", name), ValueType(INT, min(integers), max(integers)), None)
+                    continue
+                items = {}
+                for item in value:
+                    items.setdefault(value_type(item), item)
+                for item_type, item in items.items():
+                    self.give(("list", name), item_type,
+                            lambda: "it starts with {}".format(json.dumps(item)))
+            else:
+                self.give(("variable", name), value_type(value),
+                        lambda: "it starts as {}".format(json.dumps(value)))
+        targets = []
+        for site in sites:
+            key = site.key
+            if key[0] == "argument":
+                function = functions.get(key[1])
+                if not isinstance(function, Function) or key[2] >= len(function.arg_names):
+                    continue
+                key = ("parameter", function.name, function.arg_names[key[2]])
+            targets.append((key, site))
+        self.assigned = set(key for key, site in targets)
+        # Nothing in the project gives the rest of what the sites read a value:
+        # undeclared variables, the parameters of functions never called, and
+        # Arduino code from the target
+        for key, site in targets:
+            for read in site.reads:
+                if read not in self.assigned and read not in self.types:
+                    self.types[read] = UNKNOWN
+        self.solve(targets)
+
+    def give(self, key, new_type, reason, widen=False):
+        """Adds new_type to the values key can hold, and returns whether that
+        changed them. reason() says why, should it make them fractions or text."""
+        current = self.types.get(key)
+        if new_type is None or (current is not None and current.holds(new_type)):
+            return False
+        joined = new_type.join(current)
+        if widen and current is not None:
+            joined = current.widen(joined)
+        if joined == current:
+            return False
+        if joined.kind > INT and (current is None or joined.kind > current.kind) and \
+                new_type.kind == joined.kind:
+            self.reasons[key] = reason()
+        self.types[key] = joined
+        return True
+
+    def solve(self, targets):
+        """Gives each site's value to its target, then gives again the values of
+        the sites that read something whose type changed, until none does. A
+        range that keeps growing is made unbounded, so this always finishes."""
+        readers = {}
+        for index, (key, site) in enumerate(targets):
+            for read in site.reads:
+                readers.setdefault(read, []).append(index)
+        evaluated = [False] * len(targets)
+        growths = {}
+        pending = deque(range(len(targets)))
+        queued = set(pending)
+        while pending:
+            index = pending.popleft()
+            queued.discard(index)
+            key, site = targets[index]
+            new_type = self.expression_type(site)
+            if new_type is None:
+                continue
+            if site.how == CHANGE:
+                # Scratch starts a variable with no value at 0
+                current = self.types.get(key) or ValueType(INT, 0, 0)
+                new_type = arithmetic_type(Add, current, new_type)
+            # Only growth from working out a value again counts towards widening,
+            # not one value after another given for the first time
+            again = evaluated[index]
+            evaluated[index] = True
+            widen = again and growths.get(key, 0) >= WIDEN_AFTER
+            if self.give(key, new_type, site.reason, widen):
+                if again:
+                    growths[key] = growths.get(key, 0) + 1
+                for reader in readers.get(key, ()):
+                    if reader not in queued:
+                        queued.add(reader)
+                        pending.append(reader)
+
+    def expression_type(self, site):
+        "The type of the value given at site, as things stand"
+        return site.constant or nodes_type(site.nodes, self.types)
+
+    def variable(self, name):
+        return self.types.get(("variable", name))
+
+    def list_items(self, name):
+        return self.types.get(("list", name))
+
+    def parameter(self, function, name):
+        return self.types.get(("parameter", function, name))
+
+    def written(self, kind, name):
+        "Whether any block sets the variable or an item of the list"
+        return (kind, name) in self.assigned
+
+    def reason(self, kind, name):
+        return self.reasons.get((kind, name))
+
+    def invariants(self):
+        "The type of each loop invariant, by its script's code_name and its own name"
+        return dict((key[1:], value_type) for key, value_type in self.types.items()
+                if key[0] == "invariant")
+
+    def parameter_reason(self, function, name):
+        return self.reasons.get(("parameter", function, name))
+
+    def find_whole(self, scripts):
+        "Notes which divisions in scripts, (key, script, ScriptSites) triples, come out whole"
+        for key, script, script_sites in scripts:
+            # Only an exact division of single whole numbers is a bounded whole number
+            positions = frozenset(position for position, site in enumerate(script_sites.divisions)
+                    if (self.expression_type(site) or UNKNOWN).bounded())
+            if positions:
+                self.whole[key] = positions
+
+    def add(self, other):
+        "Adds what other inferred, from sites and state that have nothing to do with these"
+        self.types.update(other.types)
+        self.reasons.update(other.reasons)
+        self.assigned.update(other.assigned)
+        self.whole.update(other.whole)
+
+    def whole_divisions(self, scripts):
+        """Returns the ids of the divisions in scripts, (key, script, ScriptSites)
+        triples, that come out whole, by the id of their script"""
+        whole = {}
+        for key, script, script_sites in scripts:
+            positions = self.whole.get(key)
+            if positions:
+                whole[id(script)] = frozenset(id(script_sites.divisions[position].value)
+                        for position in positions)
+        return whole
+
+def state_value(value):
+    "A variable's or list's initial value, as part of what its types were inferred from"
+    if isinstance(value, list):
+        return tuple(value), tuple(map(type, value))
+    # 1, 1.0 and True are equal, but not of the same type
+    return value, type(value)
+
+def infer_types(scripts, functions, state, solved=None):
+    """Infers the types in a project, given (key, script, ScriptSites) for each of
+    its scripts, where key is the script's hash, its functions by name and its
+    state. Scripts that touch none of the same groups (see group_of) can't change
+    each other's types, so the project is split into parts that don't, and each
+    part is solved on its own. solved holds the parts solved for an earlier
+    version of the project, by what they were solved from; those are reused.
+    Returns the TypeInference, and the parts solved for this version."""
+    # The groups each group is joined with, as a forest: each tree is a part
+    parents = {}
+    def root(group):
+        path = []
+        while group in parents:
+            path.append(group)
+            group = parents[group]
+        for joined in path:
+            parents[joined] = group
+        return group
+    for key, script, script_sites in scripts:
+        groups = iter(script_sites.groups)
+        first = root(next(groups, None))
+        for group in groups:
+            group = root(group)
+            if group != first:
+                parents[group] = first
+    parts = {}
+    for index, (key, script, script_sites) in enumerate(scripts):
+        # A script that touches no group may still have divisions to tell apart
+        group = root(next(iter(script_sites.groups))) if script_sites.groups else ("script", index)
+        parts.setdefault(group, ([], []))[0].append(index)
+    for name, value in state.items():
+        group = ("list", name) if isinstance(value, list) else ("variable", name)
+        parts.setdefault(root(group), ([], []))[1].append(name)
+
+    types = TypeInference([], functions, {})
+    now_solved = {}
+    for indexes, names in parts.values():
+        part_scripts = [scripts[index] for index in indexes]
+        signature = (tuple(sorted(key for key, script, script_sites in part_scripts)),
+                tuple(sorted((name, state_value(state[name])) for name in names)))
+        part = (solved or {}).get(signature)
+        if part is None or None in signature[0]:
+            part = TypeInference([site for key, script, script_sites in part_scripts
+                    for site in script_sites.sites], functions,
+                    dict((name, state[name]) for name in names))
+            part.find_whole(part_scripts)
+        now_solved[signature] = part
+        types.add(part)
+    return types, now_solved
@@ -0,0 +1,88 @@
+# Runs CPU-bound translations off the request thread. The pool admits a bounded
+# number of pending jobs; once it is full, new work is refused immediately with
+# PoolSaturatedError instead of queueing behind a slow request.
+
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+class PoolSaturatedError(Exception):
+    pass
+
+class WorkerError(Exception):
+    "Raised in the caller when a job fails in a worker; carries the worker's traceback"
+    def __init__(self, error, worker_traceback):
+        Exception.__init__(self, "{}\n\nIn worker:\n{}".format(error, worker_traceback))
+        self.error = error
+        self.worker_traceback = worker_traceback
+
+def call_capturing(fn, args):
+    "Calls fn in a worker, returning (ok, value, traceback) so failures always report back"
+    try:
+        return True, fn(*args), None
+    except Exception as e:
+        return False, e, traceback.format_exc()
+
+class WorkerPool(object):
+    """A thread or process pool with a bound on pending jobs. Threads suit
+    translations that are mostly waiting; processes spread them across cores."""
+
+    def __init__(self, workers=None, kind="thread", max_pending=None, timeout=30):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.kind = kind
+        self.max_pending = max_pending or 4 * self.workers
+        self.timeout = timeout
+        if kind == "thread":
+            self.pool = ThreadPool(self.workers)
+        elif kind == "process":
+            self.pool = multiprocessing.Pool(self.workers)
+        else:
+            raise ValueError("Unknown pool kind {}".format(kind))
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def __repr__(self):
+        return "<WorkerPool {} x{}>".format(self.kind, self.workers)
+
+    def submit(self, fn, *args):
+        """Queues fn(*args), returning an AsyncResult of (ok, value, traceback).
+        fn must be a module-level function when the pool uses processes."""
+        if not self.slots.acquire(False):
+            with self.lock:
+                self.rejected += 1
+            raise PoolSaturatedError("{} pending jobs; try again shortly".format(self.max_pending))
+        with self.lock:
+            self.pending += 1
+        return self.pool.apply_async(call_capturing, (fn, args), callback=self.finished)
+
+    def run(self, fn, *args):
+        "Runs fn(*args) in the pool and returns its result, re-raising failures as WorkerError"
+        ok, value, worker_traceback = self.submit(fn, *args).get(self.timeout)
+        if not ok:
+            raise WorkerError(value, worker_traceback)
+        return value
+
+    def finished(self, result):
+        with self.lock:
+            self.pending -= 1
+            self.completed += 1
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "kind": self.kind,
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self.pending,
+                "completed": self.completed,
+                "rejected": self.rejected
+            }
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()